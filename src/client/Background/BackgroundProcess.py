@@ -41,6 +41,9 @@ class BackgroundProcess:
             from Background.RequestsSender import RequestsSender
             self.requests_sender = RequestsSender()
 
+            from Background.ChangeWatcher import ChangeWatcher
+            self.change_watcher = ChangeWatcher()
+
             from GUI.Popup import Popup
             self.popup = Popup()
 
@@ -64,7 +67,10 @@ class BackgroundProcess:
             
          # Get number of other connected clients that are not away
 
-        number_of_clients = self.requests_sender.get_number_of_connected_clients(self.parameters.current_user.user_id)
+        number_of_clients = self.parameters.take_prefetched('number_of_connected_clients')  # Retrieved at login
+
+        if number_of_clients is None:
+            number_of_clients = self.requests_sender.get_number_of_connected_clients(self.parameters.current_user.user_id)
 
         if number_of_clients < 2:  # If there are no other connected clients
             Logs().write_new_log(logging.INFO, "NO OTHER CONNECTED CLIENT")
@@ -74,7 +80,8 @@ class BackgroundProcess:
         self.construct_popup_at_connection()
 
     def recreate_scheduler(self):
-        """Create or recreate the scheduler to check if there are changes in the user directory"""
+        """Create or recreate the scheduler to check if there are changes in the user directory.
+        When inotify is available, the changes are detected by the change watcher and the scheduler only runs occasional full rescans"""
 
         if self.scheduler_changes.running:
             self.scheduler_changes.shutdown(wait=False)
@@ -85,7 +92,12 @@ class BackgroundProcess:
             self.scheduler_changes.remove_job("scheduler_changes")
             Logs().write_new_log(logging.INFO, "RECREATED SCHEDULER TO CHECK CHANGES")
 
-        self.scheduler_changes.add_job(self.patch_process.send_changes_if_any, 'interval', seconds=self.parameters.current_client.interval_in_seconds_check, id="scheduler_changes")
+        interval_in_seconds_check = self.parameters.current_client.interval_in_seconds_check
+
+        if self.change_watcher.is_available() and self.change_watcher.start():
+            interval_in_seconds_check = max(interval_in_seconds_check, self.change_watcher.CONSISTENCY_CHECK_INTERVAL_IN_SECONDS)
+
+        self.scheduler_changes.add_job(self.patch_process.change_coalescer.add_changes, 'interval', seconds=interval_in_seconds_check, id="scheduler_changes")
         self.scheduler_changes.start()
 
         Logs().write_new_log(logging.INFO, "STARTED SCHEDULER TO CHECK CHANGES")
@@ -107,6 +119,7 @@ class BackgroundProcess:
     
     def stop_interval_check_for_changes(self):
         self.scheduler_changes.shutdown(wait=False)
+        self.change_watcher.stop()
         Logs().write_new_log(logging.INFO, "STOPPED SCHEDULER TO CHECK CHANGES")
 
     def overwrite_local_files(self):
@@ -123,7 +136,7 @@ class BackgroundProcess:
         Logs().write_new_log(logging.INFO, "SENDING LOCAL FILES TO OTHER CLIENTS")
         
         # Backup of files before block-level synchronization
-        backup_current_files = self.parameters.get_list_of_files()
+        backup_current_files = self.parameters.take_snapshot_of_files()
 
         self.requests_sender.send_to_server_blocks(self.files_blocks)
 
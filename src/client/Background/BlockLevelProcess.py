@@ -5,12 +5,16 @@ import hashlib
 import json
 import bsdiff4
 import glob
+import zlib
+import concurrent.futures
+import multiprocessing
 from pathlib import Path
 
 from Parameters import Parameters
 
 from Block import Block
 from File import File
+from Background.ContentDefinedChunker import ContentDefinedChunker
 
 import sys
 from pathlib import Path
@@ -23,6 +27,11 @@ from Logs import Logs
 class BlockLevelProcess:
     _instance = None
 
+    HASHING_WORKERS = min(32, (os.cpu_count() or 1) * 2)  # hashlib releases the GIL on large buffers, so threads hash in parallel
+    ADLER_MODULO = 65521
+    MAX_ROLLED_BYTES_PER_FILE = 8 * 1024 * 1024  # About a second of rolling in Python, the windows are then only checked after the previous one
+    ROLLING_READ_SIZE = 1024 * 1024  # Bytes read at once, after the block being rolled over
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(BlockLevelProcess, cls).__new__(cls)
@@ -45,96 +54,386 @@ class BlockLevelProcess:
         """Call generate_blocks() at startup and return it"""
         return self.generate_blocks()
 
-    def generate_blocks(self):
-        """Generate a list of blocks for each file in the user directory"""
+    def hash_blocks_of_file(self, current_file_path, relative_path, block_size_limit):
+        """Hash the blocks of a file, reading them one by one into a reused buffer.
+        The file is not mapped: a file truncated by another program while it is mapped kills the client with SIGBUS
+
+        Parameters:
+            current_file_path -- The full path of the file
+            relative_path -- The relative path of the file
+            block_size_limit -- The size of the blocks in bytes
+
+        Returns:
+            The list of blocks of the file
+        """
+        blocks = []
+        buffer_view = memoryview(bytearray(block_size_limit))
+        bytes_count = 0
+
+        with open(current_file_path, "rb") as f:
+            while block_size := f.readinto(buffer_view):  # Get the size of the block, only the last one is smaller
+                read_block = buffer_view[:block_size]  # No copy of the block
+                hashed_block = hashlib.sha256(read_block).hexdigest()  # Get the hash of the block
+                weak_hash = zlib.adler32(read_block)  # Lets the sending client find the block at any offset of its file
+                read_block.release()
+
+                blocks.append(Block(
+                    file_rel_path=relative_path,
+                    block_number=len(blocks),
+                    hash_var=hashed_block,
+                    starting_byte=bytes_count,
+                    block_size=block_size,
+                    weak_hash=weak_hash
+                ))
+
+                bytes_count += block_size
+
+        if not blocks:  # The file was emptied after its size was read
+            blocks.append(Block(
+                file_rel_path=relative_path,
+                block_number=0,
+                hash_var=hashlib.sha256(b'').hexdigest(),
+            ))
+
+        return blocks
+
+    def generate_blocks(self, chunking_mode=None):
+        """Generate a list of blocks for each file in the user directory. The files are hashed in parallel by a pool of workers
+
+        Parameters:
+            chunking_mode -- "fixed" to cut the files every block_size_in_bytes, "cdc" to cut them at content-defined boundaries. Defaults to the mode of the user"""
         files_blocks = {}
         full_path_to_user_dir = self.parameters.current_client.user_directory  # Path to the user directory
+        block_size_limit = self.parameters.current_user.block_size_in_bytes
+        chunking_mode = chunking_mode or self.parameters.current_user.chunking_mode
 
         # Get all files in the user directory, including hidden files
 
         files = Path(full_path_to_user_dir).rglob('*')
-        
-        for file in files:
-            #current_file_path = full_path_to_user_dir / file  # Full path to file
-            current_file_path = file
-
-            # Skip if path is invalid or inaccessible
-            if not current_file_path.exists():
-                continue
 
-            current_file_size = current_file_path.stat().st_size  # Get the size of the file
-            relative_path = str(current_file_path.relative_to(full_path_to_user_dir))  # Get the relative path
-            files_blocks[relative_path] = []  # Create an empty list for the file inside the dictionary
+        if chunking_mode == "cdc":
+            # The rolling hash holds the GIL, so the files are cut in other processes. They are spawned, a fork would copy the locks held by the Qt and torrent threads
+            chunker = ContentDefinedChunker(block_size_limit)
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.HASHING_WORKERS)
 
-            if current_file_path.is_dir():  # If it's a directory                
-                files_blocks[relative_path].append(Block(
-                    is_dir=1,
-                    file_rel_path=relative_path,
-                    block_number=0,
-                ))
+        with executor:
+            futures = {}
 
-                continue
+            for file in files:
+                #current_file_path = full_path_to_user_dir / file  # Full path to file
+                current_file_path = file
 
-            if current_file_size == 0:  # Handle empty files
-                files_blocks[relative_path].append(Block(
-                    file_rel_path=relative_path,
-                    block_number=0,
-                    hash_var=hashlib.sha256(b'').hexdigest(),
-                ))
+                # Skip if path is invalid or inaccessible
+                if not current_file_path.exists():
+                    continue
 
-                continue
+                current_file_size = current_file_path.stat().st_size  # Get the size of the file
+                relative_path = str(current_file_path.relative_to(full_path_to_user_dir))  # Get the relative path
+                files_blocks[relative_path] = []  # Create an empty list for the file inside the dictionary
 
-            with open(current_file_path, "rb") as f:  # Open the file in binary mode
-                size_limit = self.parameters.current_user.block_size_in_bytes
-                bytes_count = 0
-                block_number = 0
+                if current_file_path.is_dir():  # If it's a directory                
+                    files_blocks[relative_path].append(Block(
+                        is_dir=1,
+                        file_rel_path=relative_path,
+                        block_number=0,
+                    ))
 
-                while bytes_count < current_file_size:  # While it has not reached the end of the file
-                    read_file = f.read(size_limit)  # Read from the pointer to the end of the block
-                    block_size = len(read_file)  # Get the size of the block
-                    hashed_block = hashlib.sha256(read_file).hexdigest()  # Get the hash of the block
+                    continue
 
+                if current_file_size == 0:  # Handle empty files
                     files_blocks[relative_path].append(Block(
                         file_rel_path=relative_path,
-                        block_number=block_number,
-                        hash_var=hashed_block,
-                        starting_byte=bytes_count,
-                        block_size=block_size
+                        block_number=0,
+                        hash_var=hashlib.sha256(b'').hexdigest(),
                     ))
 
-                    bytes_count += block_size
-                    block_number += 1
+                    continue
+
+                if chunking_mode == "cdc":
+                    futures[relative_path] = executor.submit(chunker.chunk_file, current_file_path)
+                else:
+                    futures[relative_path] = executor.submit(self.hash_blocks_of_file, current_file_path, relative_path, block_size_limit)
+
+            for relative_path, future in futures.items():
+                try:
+                    if chunking_mode == "cdc":
+                        files_blocks[relative_path] = [Block(
+                            file_rel_path=relative_path,
+                            block_number=block_number,
+                            hash_var=chunk_hash,
+                            starting_byte=starting_byte,
+                            block_size=chunk_size
+                        ) for block_number, (starting_byte, chunk_size, chunk_hash) in enumerate(future.result())]
+                    else:
+                        files_blocks[relative_path] = future.result()
+
+                except (OSError, ValueError):  # The file was removed or emptied while it was hashed
+                    del files_blocks[relative_path]
 
         Logs().write_new_log(logging.INFO, "DETERMINED FILES AND THEIR BLOCKS")
 
         return files_blocks
 
-    def compare_files_blocks(self, received_files_blocks, connecting_client):
+    def index_received_blocks(self, received_files_blocks):
+        """Index the blocks of the receiving client by hash, so a content it already has in any of its files is not sent
+
+        Parameters:
+        received_files_blocks -- The blocks of the files of the receiving client
+
+        Returns:
+        A dictionary SHA-256 -> location {'file_rel_path', 'starting_byte', 'length'} of the content in the files of the receiving client
+        """
+        received_blocks_locations = {}
+
+        for file, received_blocks in received_files_blocks.items():
+            for received_block in received_blocks:
+                if not received_block['is_dir'] and received_block['block_size']:
+                    received_blocks_locations.setdefault(received_block['hash'], {
+                        'file_rel_path': file,
+                        'starting_byte': received_block['starting_byte'],
+                        'length': received_block['block_size']
+                    })
+
+        return received_blocks_locations
+
+    def index_received_weak_hashes(self, received_files_blocks, block_size):
+        """Index the full-size blocks of the receiving client by Adler-32, so they can be found at any offset of the local files
+
+        Parameters:
+        received_files_blocks -- The blocks of the files of the receiving client
+        block_size -- The size of the blocks
+
+        Returns:
+        A dictionary Adler-32 -> SHA-256 of the blocks having this Adler-32. It is empty if the receiving client sent no Adler-32
+        """
+        received_weak_hashes = {}
+
+        for received_blocks in received_files_blocks.values():
+            for received_block in received_blocks:
+                if received_block.get('weak_hash') is not None and received_block['block_size'] == block_size:
+                    received_weak_hashes.setdefault(received_block['weak_hash'], set()).add(received_block['hash'])
+
+        return received_weak_hashes
+
+    def find_blocks_at_any_offset(self, file, block_size, received_weak_hashes):
+        """Cut a local file into the blocks the receiving client has, wherever they moved, and the data between them.
+        Like rsync, an Adler-32 window rolls over the file one byte at a time and the windows with a known Adler-32 are confirmed by their SHA-256.
+        After a found block the next window is hashed directly, so only the data the receiving client does not have is rolled over in Python.
+        The rolling holds the lock of the changes, so after MAX_ROLLED_BYTES_PER_FILE the windows are only checked at the block boundaries
+        following the last found block. The file is read into a bounded buffer, not mapped, so a truncation cannot raise SIGBUS
+
+        Parameters:
+        file -- The relative path of the file
+        block_size -- The size of the blocks of the receiving client
+        received_weak_hashes -- The SHA-256 of the blocks of the receiving client, by Adler-32
+
+        Returns:
+        The list of blocks of the local file. The data between the found blocks has no hash, except the end of the file
+        """
+        current_file_path = self.parameters.current_client.user_directory / file
+        blocks = []
+        adler_modulo = self.ADLER_MODULO
+
+        with open(current_file_path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            buffer = bytearray()
+            buffer_start = 0  # Position of the first byte of the buffer in the file
+            position = 0
+            unmatched_start = 0
+            weak_hash = None
+            rolled_bytes = 0
+
+            while position + block_size <= file_size:
+                index = position - buffer_start
+
+                if index + block_size >= len(buffer) and buffer_start + len(buffer) < file_size:  # The window or the next byte is not read yet
+                    del buffer[:index]
+                    buffer_start = position
+                    read_bytes = f.read(block_size + self.ROLLING_READ_SIZE)
+                    buffer += read_bytes
+
+                    if len(read_bytes) < block_size + self.ROLLING_READ_SIZE:  # The end of the file, earlier if it was truncated
+                        file_size = min(file_size, buffer_start + len(buffer))
+
+                    continue
+
+                if weak_hash is None:
+                    weak_hash = zlib.adler32(buffer[index:index + block_size])
+
+                candidates = received_weak_hashes.get(weak_hash)
+
+                if candidates is not None:
+                    block_hash = hashlib.sha256(buffer[index:index + block_size]).hexdigest()
+
+                    if block_hash in candidates:
+                        if unmatched_start < position:
+                            blocks.append(Block(file_rel_path=file, block_number=len(blocks), hash_var=None, starting_byte=unmatched_start, block_size=position - unmatched_start))
+
+                        blocks.append(Block(file_rel_path=file, block_number=len(blocks), hash_var=block_hash, starting_byte=position, block_size=block_size))
+
+                        position += block_size
+                        unmatched_start = position
+                        weak_hash = None
+                        continue
+
+                if rolled_bytes >= self.MAX_ROLLED_BYTES_PER_FILE:  # Only the next block boundary after the last found block is checked
+                    position += block_size - (position - unmatched_start) % block_size
+                    weak_hash = None
+                    continue
+
+                if position + block_size < file_size:  # Roll the window by one byte
+                    outgoing_byte = buffer[index]
+                    incoming_byte = buffer[index + block_size]
+
+                    sum_a = ((weak_hash & 0xffff) - outgoing_byte + incoming_byte) % adler_modulo
+                    sum_b = ((weak_hash >> 16) - block_size * outgoing_byte + sum_a - 1) % adler_modulo
+                    weak_hash = (sum_b << 16) | sum_a
+
+                position += 1
+                rolled_bytes += 1
+
+            if unmatched_start < file_size:
+                end_hash = None
+
+                if file_size - unmatched_start <= block_size:  # May be the same as the last partial block of the receiving client
+                    f.seek(unmatched_start)
+                    end_hash = hashlib.sha256(f.read(file_size - unmatched_start)).hexdigest()
+
+                blocks.append(Block(file_rel_path=file, block_number=len(blocks), hash_var=end_hash, starting_byte=unmatched_start, block_size=file_size - unmatched_start))
+
+        return blocks
+
+    def add_block_content(self, payload_writer, current_file_path, block, received_blocks_locations):
+        """Reference the content of a block if the receiving client has it, or copy it into the payload once per content
+
+        Parameters:
+        payload_writer -- The writer of the payload
+        current_file_path -- The full path of the file of the block
+        block -- The block
+        received_blocks_locations -- The locations of the blocks of the receiving client, by hash
+
+        Returns:
+        The reference of the content, to put in the manifest
+        """
+        location = received_blocks_locations.get(block.hash)
+
+        if location is not None:
+            return payload_writer.add_local_content(block.hash, **location)
+
+        return payload_writer.add_file_segment(current_file_path, block.starting_byte, block.block_size, content_hash=block.hash)
+
+    def build_rebuild_recipe(self, payload_writer, file, local_blocks, received_blocks, received_blocks_locations, max_literal_size, received_weak_hashes=None):
+        """Build the list of instructions needed by the receiving client to rebuild a file, whatever the chunking mode.
+        Blocks are matched by hash at any offset: the blocks the receiving client has in the same file become copies from their offset,
+        contiguous copies being merged, the ones it has in another file are referenced, and only the missing data is sent.
+        Content-defined chunks follow the data that moved. Fixed-size blocks only do if the receiving client sent their Adler-32,
+        they are then searched at every offset of the local file
+
+        Parameters:
+        payload_writer -- The writer of the payload in which the missing blocks are copied
+        file -- The relative path of the file
+        local_blocks -- The blocks of the local file
+        received_blocks -- The blocks of the file of the receiving client
+        received_blocks_locations -- The locations of the blocks of every file of the receiving client, by hash
+        max_literal_size -- The maximum size of the data sent in one instruction
+        received_weak_hashes -- The SHA-256 of the fixed-size blocks of the receiving client by Adler-32, or None for content-defined chunks
+
+        Returns:
+        The recipe of the file, or None if the file is the same on both clients
+        """
+        if [block.hash for block in local_blocks] == [block['hash'] for block in received_blocks]:
+            return None
+
+        if received_weak_hashes:  # The local blocks are cut again where the blocks of the receiving client are found
+            local_blocks = self.find_blocks_at_any_offset(file, max_literal_size, received_weak_hashes)
+
+        received_blocks_by_hash = {block['hash']: block for block in received_blocks if block['block_size']}
+        current_file_path = self.parameters.current_client.user_directory / file
+        chunks = []
+
+        for block in local_blocks:
+            received_block = received_blocks_by_hash.get(block.hash)
+
+            if received_block is not None:  # The receiving client copies the block from its own file
+                previous_chunk = chunks[-1] if chunks else None
+
+                if previous_chunk is not None and previous_chunk['source_starting_byte'] is not None \
+                        and previous_chunk['source_starting_byte'] + previous_chunk['block_size'] == received_block['starting_byte']:
+                    previous_chunk['block_size'] += block.block_size  # Contiguous copies are merged into one instruction
+                    previous_chunk['hash'] = None
+                    continue
+
+                chunks.append(Block(
+                    is_dir=0,
+                    file_rel_path=file,
+                    block_number=block.block_number,
+                    hash_var=block.hash,
+                    starting_byte=block.starting_byte,
+                    block_size=block.block_size,
+                    source_starting_byte=received_block['starting_byte']
+                ).to_json())
+
+            elif block.block_size <= max_literal_size or block.hash in received_blocks_locations:
+                chunks.append(Block(
+                    is_dir=0,
+                    file_rel_path=file,
+                    content_bytes=self.add_block_content(payload_writer, current_file_path, block, received_blocks_locations),  # Maybe in another file
+                    block_number=block.block_number,
+                    hash_var=block.hash,
+                    starting_byte=block.starting_byte,
+                    block_size=block.block_size
+                ).to_json())
+
+            else:  # A content-defined chunk larger than the block size is sent in several parts
+                for offset in range(0, block.block_size, max_literal_size):
+                    part_size = min(max_literal_size, block.block_size - offset)
+
+                    chunks.append(Block(
+                        is_dir=0,
+                        file_rel_path=file,
+                        content_bytes=payload_writer.add_file_segment(current_file_path, block.starting_byte + offset, part_size),
+                        block_number=block.block_number,
+                        hash_var=None,
+                        starting_byte=block.starting_byte + offset,
+                        block_size=part_size
+                    ).to_json())
+
+        return {'file_rel_path': file, 'chunks': chunks}
+
+    def compare_files_blocks(self, received_files_blocks, connecting_client, chunking_mode="fixed"):
         """Compare the blocks received via socket with the current client's own blocks
         
         Parameters:
         received_files_blocks -- List of blocks of files received by another client via socket
         connecting_client -- The client that sent the blocks
+        chunking_mode -- The chunking mode used by the client that sent the blocks
         """
 
         Logs().write_new_log(logging.INFO, "COMPARING LOCAL BLOCKS WITH RECEIVED BLOCKS")
                 
-        files_blocks = self.generate_blocks()  # Get the files blocks
+        files_blocks = self.generate_blocks(chunking_mode)  # Get the files blocks, cut the same way as the received ones
 
-        # Dictionary of differences that will be serialized to JSON and sent via torrent
-        difference_blocks = {
-            'added': [],
-            'deleted': [],
-            'modified': []
-        }
+        # The differences are fed one at a time to the payload that will be sent via torrent
+        payload_writer = self.torrent_handler.create_payload_writer()
 
         # Get the files that need to be added or deleted
         to_add = set(files_blocks).difference(received_files_blocks)
         to_delete = set(received_files_blocks).difference(files_blocks)
 
+        # The contents the receiving client has in any of its files are referenced instead of sent
+        received_blocks_locations = self.index_received_blocks(received_files_blocks)
+
+        # Fixed-size blocks are also searched at every offset of the local files, content-defined chunks already follow the data that moved
+        received_weak_hashes = None
+
+        if chunking_mode != "cdc":
+            received_weak_hashes = self.index_received_weak_hashes(received_files_blocks, self.parameters.current_user.block_size_in_bytes)
+
         # Add files to be deleted
         for file in to_delete:
-            difference_blocks['deleted'].append(file)
+            payload_writer.add_entry('deleted', file)
 
         for file in files_blocks:
             if file in to_add:  # If the file needs to be added
@@ -142,13 +441,10 @@ class BlockLevelProcess:
 
                 file_obj = None
 
-                if not current_file_full_path.is_dir():  # If the file is not a directory, open it
-                    with open(current_file_full_path, "rb") as file_open:
-                        file_content_bytes = file_open.read()
-
+                if not current_file_full_path.is_dir():  # If the file is not a directory, copy it into the payload
                     file_obj = File(                        
                         file_rel_path=file,
-                        content_bytes=str(file_content_bytes)
+                        content_bytes=payload_writer.add_file_segment(current_file_full_path)
                     ).to_json()
 
                 else:
@@ -157,7 +453,7 @@ class BlockLevelProcess:
                         file_rel_path=file,
                     ).to_json()
 
-                difference_blocks['added'].append(file_obj)
+                payload_writer.add_entry('added', file_obj)
 
             else:
                 current_file_path = self.parameters.current_client.user_directory / file
@@ -165,29 +461,11 @@ class BlockLevelProcess:
                 if current_file_path.is_dir():
                     continue
 
-                with open(current_file_path, "rb") as file_open:
-                    for index, block in enumerate(files_blocks[file]):  # For each block of the file
-
-                        if index >= len(received_files_blocks[file]):  # If the block is not in the list of received blocks
-                            file_open.seek(block.starting_byte)
-                            block_content_bytes = file_open.read()
-
-                        elif block.hash != received_files_blocks[file][index]['hash']:  # If the hashes of the two lists are not the same
-                            file_open.seek(block.starting_byte)
-                            block_content_bytes = file_open.read(block.block_size)
-
-                        else:
-                            continue
+                # Blocks are matched by hash instead of index, in both chunking modes
+                recipe = self.build_rebuild_recipe(payload_writer, file, files_blocks[file], received_files_blocks[file], received_blocks_locations, self.parameters.current_user.block_size_in_bytes, received_weak_hashes)
 
-                        difference_blocks['modified'].append(Block(
-                            is_dir=0,
-                            file_rel_path=file,
-                            content_bytes=str(block_content_bytes),
-                            block_number=block.block_number,
-                            hash_var=block.hash,
-                            starting_byte=block.starting_byte,
-                            block_size=block.block_size
-                        ).to_json())
+                if recipe is not None:
+                    payload_writer.add_entry('rebuilt', recipe)
 
         # Generate and send the data for the differences found
-        self.torrent_handler.generate_data_to_send_and_torrent(difference_blocks, "block", connecting_client)
\ No newline at end of file
+        self.torrent_handler.generate_data_to_send_and_torrent(payload_writer, "block", connecting_client)
\ No newline at end of file
@@ -0,0 +1,154 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import time
+import threading
+
+import sys
+from pathlib import Path
+parent_directory = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(parent_directory))
+
+import logging
+from Logs import Logs
+
+class ChangeCoalescer:
+    """
+    The ChangeCoalescer class merges the changes reported in a short time into a single generation of changes.
+    The changes are only looked for once no change was reported during the quiet window, once the batch is large enough,
+    or once the first change waited for too long. The changes are computed against the last published snapshot,
+    so the intermediate versions of a file saved several times are never published.
+    """
+
+    DEFAULT_QUIET_WINDOW_IN_SECONDS = 2  # Time without new change before the generation is published
+    DEFAULT_MAX_BATCH_SIZE = 1000  # Number of changed paths after which the generation is published without waiting
+    DEFAULT_MAX_DELAY_IN_SECONDS = 10  # Maximum time a change waits while changes keep coming
+    RETRY_DELAY_IN_SECONDS = 10  # Time before the changes of a generation that could not be published are looked for again
+
+    def __init__(self, send_changes, quiet_window_in_seconds=DEFAULT_QUIET_WINDOW_IN_SECONDS, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_delay_in_seconds=DEFAULT_MAX_DELAY_IN_SECONDS):
+        """
+        Initialize a new ChangeCoalescer object.
+
+        Parameters:
+        send_changes -- Function looking for the changes of a set of relative paths (or None for every path) and publishing them.
+        quiet_window_in_seconds -- Time without new change before the generation is published.
+        max_batch_size -- Number of changed paths after which the generation is published without waiting.
+        max_delay_in_seconds -- Maximum time a change waits while changes keep coming.
+        """
+        self.send_changes = send_changes
+        self.quiet_window_in_seconds = quiet_window_in_seconds
+        self.max_batch_size = max_batch_size
+        self.max_delay_in_seconds = max_delay_in_seconds
+
+        self.pending_paths = set()
+        self.is_full_scan_pending = False
+        self.has_pending_changes = False
+        self.first_change_time = 0
+        self.last_change_time = 0
+        self.retry_time = 0  # Time before which nothing is published, after a generation failed
+
+        self.condition = threading.Condition()
+        self.is_flushing = False  # Indicates if a thread is waiting to publish the pending changes
+        self.pause_count = 0  # Number of payloads being applied, the changes are only published once none is
+
+    def add_changes(self, dirty_paths=None):
+        """Add changes to the next generation
+
+        Parameters:
+            dirty_paths -- Relative paths that changed. If None, the whole user directory is scanned"""
+        with self.condition:
+            if dirty_paths is None:
+                self.is_full_scan_pending = True
+            else:
+                self.pending_paths.update(dirty_paths)
+
+            now = time.monotonic()
+
+            if not self.has_pending_changes:
+                self.first_change_time = now
+                self.has_pending_changes = True
+
+            self.last_change_time = now
+            self.condition.notify()
+
+            if not self.is_flushing:
+                self.is_flushing = True
+                threading.Thread(target=self.flush_when_settled, daemon=True).start()
+
+    def configure(self, quiet_window_in_seconds, max_batch_size):
+        """Change the settings of the coalescing, they are used for the pending changes too
+
+        Parameters:
+            quiet_window_in_seconds -- Time without new change before the generation is published
+            max_batch_size -- Number of changed paths after which the generation is published without waiting"""
+        with self.condition:
+            self.quiet_window_in_seconds = quiet_window_in_seconds
+            self.max_batch_size = max_batch_size
+
+            self.condition.notify()
+
+    def pause(self):
+        """Stop publishing the changes, e.g. while a payload is applied. The changes reported meanwhile are kept"""
+        with self.condition:
+            self.pause_count += 1
+
+    def resume(self, discarded_paths=()):
+        """Publish the changes again, without the changes made by the client itself while it was paused
+
+        Parameters:
+            discarded_paths -- Relative paths written by the client while it was paused"""
+        with self.condition:
+            self.pause_count -= 1
+            self.pending_paths.difference_update(discarded_paths)
+
+            if not self.pending_paths and not self.is_full_scan_pending:
+                self.has_pending_changes = False
+
+            self.condition.notify()
+
+    def flush_when_settled(self):
+        """Wait for the pending changes to settle and publish them, until no change is pending anymore"""
+        while True:
+            with self.condition:
+                if not self.has_pending_changes:
+                    self.is_flushing = False
+                    return
+
+                if self.pause_count:
+                    self.condition.wait()
+                    continue
+
+                now = time.monotonic()
+
+                if now < self.retry_time:
+                    self.condition.wait(self.retry_time - now)
+                    continue
+
+                remaining_time = min(self.last_change_time + self.quiet_window_in_seconds, self.first_change_time + self.max_delay_in_seconds) - now
+
+                if remaining_time > 0 and len(self.pending_paths) < self.max_batch_size:
+                    self.condition.wait(remaining_time)
+                    continue
+
+                dirty_paths = None if self.is_full_scan_pending else self.pending_paths
+
+                self.pending_paths = set()
+                self.is_full_scan_pending = False
+                self.has_pending_changes = False
+
+            Logs().write_new_log(logging.INFO, f"PUBLISHING GENERATION OF {'ALL' if dirty_paths is None else len(dirty_paths)} CHANGED PATHS")
+
+            try:
+                self.send_changes(dirty_paths)  # Changes reported meanwhile are kept for the next generation
+
+            except Exception as e:
+                # E.g. a file deleted while it was read, or the server unreachable. The thread keeps running and the paths are looked for again later
+                Logs().write_new_log(logging.ERROR, f"ERROR WHILE PUBLISHING GENERATION: {e!r}")
+
+                with self.condition:
+                    self.retry_time = time.monotonic() + self.RETRY_DELAY_IN_SECONDS
+
+                self.add_changes(dirty_paths)
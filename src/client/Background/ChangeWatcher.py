@@ -0,0 +1,234 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import os
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+
+from Parameters import Parameters
+
+import sys
+from pathlib import Path
+parent_directory = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(parent_directory))
+
+import logging
+from Logs import Logs
+
+# Flags of the Linux inotify API (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class ChangeWatcher:
+    """
+    The ChangeWatcher class watches the user directory with Linux inotify. It keeps the set of paths that changed,
+    waits for bursts of edits to settle and then looks for changes only in these paths.
+    """
+
+    _instance = None
+
+    DEBOUNCE_IN_SECONDS = 0.3  # Time without new event before the dirty paths are handled
+    MAX_DEBOUNCE_IN_SECONDS = 2  # Maximum time a dirty path waits while edits keep coming
+    CONSISTENCY_CHECK_INTERVAL_IN_SECONDS = 600  # Interval of the full rescans when the watcher is running
+    READ_BUFFER_SIZE = 64 * 1024
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ChangeWatcher, cls).__new__(cls)
+
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            self.initialized = True
+
+            self.parameters = Parameters()
+
+            from Background.PatchProcess import PatchProcess
+            self.patch_process = PatchProcess()
+
+            self.libc = None
+
+            if sys.platform.startswith("linux"):
+                try:
+                    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                    self.libc.inotify_init1.argtypes = [ctypes.c_int]
+                    self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                except (OSError, AttributeError):
+                    self.libc = None
+
+            self.inotify_fd = None
+            self.watch_thread = None
+            self.stop_event = threading.Event()
+
+            self.dirty_paths = set()
+            self.dirty_paths_lock = threading.Lock()
+
+            Logs().write_new_log(logging.INFO, "INITIALIZED CLIENT CHANGEWATCHER")
+
+            print("CLIENT CHANGEWATCHER INITIALIZED")
+
+    def is_available(self):
+        """Check if inotify can be used on this system"""
+        return self.libc is not None
+
+    def is_running(self):
+        """Check if the watcher thread is running"""
+        return self.watch_thread is not None and self.watch_thread.is_alive()
+
+    def start(self):
+        """Start watching the user directory, restarting the watcher if it was already running"""
+        self.stop()
+
+        self.inotify_fd = self.libc.inotify_init1(IN_CLOEXEC)
+
+        if self.inotify_fd < 0:
+            Logs().write_new_log(logging.ERROR, f"INOTIFY INIT FAILED: {os.strerror(ctypes.get_errno())}")
+            self.inotify_fd = None
+            return False
+
+        self.user_directory = Path(self.parameters.current_client.user_directory)
+        self.watched_directories = {}  # Watch descriptor -> relative path of the directory
+
+        self.add_watches(os.curdir)
+
+        self.stop_event.clear()
+        self.watch_thread = threading.Thread(target=self.watch_for_changes, daemon=True)
+        self.watch_thread.start()
+
+        Logs().write_new_log(logging.INFO, "STARTED CHANGE WATCHER")
+
+        return True
+
+    def stop(self):
+        """Stop watching the user directory"""
+        if self.is_running():
+            self.stop_event.set()
+            self.watch_thread.join()
+
+            Logs().write_new_log(logging.INFO, "STOPPED CHANGE WATCHER")
+
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+        with self.dirty_paths_lock:
+            self.dirty_paths.clear()
+
+    def add_watches(self, directory_rel_path):
+        """Watch a directory and all the directories below it
+
+        Parameters:
+            directory_rel_path -- The relative path of the directory inside the user directory"""
+        top_directory = os.path.normpath(self.user_directory / directory_rel_path)
+
+        for directory_path, directories_names, files_names in os.walk(top_directory):
+            watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory_path), WATCH_MASK)
+
+            if watch_descriptor < 0:
+                Logs().write_new_log(logging.WARNING, f"COULD NOT WATCH {directory_path}: {os.strerror(ctypes.get_errno())}")
+                continue
+
+            # Adding a watch on an already watched directory returns the same descriptor, which updates moved directories
+            self.watched_directories[watch_descriptor] = os.path.relpath(directory_path, self.user_directory)
+
+    def mark_as_dirty(self, file_rel_path):
+        """Add a path to the set of dirty paths
+
+        Parameters:
+            file_rel_path -- The relative path that changed"""
+        with self.dirty_paths_lock:
+            if not self.dirty_paths:
+                self.first_dirty_time = time.monotonic()
+
+            self.dirty_paths.add(os.path.normpath(file_rel_path))
+            self.last_event_time = time.monotonic()
+
+    def read_events(self):
+        """Read the pending inotify events and mark the corresponding paths as dirty"""
+        events_buffer = os.read(self.inotify_fd, self.READ_BUFFER_SIZE)
+        offset = 0
+
+        while offset < len(events_buffer):
+            watch_descriptor, mask, cookie, name_length = EVENT_HEADER.unpack_from(events_buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(events_buffer[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:  # Events were lost, the whole user directory has to be scanned
+                Logs().write_new_log(logging.WARNING, "INOTIFY QUEUE OVERFLOW")
+                self.mark_as_dirty(os.curdir)
+                continue
+
+            directory_rel_path = self.watched_directories.get(watch_descriptor)
+
+            if directory_rel_path is None:
+                continue
+
+            if mask & IN_IGNORED:  # The directory is not watched anymore
+                del self.watched_directories[watch_descriptor]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.mark_as_dirty(directory_rel_path)
+                continue
+
+            file_rel_path = os.path.join(directory_rel_path, name)
+            self.mark_as_dirty(file_rel_path)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):  # Watch new directories and what was already written inside them
+                self.add_watches(file_rel_path)
+
+    def watch_for_changes(self):
+        """Wait for inotify events and handle the dirty paths once the edits settled"""
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.inotify_fd], [], [], 0.1)
+
+            if readable:
+                self.read_events()
+
+            self.handle_dirty_paths_if_settled()
+
+    def handle_dirty_paths_if_settled(self):
+        """Hand the dirty paths to the change coalescer if no event came for a while, or if they waited for too long"""
+        with self.dirty_paths_lock:
+            if not self.dirty_paths:
+                return
+
+            now = time.monotonic()
+
+            if now - self.last_event_time < self.DEBOUNCE_IN_SECONDS and now - self.first_dirty_time < self.MAX_DEBOUNCE_IN_SECONDS:
+                return
+
+            dirty_paths = self.dirty_paths
+            self.dirty_paths = set()
+
+        if os.curdir in dirty_paths:
+            dirty_paths = None  # Full rescan
+
+        self.patch_process.change_coalescer.add_changes(dirty_paths)
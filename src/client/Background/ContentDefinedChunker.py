@@ -0,0 +1,197 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import os
+import struct
+import bisect
+import hashlib
+
+# Gear table of the rolling hash. It is derived from SHA-256 so every client cuts the same content at the same places
+GEAR_TABLE = [int.from_bytes(hashlib.sha256(b"foxync-gear-" + bytes([byte])).digest()[:8], "big") for byte in range(256)]
+
+# Byte j of the gear value of every byte, to build the gear values of a segment with bytes.translate
+GEAR_BYTES_TABLES = [bytes((GEAR_TABLE[byte] >> (8 * j)) & 0xff for byte in range(256)) for j in range(8)]
+
+WINDOW_SIZE = 64  # Number of bytes a gear hash depends on, older bytes are shifted out of its 64 bits
+LANE_SIZE = 9  # Bytes of a lane of the vectorized hashes: a 64 bits hash and the carries of its additions
+LANE_HASH = struct.Struct("<Q")  # Hash at the start of a lane
+
+class ContentDefinedChunker:
+    """
+    The ContentDefinedChunker class cuts files into chunks whose boundaries depend on the content (FastCDC-style gear hash).
+    An insertion in a file only changes the chunks around it, the following chunks keep the same content and hash.
+    This class does not depend on the rest of the client, so it can be used in worker processes.
+
+    The gear hash of every position is computed for a whole segment at once, on Python integers holding one lane
+    per byte of the segment, so the boundaries are found at C speed instead of a Python loop per byte.
+    It still passes over about 10 times the segment size a dozen times: a file is cut at about 10 MB/s per process,
+    twice the speed of a Python loop but far from the speed of the fixed-size blocks, which are only hashed.
+    """
+
+    SEGMENT_SIZE = 256 * 1024  # Bytes hashed at once, the integers of a segment take about 10 times its size
+
+    def __init__(self, average_size):
+        """
+        Initialize a new ContentDefinedChunker object.
+
+        Parameters:
+        average_size -- The targeted average size of the chunks in bytes.
+        """
+        self.average_size = average_size
+        self.min_size = max(average_size // 4, WINDOW_SIZE)
+        self.max_size = average_size * 4
+
+        # Normalized chunking: a harder condition before the average size and an easier one after it.
+        # Only the high bits of the hash are used because they depend on the last 64 bytes, the low bits only on the last few ones
+        bits = max(average_size.bit_length() - 1, 4)
+        self.mask_small = ((1 << (bits + 2)) - 1) << (64 - (bits + 2))
+        self.mask_large = ((1 << (bits - 2)) - 1) << (64 - (bits - 2))
+
+        # Byte -> 0 if the most significant byte of a hash satisfies the condition after the average size, else 1
+        self.top_byte_flags_table = bytes(int(bool(byte & (self.mask_large >> 56))) for byte in range(256))
+
+        self.lane_patterns = {}  # (lane value, lanes count) -> integer with this value in every lane
+
+    def get_lane_pattern(self, lane_value, lanes_count):
+        """Get an integer with the same value in each of its lanes
+
+        Parameters:
+            lane_value -- The value of every lane
+            lanes_count -- The number of lanes"""
+        key = (lane_value, lanes_count)
+
+        if key not in self.lane_patterns:
+            self.lane_patterns[key] = int.from_bytes(lane_value.to_bytes(LANE_SIZE, "little") * lanes_count, "little")
+
+        return self.lane_patterns[key]
+
+    def find_boundary_candidates(self, data, begin, end):
+        """Find the positions of a segment where the gear hash satisfies the conditions of a boundary
+
+        Parameters:
+            data -- The content to cut (bytes or bytearray)
+            begin -- The start of the segment, at least WINDOW_SIZE - 1
+            end -- The end of the segment
+
+        Returns:
+            The sorted positions satisfying the condition before the average size and the ones satisfying the condition after it
+        """
+        history_start = begin - (WINDOW_SIZE - 1)  # The hashes of the segment depend on the bytes before it
+        segment = data[history_start:end]
+        lanes_count = len(segment)
+
+        # Lane i holds the gear value of byte i, its ninth byte is left for the carries
+        lanes = bytearray(lanes_count * LANE_SIZE)
+
+        for j in range(8):
+            lanes[j::LANE_SIZE] = segment.translate(GEAR_BYTES_TABLES[j])
+
+        hashes = int.from_bytes(lanes, "little")
+
+        # hash(i) = sum of gear(i - k) << k for k < 64, modulo 2 ** 64. After the step of width m, lane i holds the sum for k < 2m.
+        # The shifted lanes are masked first, so the bits shifted past the 64 bits of a lane never reach the next lane
+        width = 1
+
+        while width < WINDOW_SIZE:
+            kept_bits_pattern = self.get_lane_pattern((1 << (64 - width)) - 1, lanes_count)
+            hashes += (hashes & kept_bits_pattern) << (width * LANE_SIZE * 8 + width)
+            width *= 2
+
+        # The last lanes were also shifted past the end of the segment
+        hashes_bytes = (hashes & ((1 << (lanes_count * LANE_SIZE * 8)) - 1)).to_bytes(lanes_count * LANE_SIZE, "little")
+
+        # The positions whose most significant byte of the hash satisfies the condition after the average size are found at C speed,
+        # the conditions on the lower bits are then checked on these few positions. The small mask contains the large mask
+        top_bytes_flags = hashes_bytes[7::LANE_SIZE].translate(self.top_byte_flags_table)
+        small_candidates = []
+        large_candidates = []
+        lane_index = top_bytes_flags.find(0, WINDOW_SIZE - 1)
+
+        while lane_index != -1:
+            (hash_value,) = LANE_HASH.unpack_from(hashes_bytes, lane_index * LANE_SIZE)
+
+            if not hash_value & self.mask_large:
+                large_candidates.append(history_start + lane_index)
+
+                if not hash_value & self.mask_small:
+                    small_candidates.append(history_start + lane_index)
+
+            lane_index = top_bytes_flags.find(0, lane_index + 1)
+
+        return small_candidates, large_candidates
+
+    def chunk_file(self, file_path):
+        """Cut a file into content-defined chunks. The file is read into a buffer holding at most a chunk and a segment,
+        it is not mapped: a file truncated by another program while it is mapped kills the process with SIGBUS
+
+        Parameters:
+            file_path -- The full path of the file
+
+        Returns:
+            A list of (starting_byte, chunk_size, chunk_hash) tuples
+        """
+        chunks = []
+
+        with open(file_path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            buffer = bytearray()
+            buffer_start = 0  # Position of the first byte of the buffer in the file
+
+            small_candidates = []
+            large_candidates = []
+            hashed_end = WINDOW_SIZE - 1  # No boundary can be before the minimum size, which is at least WINDOW_SIZE
+            starting_byte = 0
+
+            while starting_byte < file_size:
+                # Drop the bytes that are neither in the next chunk nor in the history of the next segment, then read the next chunk and its segments
+                kept_start = min(starting_byte, hashed_end - (WINDOW_SIZE - 1))
+                del buffer[:kept_start - buffer_start]
+                buffer_start = kept_start
+
+                missing_size = min(starting_byte + self.max_size + self.SEGMENT_SIZE, file_size) - (buffer_start + len(buffer))
+
+                if missing_size > 0:
+                    read_bytes = f.read(missing_size)
+                    buffer += read_bytes
+
+                    if len(read_bytes) < missing_size:  # The file was truncated while it was cut
+                        file_size = buffer_start + len(buffer)
+
+                remaining = file_size - starting_byte
+                chunk_size = remaining
+
+                if remaining > self.min_size:
+                    normal_end = starting_byte + min(self.average_size, remaining)
+                    maximum_end = starting_byte + min(self.max_size, remaining)
+
+                    while hashed_end < maximum_end:
+                        segment_end = min(hashed_end + self.SEGMENT_SIZE, file_size)
+                        segment_small_candidates, segment_large_candidates = self.find_boundary_candidates(buffer, hashed_end - buffer_start, segment_end - buffer_start)
+
+                        small_candidates += [buffer_start + position for position in segment_small_candidates]
+                        large_candidates += [buffer_start + position for position in segment_large_candidates]
+                        hashed_end = segment_end
+
+                    # A candidate at position p ends the chunk after byte p
+                    small_index = bisect.bisect_left(small_candidates, starting_byte + self.min_size)
+                    large_index = bisect.bisect_left(large_candidates, normal_end)
+
+                    if small_index < len(small_candidates) and small_candidates[small_index] < normal_end:
+                        chunk_size = small_candidates[small_index] + 1 - starting_byte
+                    elif large_index < len(large_candidates) and large_candidates[large_index] < maximum_end:
+                        chunk_size = large_candidates[large_index] + 1 - starting_byte
+                    else:
+                        chunk_size = maximum_end - starting_byte
+
+                    del small_candidates[:small_index]  # The next chunks start after them
+                    del large_candidates[:bisect.bisect_left(large_candidates, starting_byte + chunk_size)]
+
+                with memoryview(buffer) as buffer_view:  # The buffer cannot be resized while a view of it exists
+                    chunks.append((starting_byte, chunk_size, hashlib.sha256(buffer_view[starting_byte - buffer_start:starting_byte - buffer_start + chunk_size]).hexdigest()))
+
+                starting_byte += chunk_size
+
+        return chunks
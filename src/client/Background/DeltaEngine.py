@@ -0,0 +1,512 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import functools
+import bsdiff4
+
+from SnapshotStore import open_object_file
+
+# Operations of the copy-literal deltas: copy a range of the base version of the file, or write new bytes
+COPY_OPERATION = 0
+LITERAL_OPERATION = 1
+
+OPERATION_HEADER = struct.Struct("<BQ")  # operation, length
+COPY_OFFSET = struct.Struct("<Q")  # position of the copied range in the base version
+
+COPY_BUFFER_SIZE = 1024 * 1024  # Size of the reads when copying a range of the base version
+
+# Extensions of the formats that are already compressed, a change usually rewrites the whole file
+COMPRESSED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".xz", ".bz2", ".zst", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".ogg", ".flac", ".aac", ".mp4", ".mkv", ".avi", ".mov", ".webm",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".jar", ".apk"
+}
+
+def get_strong_hash(data):
+    """Get the strong hash of a block, used to confirm a match
+
+    Parameters:
+        data -- The content of the block"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def get_signature_block_size(file_size, min_block_size, max_signature_entries):
+    """Get the smallest power of two block size, at least min_block_size, cutting a file in at most max_signature_entries blocks
+
+    Parameters:
+        file_size -- The size of the file
+        min_block_size -- The minimal block size
+        max_signature_entries -- The maximal number of blocks"""
+    block_size = min_block_size
+
+    while file_size > block_size * max_signature_entries:
+        block_size *= 2
+
+    return block_size
+
+class CopyLiteralEncoder:
+    """
+    The CopyLiteralEncoder class encodes the operations of a copy-literal delta. Contiguous copies are merged
+    and the encoded operations are returned as chunks of bytes, so the delta never has to be built in memory.
+    """
+
+    def __init__(self):
+        """
+        Initialize a new CopyLiteralEncoder object.
+        """
+        self.pending_copy_offset = None
+        self.pending_copy_length = 0
+
+    def copy(self, offset, length):
+        """Add a copy of a range of the base version
+
+        Parameters:
+            offset -- The position of the range in the base version
+            length -- The length of the range
+
+        Returns:
+            The encoded operations that are complete
+        """
+        if self.pending_copy_offset is not None and self.pending_copy_offset + self.pending_copy_length == offset:
+            self.pending_copy_length += length
+            return []
+
+        encoded_operations = self.flush()
+        self.pending_copy_offset = offset
+        self.pending_copy_length = length
+
+        return encoded_operations
+
+    def literal(self, data):
+        """Add new bytes
+
+        Parameters:
+            data -- The new bytes
+
+        Returns:
+            The encoded operations
+        """
+        if not data:
+            return []
+
+        return self.flush() + [OPERATION_HEADER.pack(LITERAL_OPERATION, len(data)), bytes(data)]
+
+    def flush(self):
+        """Get the encoded pending copy, if any"""
+        if self.pending_copy_offset is None:
+            return []
+
+        encoded_copy = OPERATION_HEADER.pack(COPY_OPERATION, self.pending_copy_length) + COPY_OFFSET.pack(self.pending_copy_offset)
+        self.pending_copy_offset = None
+        self.pending_copy_length = 0
+
+        return [encoded_copy]
+
+def read_exactly(file, size):
+    """Read an exact number of bytes from a file
+
+    Parameters:
+        file -- The file opened in binary mode
+        size -- The number of bytes to read
+
+    Returns:
+        The bytes read, or b"" if the file was at its end
+    """
+    read_bytes = file.read(size)
+
+    if read_bytes and len(read_bytes) < size:
+        raise ValueError("The delta is truncated")
+
+    return read_bytes
+
+def apply_copy_literal_delta(base_file, delta_file, destination_file):
+    """Write a file from its base version and a copy-literal delta. The delta is read operation by operation and
+    the ranges by bounded reads, so the memory does not depend on the size of the delta
+
+    Parameters:
+        base_file -- The base version, opened in binary mode
+        delta_file -- The delta, opened for reading in binary mode
+        destination_file -- The file to write, opened in binary mode"""
+    while header := read_exactly(delta_file, OPERATION_HEADER.size):
+        operation, length = OPERATION_HEADER.unpack(header)
+
+        if operation == COPY_OPERATION:
+            offset_bytes = read_exactly(delta_file, COPY_OFFSET.size)
+
+            if not offset_bytes:
+                raise ValueError("The delta is truncated")
+
+            offset, = COPY_OFFSET.unpack(offset_bytes)
+            source_file = base_file
+            source_file.seek(offset)
+
+        elif operation == LITERAL_OPERATION:
+            source_file = delta_file
+
+        else:
+            raise ValueError(f"Unknown delta operation {operation}")
+
+        remaining_length = length
+
+        while remaining_length > 0:
+            read_bytes = source_file.read(min(COPY_BUFFER_SIZE, remaining_length))
+
+            if not read_bytes:
+                raise ValueError("The delta copies a range after the end of the base version" if source_file is base_file else "The delta is truncated")
+
+            destination_file.write(read_bytes)
+            remaining_length -= len(read_bytes)
+
+class BsdiffEngine:
+    """
+    The BsdiffEngine class computes the smallest deltas, but bsdiff loads both versions and builds a suffix array of
+    the base version, about 17 times the size of the base version in memory, and its time is super-linear.
+    It is only used when this fits the memory ceiling, which limits it to files of about 8 MiB.
+    """
+
+    NAME = "bsdiff"
+    MAX_MEMORY_IN_BYTES = 160 * 1024 * 1024
+    MEMORY_PER_BASE_BYTE = 17  # The base version and its suffix array of two 64 bits integers per byte
+
+    def get_memory_needed(self, base_size, current_size):
+        """Get the peak memory of a diff, in bytes
+
+        Parameters:
+            base_size -- The size of the base version
+            current_size -- The size of the current version"""
+        return self.MEMORY_PER_BASE_BYTE * base_size + 2 * current_size  # The current version and the patch
+
+    def can_handle(self, file_name, file_size):
+        """Check if the engine can be used for a file, assuming its base version has about the same size
+
+        Parameters:
+            file_name -- The name of the file
+            file_size -- The size of the current version of the file"""
+        return self.get_memory_needed(file_size, file_size) <= self.MAX_MEMORY_IN_BYTES and os.path.splitext(file_name)[1].lower() not in COMPRESSED_EXTENSIONS
+
+    def diff(self, open_base, current_path):
+        """Compute the delta between the base version and the current version of a file
+
+        Parameters:
+            open_base -- Function opening the base version for reading
+            current_path -- The full path of the current version
+
+        Returns:
+            The delta as a list of chunks of bytes, or None if the base version is too large for the memory ceiling
+        """
+        current_size = os.path.getsize(current_path)
+        max_base_size = (self.MAX_MEMORY_IN_BYTES - 2 * current_size) // self.MEMORY_PER_BASE_BYTE
+
+        if max_base_size < 0:
+            return None
+
+        with open_base() as base_file:
+            base_content_bytes = base_file.read(max_base_size + 1)
+
+        if len(base_content_bytes) > max_base_size:
+            return None
+
+        with open(current_path, "rb") as current_file:
+            current_content_bytes = current_file.read()
+
+        return [bsdiff4.diff(base_content_bytes, current_content_bytes)]
+
+    def apply(self, base_file, delta_file, destination_file):
+        """Write a file from its base version and a delta
+
+        Parameters:
+            base_file -- The base version, opened in binary mode
+            delta_file -- The delta, opened for reading in binary mode
+            destination_file -- The file to write, opened in binary mode"""
+        # bsdiff works on whole contents, the files and their deltas were small enough for the memory ceiling of the diff
+        destination_file.write(bsdiff4.patch(base_file.read(), delta_file.read()))
+
+class RollingChecksumEngine:
+    """
+    The RollingChecksumEngine class computes rsync-style deltas. The base version is cut in blocks indexed by their
+    Adler-32 and strong hash, then a window rolls over the current version to find the blocks wherever they moved.
+    The memory is bounded by the memory ceiling: the number of blocks of the signature is limited to what fits in it
+    next to two copies of a literal run, the current version is mapped and not loaded.
+    The rolling is done in Python at a few MB/s, so the engine is only used for files of at most MAX_FILE_SIZE.
+    """
+
+    NAME = "rolling"
+    MAX_FILE_SIZE = 32 * 1024 * 1024
+    MIN_BLOCK_SIZE = 2048
+    LITERAL_RUN_SIZE = 1024 * 1024  # Maximum size of a literal operation
+    MAX_MEMORY_IN_BYTES = 66 * 1024 * 1024
+    SIGNATURE_ENTRY_SIZE_IN_BYTES = 256  # A weak hash, its dictionary of strong hashes and an offset
+    MAX_SIGNATURE_ENTRIES = (MAX_MEMORY_IN_BYTES - 2 * LITERAL_RUN_SIZE) // SIGNATURE_ENTRY_SIZE_IN_BYTES
+
+    ADLER_MODULO = 65521
+
+    def can_handle(self, file_name, file_size):
+        """Check if the engine can be used for a file
+
+        Parameters:
+            file_name -- The name of the file
+            file_size -- The size of the current version of the file"""
+        return file_size <= self.MAX_FILE_SIZE and os.path.splitext(file_name)[1].lower() not in COMPRESSED_EXTENSIONS
+
+    def build_signature(self, open_base, block_size):
+        """Index the blocks of the base version by their weak and strong hashes
+
+        Parameters:
+            open_base -- Function opening the base version for reading
+            block_size -- The size of the blocks
+
+        Returns:
+            A dictionary weak hash -> {strong hash: offset}, or None if it would have too many entries
+        """
+        signature = {}
+        entries_count = 0
+        offset = 0
+
+        with open_base() as base_file:
+            while block := base_file.read(block_size):
+                if len(block) == block_size:  # The last partial block cannot be found by a window of block_size bytes
+                    signature.setdefault(zlib.adler32(block), {}).setdefault(get_strong_hash(block), offset)
+                    entries_count += 1
+
+                    if entries_count > self.MAX_SIGNATURE_ENTRIES:
+                        return None
+
+                offset += len(block)
+
+        return signature
+
+    def diff(self, open_base, current_path):
+        """Compute the delta between the base version and the current version of a file
+
+        Parameters:
+            open_base -- Function opening the base version for reading
+            current_path -- The full path of the current version
+
+        Returns:
+            A generator of the chunks of bytes of the delta
+        """
+        block_size = get_signature_block_size(os.path.getsize(current_path), self.MIN_BLOCK_SIZE, self.MAX_SIGNATURE_ENTRIES)
+
+        # The base version can be larger than the current one, the blocks are enlarged until the signature fits the memory ceiling
+        while (signature := self.build_signature(open_base, block_size)) is None:
+            block_size *= 2
+
+        return self.generate_delta(signature, block_size, current_path)
+
+    def generate_delta(self, signature, block_size, current_path):
+        """Roll a window over the current version and generate the operations of the delta
+
+        Parameters:
+            signature -- The signature of the base version
+            block_size -- The size of the blocks of the signature
+            current_path -- The full path of the current version"""
+        encoder = CopyLiteralEncoder()
+        file_size = os.path.getsize(current_path)
+
+        if file_size == 0:
+            return
+
+        adler_modulo = self.ADLER_MODULO
+
+        with open(current_path, "rb") as current_file, mmap.mmap(current_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            literal_start = 0
+            weak_hash = None
+
+            while position + block_size <= file_size:
+                if weak_hash is None:
+                    weak_hash = zlib.adler32(data[position:position + block_size])
+
+                candidates = signature.get(weak_hash)
+
+                if candidates is not None:
+                    base_offset = candidates.get(get_strong_hash(data[position:position + block_size]))
+
+                    if base_offset is not None:
+                        yield from encoder.literal(data[literal_start:position])
+                        yield from encoder.copy(base_offset, block_size)
+
+                        position += block_size
+                        literal_start = position
+                        weak_hash = None
+                        continue
+
+                if position + block_size < file_size:  # Roll the window by one byte
+                    outgoing_byte = data[position]
+                    incoming_byte = data[position + block_size]
+
+                    sum_a = ((weak_hash & 0xffff) - outgoing_byte + incoming_byte) % adler_modulo
+                    sum_b = ((weak_hash >> 16) - block_size * outgoing_byte + sum_a - 1) % adler_modulo
+                    weak_hash = (sum_b << 16) | sum_a
+
+                position += 1
+
+                if position - literal_start >= self.LITERAL_RUN_SIZE:
+                    yield from encoder.literal(data[literal_start:position])
+                    literal_start = position
+
+            for run_start in range(literal_start, file_size, self.LITERAL_RUN_SIZE):
+                yield from encoder.literal(data[run_start:min(run_start + self.LITERAL_RUN_SIZE, file_size)])
+
+        yield from encoder.flush()
+
+    def apply(self, base_file, delta_file, destination_file):
+        """Write a file from its base version and a delta
+
+        Parameters:
+            base_file -- The base version, opened in binary mode
+            delta_file -- The delta, opened for reading in binary mode
+            destination_file -- The file to write, opened in binary mode"""
+        apply_copy_literal_delta(base_file, delta_file, destination_file)
+
+class BlockHashEngine:
+    """
+    The BlockHashEngine class computes deltas of fixed blocks, like the block-level synchronization. The blocks of the
+    current version are looked up by hash among the blocks of the base version, so a block is only sent if its
+    content is nowhere in the base version. It reads the files once at hashing speed and works for any size:
+    the blocks are enlarged until the signature fits the memory ceiling, next to a block or two being read.
+    """
+
+    NAME = "block"
+    MIN_BLOCK_SIZE = 64 * 1024
+    MAX_MEMORY_IN_BYTES = 32 * 1024 * 1024
+    SIGNATURE_ENTRY_SIZE_IN_BYTES = 128  # A strong hash and an offset in a dictionary
+    MAX_SIGNATURE_ENTRIES = MAX_MEMORY_IN_BYTES // SIGNATURE_ENTRY_SIZE_IN_BYTES
+
+    def can_handle(self, file_name, file_size):
+        """Check if the engine can be used for a file
+
+        Parameters:
+            file_name -- The name of the file
+            file_size -- The size of the current version of the file"""
+        return True
+
+    def build_signature(self, open_base, block_size):
+        """Index the blocks of the base version by their strong hash
+
+        Parameters:
+            open_base -- Function opening the base version for reading
+            block_size -- The size of the blocks
+
+        Returns:
+            A dictionary strong hash -> offset, or None if it would have too many entries
+        """
+        signature = {}
+        offset = 0
+
+        with open_base() as base_file:
+            while block := base_file.read(block_size):
+                signature.setdefault(get_strong_hash(block), offset)
+                offset += len(block)
+
+                if len(signature) > self.MAX_SIGNATURE_ENTRIES:
+                    return None
+
+        return signature
+
+    def diff(self, open_base, current_path):
+        """Compute the delta between the base version and the current version of a file
+
+        Parameters:
+            open_base -- Function opening the base version for reading
+            current_path -- The full path of the current version
+
+        Returns:
+            A generator of the chunks of bytes of the delta
+        """
+        block_size = get_signature_block_size(os.path.getsize(current_path), self.MIN_BLOCK_SIZE, self.MAX_SIGNATURE_ENTRIES)
+
+        while (signature := self.build_signature(open_base, block_size)) is None:
+            block_size *= 2
+
+        return self.generate_delta(signature, block_size, current_path)
+
+    def generate_delta(self, signature, block_size, current_path):
+        """Look up the blocks of the current version and generate the operations of the delta
+
+        Parameters:
+            signature -- The signature of the base version
+            block_size -- The size of the blocks of the signature
+            current_path -- The full path of the current version"""
+        encoder = CopyLiteralEncoder()
+
+        with open(current_path, "rb") as current_file:
+            while block := current_file.read(block_size):
+                base_offset = signature.get(get_strong_hash(block))
+
+                if base_offset is not None:
+                    yield from encoder.copy(base_offset, len(block))
+                else:
+                    yield from encoder.literal(block)
+
+        yield from encoder.flush()
+
+    def apply(self, base_file, delta_file, destination_file):
+        """Write a file from its base version and a delta
+
+        Parameters:
+            base_file -- The base version, opened in binary mode
+            delta_file -- The delta, opened for reading in binary mode
+            destination_file -- The file to write, opened in binary mode"""
+        apply_copy_literal_delta(base_file, delta_file, destination_file)
+
+DELTA_ENGINES = [BsdiffEngine(), RollingChecksumEngine(), BlockHashEngine()]  # By order of preference
+DELTA_ENGINES_BY_NAME = {engine.NAME: engine for engine in DELTA_ENGINES}
+MAX_DELTA_MEMORY_IN_BYTES = max(engine.MAX_MEMORY_IN_BYTES for engine in DELTA_ENGINES)  # Peak memory of a delta computation
+
+def get_delta_engine(name):
+    """Get a delta engine by its name. Patches of older clients have no engine name and are bsdiff patches
+
+    Parameters:
+        name -- The name of the engine, or None"""
+    return DELTA_ENGINES_BY_NAME[name or BsdiffEngine.NAME]
+
+def compute_delta(open_base, current_path):
+    """Compute the delta of a file with the first engine that can handle it within its memory ceiling
+
+    Parameters:
+        open_base -- Function opening the base version for reading
+        current_path -- The full path of the current version
+
+    Returns:
+        The name of the engine and the iterable of the chunks of bytes of the delta
+    """
+    file_size = os.path.getsize(current_path)
+
+    for engine in DELTA_ENGINES:
+        if not engine.can_handle(os.path.basename(current_path), file_size):
+            continue
+
+        delta_chunks = engine.diff(open_base, current_path)
+
+        if delta_chunks is not None:
+            return engine.NAME, delta_chunks
+
+    raise ValueError(f"No delta engine can handle {current_path}")
+
+def write_delta_to_file(base_object_path, current_path, delta_path):
+    """Compute the delta of a file and write it to a file. Run by the worker processes computing the deltas in parallel
+
+    Parameters:
+        base_object_path -- The path of the object of the base version in the snapshot store
+        current_path -- The full path of the current version
+        delta_path -- The path of the file to which the delta is written
+
+    Returns:
+        The name of the engine that computed the delta
+    """
+    engine_name, delta_chunks = compute_delta(functools.partial(open_object_file, base_object_path), current_path)
+
+    with open(delta_path, "wb") as delta_file:
+        for chunk in delta_chunks:
+            delta_file.write(chunk)
+
+    return engine_name
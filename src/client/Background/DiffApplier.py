@@ -7,13 +7,18 @@
 import libtorrent as lt
 import time
 import os
+import errno
 import shutil
 import json
-import bsdiff4
 import codecs
+import itertools
 from pathlib import Path
 
 from Parameters import Parameters
+from Background.Payload import PayloadReader
+from Background.DeltaEngine import get_delta_engine
+from Background.LocalContentIndex import LocalContentIndex
+from FileIndex import TEMPORARY_FILE_SUFFIX
 
 from File import File
 from Block import Block
@@ -30,6 +35,8 @@ from Logs import Logs
 class DiffApplier:
     _instance = None
 
+    COPY_BUFFER_SIZE = 1024 * 1024  # Size of the reads when copying a range of the current version of a file
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(DiffApplier, cls).__new__(cls)
@@ -52,20 +59,77 @@ class DiffApplier:
 
             print("CLIENT DIFFAPPLIER INITIALIZED")
 
-    def apply_downloaded_torrent(self, file_path):
+    def apply_downloaded_torrent(self, file_path, wait_for_range=None):
         """Apply the changes in the downloaded torrent
         
         Parameters:
-            file_path -- Path to the downloaded torrent"""
+            file_path -- Path to the downloaded torrent
+            wait_for_range -- Function waiting for a part of the payload to be downloaded, if it is still downloading"""
         self.main_gui.ui.label_sync_state.setText("Applying modifications...")  # Update GUI label
 
         Logs().write_new_log(logging.INFO, "APPLYING DOWNLOADED TORRENT")
 
-        with open(file_path, 'rb') as f:
-            torrent_content_dict = json.load(f)  # Load torrent content
+        # No change is published until the payload is applied and the snapshot updated,
+        # otherwise the files being applied would be sent back to the other clients
+        change_coalescer = self.patch_process.change_coalescer
+        change_coalescer.pause()
+        applied_paths = set()
+
+        try:
+            with self.patch_process.send_changes_lock:
+                with PayloadReader(file_path, wait_for_range) as payload_reader:  # The contents are read from the payload only when they are written
+                    self.payload_reader = payload_reader
+                    applied_paths = self.get_applied_paths(payload_reader.manifest)
+
+                    # The contents this client already has are copied aside before any file is changed
+                    self.local_content_index = LocalContentIndex(self.parameters.current_client.user_directory, self.parameters.get_snapshot_store(), self.parameters.get_file_index().entries)
+                    payload_reader.stage_local_contents(self.local_content_index.copy_content, self.parameters.get_cache_directory() / "staged-contents")
+
+                    self.apply_payload(payload_reader.manifest)
+
+                self.parameters.files_hashes_list_previous = self.parameters.take_snapshot_of_files()  # Update file hashes list
+
+        finally:
+            change_coalescer.resume(applied_paths)  # The changes reported for the applied paths were made by this client
+
+        self.main_gui.ui.label_sync_state.setText("Synchronized")  # Update GUI label
+
+    def get_applied_paths(self, torrent_content_dict):
+        """Get the relative paths written when applying a payload, as reported by the change watcher
+        
+        Parameters:
+            torrent_content_dict -- The torrent content dictionary"""
+        changes = torrent_content_dict['changes']
+        applied_paths = set(changes['deleted'])
+
+        for move in changes.get('moved', []):
+            applied_paths.update((move['source'], move['destination']))
+
+        for entry in changes['added'] + changes['modified'] + changes.get('rebuilt', []):
+            applied_paths.add(entry['file_rel_path'])
+
+        return {os.path.normpath(applied_path) for applied_path in applied_paths}
+
+    def get_temporary_path(self, file_full_path):
+        """Get the path of the temporary file in which a file is written before replacing it
+        
+        Parameters:
+            file_full_path -- Full path of the file"""
+        file_full_path = Path(file_full_path)
+
+        return file_full_path.with_name(file_full_path.name + TEMPORARY_FILE_SUFFIX)
 
+    def apply_payload(self, torrent_content_dict):
+        """Apply the changes described by the manifest of the payload
+        
+        Parameters:
+            torrent_content_dict -- The torrent content dictionary"""
         user_directory = self.parameters.current_client.user_directory  # Get user directory
-        torrent_directory = self.parameters.current_client.torrent_directory  # Get torrent directory
+
+        # The moved paths are taken out of the user directory first, the deleted paths can be parents of their sources
+        # or occupy the parents of their destinations. They are put in place once the deletions are done
+        moves = torrent_content_dict['changes'].get('moved', [])
+        staged_moves = self.stage_moves(moves, user_directory)
 
         for item in torrent_content_dict['changes']['deleted']:
 
@@ -81,6 +145,8 @@ class DiffApplier:
 
             Logs().write_new_log(logging.INFO, "DELETED FILES")
 
+        self.place_moves(staged_moves, user_directory)
+
         for file_dict in torrent_content_dict['changes']['added']:
             
             file = File.to_object(file_dict)
@@ -91,9 +157,12 @@ class DiffApplier:
             if file.is_dir:
                 os.makedirs(file_full_path, exist_ok=True)  # Create directory
             else:
-                with open(file_full_path, 'wb') as patched_file:
-                    file_content_bytes = codecs.escape_decode(file.content_bytes[2:-1])[0]  # Decode content
-                    patched_file.write(file_content_bytes)  # Write content to file
+                temporary_file_path = self.get_temporary_path(file_full_path)
+
+                with open(temporary_file_path, 'wb') as added_file:
+                    self.payload_reader.copy_content_to_file(file.content_bytes, added_file)  # Copy content from the payload
+
+                os.replace(temporary_file_path, file_full_path)  # Replace the file only once it is complete
 
         Logs().write_new_log(logging.INFO, "ADDED FILES")
 
@@ -103,11 +172,86 @@ class DiffApplier:
         elif torrent_content_dict['changes_type'] == "block":
             self.apply_blocks(torrent_content_dict, user_directory)  # Apply blocks
 
-        os.remove(f"{torrent_directory}/foxync-torrent.json")  # Remove torrent JSON file
+    def move_path(self, source_full_path, destination_full_path):
+        """Rename a file or a directory, copying it if the destination is on another file system
+        
+        Parameters:
+            source_full_path -- Full path of the file or directory
+            destination_full_path -- Full path of its new location, which must not exist"""
+        try:
+            os.replace(source_full_path, destination_full_path)
 
-        self.parameters.files_hashes_list_previous = self.parameters.get_list_of_files()  # Update file hashes list
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
 
-        self.main_gui.ui.label_sync_state.setText("Synchronized")  # Update GUI label
+            shutil.move(source_full_path, destination_full_path)
+
+    def stage_moves(self, moves, user_directory):
+        """Take the sources of the moved files and directories out of the user directory, into the cache directory.
+        Moves swapping or chaining paths then cannot overwrite each other, and the deletions cannot remove them
+        
+        Parameters:
+            moves -- The moves of the manifest, {'source', 'destination', 'is_dir', 'hash'}
+            user_directory -- The user directory
+
+        Returns:
+            The list of tuples (full path of the staged source or None if it is missing, move)
+        """
+        if not moves:
+            return []
+
+        staging_directory = self.parameters.get_cache_directory() / "moving"
+
+        if staging_directory.exists():  # Left by an interrupted application
+            shutil.rmtree(staging_directory)
+
+        staging_directory.mkdir()
+
+        staged_moves = []
+
+        for index, move in enumerate(moves):
+            source_full_path = f"{user_directory}/{move['source']}"
+            staged_full_path = staging_directory / str(index)
+
+            if os.path.lexists(source_full_path):
+                self.move_path(source_full_path, staged_full_path)
+                staged_moves.append((staged_full_path, move))
+            else:
+                staged_moves.append((None, move))
+
+        return staged_moves
+
+    def place_moves(self, staged_moves, user_directory):
+        """Put the staged sources of the moved files and directories at their destinations
+        
+        Parameters:
+            staged_moves -- The list of tuples (full path of the staged source or None if it is missing, move)
+            user_directory -- The user directory"""
+        if not staged_moves:
+            return
+
+        # Shallowest destinations first, so a moved directory is in place before the moves into it
+        for staged_full_path, move in sorted(staged_moves, key=lambda staged_move: staged_move[1]['destination'].count(os.sep)):
+            self.main_gui.ui.label_sync_state.setText(f"Moving {move['source']}")  # Update GUI label
+            destination_full_path = f"{user_directory}/{move['destination']}"
+            os.makedirs(os.path.dirname(destination_full_path), exist_ok=True)
+
+            if staged_full_path is not None:
+                self.move_path(staged_full_path, destination_full_path)
+
+            elif move['is_dir']:  # The source is missing here, only the directory can be created
+                os.makedirs(destination_full_path, exist_ok=True)
+                Logs().write_new_log(logging.ERROR, f"SOURCE OF MOVED DIRECTORY {move['source']} NOT FOUND")
+
+            else:  # The source is missing here, its content is taken from the local data with the same hash
+                temporary_file_path = self.get_temporary_path(destination_full_path)
+                self.local_content_index.copy_content(move['hash'], None, temporary_file_path)
+                os.replace(temporary_file_path, destination_full_path)
+
+        shutil.rmtree(self.parameters.get_cache_directory() / "moving", ignore_errors=True)
+
+        Logs().write_new_log(logging.INFO, "MOVED FILES")
 
     def apply_patches(self, torrent_content_dict, user_directory):
         """Apply the patches in the downloaded torrent
@@ -124,15 +268,15 @@ class DiffApplier:
             file_full_path = f"{user_directory}/{patch.file_rel_path}"  # Get full path of the patch
             
             if os.path.isfile(file_full_path):
-                patch_data = codecs.escape_decode(patch.patch[2:-1])[0]  # Decode patch
+                delta_engine = get_delta_engine(patch.delta_engine)  # Engine that computed the patch
 
-                with open(file_full_path, 'rb') as original_file:
-                    file_content_bytes = original_file.read()  # Read original file content
+                temporary_file_path = self.get_temporary_path(file_full_path)
 
-                patched_content = bsdiff4.patch(file_content_bytes, patch_data)  # Apply patch
+                # The patch is read from the payload by chunks while it is applied
+                with open(file_full_path, 'rb') as original_file, self.payload_reader.open_content(patch.patch) as patch_file, open(temporary_file_path, 'wb') as patched_file:
+                    delta_engine.apply(original_file, patch_file, patched_file)  # Write patched content to file
 
-                with open(file_full_path, 'wb') as patched_file:
-                    patched_file.write(patched_content)  # Write patched content to file
+                os.replace(temporary_file_path, file_full_path)  # Replace the file only once it is complete
 
         Logs().write_new_log(logging.INFO, "APPLIED PATCHES")
 
@@ -142,28 +286,76 @@ class DiffApplier:
         Parameters:
             torrent_content_dict -- The torrent content dictionary
             user_directory -- The user directory"""
-            
-        for block_dict in torrent_content_dict['changes']['modified']:
 
-            block = Block.to_object(block_dict)
 
-            self.main_gui.ui.label_sync_state.setText(f"Editing {block.file_rel_path}")  # Update GUI label
-            file_full_path = Path(f"{user_directory}/{block.file_rel_path}")  # Get full path of the file containing the block
+        # The blocks of a file follow each other in the manifest, they are applied to a copy of the file that replaces it at the end
+        blocks = (Block.to_object(block_dict) for block_dict in torrent_content_dict['changes']['modified'])
+
+        for file_rel_path, file_blocks in itertools.groupby(blocks, key=lambda block: block.file_rel_path):
+
+            self.main_gui.ui.label_sync_state.setText(f"Editing {file_rel_path}")  # Update GUI label
+            file_full_path = Path(f"{user_directory}/{file_rel_path}")  # Get full path of the file containing the blocks
 
             if os.path.isfile(file_full_path):
-                block_content = codecs.escape_decode(block.content_bytes[2:-1])[0]  # Decode block content
+                self.apply_blocks_to_file(file_full_path, file_blocks)
+
+        for recipe in torrent_content_dict['changes'].get('rebuilt', []):
+            self.rebuild_file(recipe, user_directory)
+
+        self.patch_process.backup_files_can_be_applied = True  # Allow backup files to be applied
+
+        Logs().write_new_log(logging.INFO, "APPLIED BLOCKS")
+
+    def apply_blocks_to_file(self, file_full_path, file_blocks):
+        """Write the blocks of a file to a temporary copy of it, then replace the file
+        
+        Parameters:
+            file_full_path -- Full path of the file containing the blocks
+            file_blocks -- The blocks of the file, in the order of the manifest"""
+        temporary_file_path = self.get_temporary_path(file_full_path)
+        shutil.copyfile(file_full_path, temporary_file_path)
 
-                with open(file_full_path, 'r+b') as file:
-                    file.seek(block.starting_byte)  # Set cursor to the starting byte of the block
-                    file.write(block_content)  # Write block content
+        with open(temporary_file_path, 'r+b') as file:
+            for block in file_blocks:
+                file.seek(block.starting_byte)  # Set cursor to the starting byte of the block
+                self.payload_reader.copy_content_to_file(block.content_bytes, file)  # Copy block content from the payload
 
                 last_starting_byte = block.starting_byte + block.block_size # Calculate last starting byte
 
-                if last_starting_byte < file_full_path.stat().st_size: #Delete everything after the last starting byte
-                    with open(file_full_path, 'r+b') as file:
-                        file.seek(last_starting_byte)  # Set cursor to last starting byte
-                        file.truncate()  # Truncate file
+                if last_starting_byte < os.fstat(file.fileno()).st_size: #Delete everything after the last starting byte
+                    file.truncate(last_starting_byte)  # Truncate file
 
-        self.patch_process.backup_files_can_be_applied = True  # Allow backup files to be applied
+        os.replace(temporary_file_path, file_full_path)  # Replace the file only once every block is written
+
+    def rebuild_file(self, recipe, user_directory):
+        """Rebuild a file from the chunks sent and the ranges of the current version of the file
+        
+        Parameters:
+            recipe -- The file relative path and its list of chunks, copied from the payload or from an offset of the current version
+            user_directory -- The user directory"""
+
+        self.main_gui.ui.label_sync_state.setText(f"Editing {recipe['file_rel_path']}")  # Update GUI label
+        file_full_path = Path(f"{user_directory}/{recipe['file_rel_path']}")  # Get full path of the file
+
+        if not os.path.isfile(file_full_path):
+            return
+
+        rebuilt_file_path = self.get_temporary_path(file_full_path)
+
+        with open(file_full_path, 'rb') as original_file, open(rebuilt_file_path, 'wb') as rebuilt_file:
+            for block_dict in recipe['chunks']:
+                block = Block.to_object(block_dict)
+
+                if block.source_starting_byte is not None:  # The range is already in the current version of the file, copied by parts
+                    original_file.seek(block.source_starting_byte)
+                    remaining_size = block.block_size
+
+                    while remaining_size > 0 and (read_bytes := original_file.read(min(self.COPY_BUFFER_SIZE, remaining_size))):
+                        rebuilt_file.write(read_bytes)
+                        remaining_size -= len(read_bytes)
+                else:
+                    self.payload_reader.copy_content_to_file(block.content_bytes, rebuilt_file)  # Copy chunk content from the payload
+
+        os.replace(rebuilt_file_path, file_full_path)  # Replace the file only once it is complete
 
-        Logs().write_new_log(logging.INFO, "APPLIED BLOCKS")
\ No newline at end of file
+        Logs().write_new_log(logging.INFO, "REBUILT FILE FROM CHUNKS")
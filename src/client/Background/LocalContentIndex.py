@@ -0,0 +1,125 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import os
+import hashlib
+from pathlib import Path
+
+import sys
+parent_directory = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(parent_directory))
+
+from SnapshotStore import open_object_file
+
+import logging
+from Logs import Logs
+
+class LocalContentIndex:
+    """
+    The LocalContentIndex class finds the contents a payload references by SHA-256 among the data the client already has:
+    the objects of the snapshot store, the location hinted by the sending client, and the files of the file index
+    with the same hash. Every copy is hashed, so a location whose content changed since it was indexed is skipped.
+    """
+
+    COPY_BUFFER_SIZE = 1024 * 1024  # Size of the reads when copying a local content
+
+    def __init__(self, user_directory, snapshot_store, file_index_entries):
+        """
+        Initialize a new LocalContentIndex object.
+
+        Parameters:
+        user_directory -- The user directory.
+        snapshot_store -- The snapshot store of the last synchronized state.
+        file_index_entries -- The entries of the file index, relative path -> {'is_dir', 'size', 'mtime_ns', 'inode', 'hash'}.
+        """
+        self.user_directory = Path(user_directory)
+        self.snapshot_store = snapshot_store
+
+        self.files_by_hash = {}  # SHA-256 -> relative paths of the files with this content
+
+        for file_rel_path, entry in file_index_entries.items():
+            if not entry['is_dir'] and entry['hash']:
+                self.files_by_hash.setdefault(entry['hash'], []).append(file_rel_path)
+
+    def get_locations(self, content_hash, location_hint):
+        """Get the locations that may contain a content, by order of reliability
+
+        Parameters:
+            content_hash -- The SHA-256 of the content
+            location_hint -- {'file_rel_path', 'starting_byte', 'length'} of a file of this client containing the content, according to the sending client
+
+        Returns:
+            A list of tuples (function opening the location, starting byte, length or None)
+        """
+        locations = []
+        object_path = self.snapshot_store.get_object_path(content_hash)
+
+        if object_path is not None:  # The objects of the snapshot store never change
+            locations.append((lambda: open_object_file(object_path), 0, None))
+
+        if location_hint is not None:
+            hinted_path = self.user_directory / location_hint['file_rel_path']
+            locations.append((lambda: open(hinted_path, "rb"), location_hint.get('starting_byte', 0), location_hint.get('length')))
+
+        for file_rel_path in self.files_by_hash.get(content_hash, []):
+            file_path = self.user_directory / file_rel_path
+            locations.append((lambda file_path=file_path: open(file_path, "rb"), 0, None))
+
+        return locations
+
+    def copy_content(self, content_hash, location_hint, destination_path):
+        """Copy a local content to a file, from the first location where its SHA-256 matches
+
+        Parameters:
+            content_hash -- The SHA-256 of the content
+            location_hint -- {'file_rel_path', 'starting_byte', 'length'} of a file of this client containing the content, or None
+            destination_path -- The path of the file to write"""
+        for open_location, starting_byte, length in self.get_locations(content_hash, location_hint):
+            try:
+                if self.copy_and_hash(open_location, starting_byte, length, destination_path) == content_hash:
+                    return
+
+            except OSError:  # The location was removed
+                continue
+
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
+
+        Logs().write_new_log(logging.ERROR, f"LOCAL CONTENT {content_hash} NOT FOUND")
+
+        raise FileNotFoundError(f"Content {content_hash} was not found locally")
+
+    def copy_and_hash(self, open_location, starting_byte, length, destination_path):
+        """Copy a part of a location to a file, by chunks
+
+        Parameters:
+            open_location -- Function opening the location for reading
+            starting_byte -- The position of the content in the location
+            length -- The length of the content, or None to copy until the end of the location
+            destination_path -- The path of the file to write
+
+        Returns:
+            The SHA-256 of the copied content
+        """
+        content_hash = hashlib.sha256()
+        copied_length = 0
+
+        with open_location() as source_file, open(destination_path, "wb") as destination_file:
+            if starting_byte:  # Only the files of the user directory are read from an offset
+                source_file.seek(starting_byte)
+
+            while length is None or copied_length < length:
+                read_size = self.COPY_BUFFER_SIZE if length is None else min(self.COPY_BUFFER_SIZE, length - copied_length)
+                read_bytes = source_file.read(read_size)
+
+                if not read_bytes:
+                    break
+
+                content_hash.update(read_bytes)
+                destination_file.write(read_bytes)
+                copied_length += len(read_bytes)
+
+        return content_hash.hexdigest()
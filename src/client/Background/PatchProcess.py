@@ -6,14 +6,19 @@
 
 import time
 import os
+import threading
 import socket
 import hashlib
 import json
-import bsdiff4
 import glob
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from Parameters import Parameters
 from Patch import Patch
+from Background.ChangeCoalescer import ChangeCoalescer
+from Background.DeltaEngine import write_delta_to_file, MAX_DELTA_MEMORY_IN_BYTES
+from FileIndex import TEMPORARY_FILE_SUFFIX
 
 import sys
 from pathlib import Path
@@ -23,6 +28,8 @@ sys.path.append(str(parent_directory))
 import logging
 from Logs import Logs
 
+DELTA_MEMORY_BUDGET_IN_BYTES = 640 * 1024 * 1024  # Memory the worker processes computing the deltas can use together
+
 class PatchProcess:
     _instance = None
 
@@ -44,40 +51,76 @@ class PatchProcess:
             self.main_gui = Main()
 
             # Initialize previous file hashes list
-            self.parameters.files_hashes_list_previous = self.parameters.get_list_of_files()
+            self.parameters.files_hashes_list_previous = self.parameters.take_snapshot_of_files()
 
             self.backup_files_can_be_applied = False
 
+            self.send_changes_lock = threading.Lock()  # The scheduler and the change watcher can both look for changes
+
+            # The changes reported by the scheduler and the change watcher are merged before being published
+            self.change_coalescer = ChangeCoalescer(self.send_changes_if_any, self.parameters.current_client.quiet_window_in_seconds, self.parameters.current_client.max_batch_size)
+
+            # The deltas of the modified files are computed in parallel by worker processes, created on first use
+            self.delta_executor = None
+
             Logs().write_new_log(logging.INFO, "INITIALIZED CLIENT PATCHPROCESS")
 
             print("CLIENT PATCHPROCESS INITIALIZED")
 
-    def send_changes_if_any(self):
-        """Look for modifications inside the user directory. If any, generate the torrent and send it to the server"""
-        
-        changes = self.determine_changes()  # Get the changes in the user directory
+    def get_delta_executor(self):
+        """Get the pool of worker processes computing the deltas. The workers are spawned, not forked, so they do not inherit the threads of the GUI.
+        Each worker can reach the memory ceiling of the delta engines, so there are only as many workers as fit in the memory budget"""
+        if self.delta_executor is None:
+            max_workers = max(1, min(os.cpu_count() or 1, DELTA_MEMORY_BUDGET_IN_BYTES // MAX_DELTA_MEMORY_IN_BYTES))
+            self.delta_executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
 
-        has_changes = any(changes[key] for key in changes)
+        return self.delta_executor
 
-        if has_changes:
-            Logs().write_new_log(logging.INFO, "CHANGES IN SYNCHRONIZED FILES DETECTED")
-            self.torrent_handler.generate_data_to_send_and_torrent(changes, "patch")  # Generate the torrent and send it to the server
-            self.parameters.files_hashes_list_previous = self.parameters.get_list_of_files()
-        else:
-            self.main_gui.ui.label_sync_state.setText("Synchronized")
+    def shutdown_delta_executor(self):
+        """Stop the worker processes computing the deltas"""
+        if self.delta_executor is not None:
+            self.delta_executor.shutdown(wait=False, cancel_futures=True)
+            self.delta_executor = None
 
-    def determine_changes(self):
-        """Determine the changes and patches inside the user directory, and save them to a dictionary"""
+    def send_changes_if_any(self, dirty_paths=None):
+        """Look for modifications inside the user directory. If any, generate the torrent and send it to the server
 
-        Logs().write_new_log(logging.INFO, "DETERMINING CHANGES IN SYNCHRONIZED DIRECTORY")
+        Parameters:
+            dirty_paths -- Relative paths reported as changed by the change watcher. If None, the whole user directory is scanned"""
+
+        with self.send_changes_lock:
+            payload_writer = self.torrent_handler.create_payload_writer()
+
+            try:
+                has_changes = self.determine_changes(payload_writer, dirty_paths)  # Write the changes in the user directory to the payload
+
+                if has_changes:
+                    Logs().write_new_log(logging.INFO, "CHANGES IN SYNCHRONIZED FILES DETECTED")
+                    self.torrent_handler.generate_data_to_send_and_torrent(payload_writer, "patch")  # Generate the torrent and send it to the server
 
-        changes = {
-            'added': [],
-            'deleted': [],
-            'modified': []
-        }
+            except Exception:
+                payload_writer.discard()  # The unfinished payload is not left in the cache directory
+                raise
 
-        files_hashes_list = self.parameters.get_list_of_files()  # Get the current hashes of the files
+            if has_changes:
+                self.parameters.files_hashes_list_previous = self.parameters.take_snapshot_of_files(dirty_paths=dirty_paths)
+            else:
+                payload_writer.discard()
+                self.main_gui.ui.label_sync_state.setText("Synchronized")
+
+    def determine_changes(self, payload_writer, dirty_paths=None):
+        """Determine the changes and patches inside the user directory, and feed them one at a time to the payload writer
+
+        Parameters:
+            payload_writer -- The writer of the payload that will be sent
+            dirty_paths -- Relative paths reported as changed by the change watcher. If None, the whole user directory is scanned
+
+        Returns:
+            True if there are changes, False otherwise"""
+
+        Logs().write_new_log(logging.INFO, "DETERMINING CHANGES IN SYNCHRONIZED DIRECTORY")
+
+        files_hashes_list = self.parameters.get_list_of_files(dirty_paths)  # Get the current hashes of the files
 
         # Calculate added and deleted files
         previous_files = {file.file_rel_path: file for file in self.parameters.files_hashes_list_previous}
@@ -86,24 +129,213 @@ class PatchProcess:
         added_files_rel_path = set(current_files).difference(previous_files)
         deleted_files_rel_path = set(previous_files).difference(current_files)
 
-        changes['deleted'].extend(deleted_files_rel_path)
+        # A path that changed between file and directory is deleted and added again, it cannot be patched
+        type_changed_files_rel_path = {file_rel_path for file_rel_path in set(current_files).intersection(previous_files) if current_files[file_rel_path].is_dir != previous_files[file_rel_path].is_dir}
+        added_files_rel_path.update(type_changed_files_rel_path)
+        deleted_files_rel_path.update(type_changed_files_rel_path)
+
+        # Renamed or moved files and directories are matched, and removed from the added and deleted ones
+        moves, previous_paths_of_moved, deleted_after_move = self.detect_moves(previous_files, current_files, added_files_rel_path, deleted_files_rel_path)
+
+        for source_rel_path, destination_rel_path in moves:  # Moved file(s) and directorie(s)
+            previous_file = previous_files[source_rel_path]
+            payload_writer.add_entry('moved', {
+                'source': source_rel_path,
+                'destination': destination_rel_path,
+                'is_dir': previous_file.is_dir,
+                'hash': None if previous_file.is_dir else previous_file.hash
+            })
+
+        for file_rel_path in sorted(deleted_files_rel_path) + deleted_after_move:  # Deleted file(s)
+            payload_writer.add_entry('deleted', file_rel_path)
 
-        for file_rel_path in added_files_rel_path:  # Added file(s)
+        user_directory = self.parameters.current_client.user_directory
+
+        # The contents of the last synchronized state are also held by the other clients, so copied or moved files are not resent
+        previous_files_by_hash = {file.hash: file.file_rel_path for file in previous_files.values() if not file.is_dir and file.hash}
+
+        for file_rel_path in sorted(added_files_rel_path):  # Added file(s), a directory before its content
             file = current_files[file_rel_path]
-            file.content_bytes = str(file.content_bytes)
-            changes['added'].append(file.to_json())
 
-        for file_rel_path, current_file in current_files.items():  # Modified file(s)
-            if file_rel_path not in added_files_rel_path:
-                previous_file = previous_files.get(file_rel_path)
-                if previous_file and current_file.content_bytes != previous_file.content_bytes and not current_file.is_dir:
-                    # Determine the delta between the two states of the file
-                    delta_between_the_two_files = bsdiff4.diff(previous_file.content_bytes, current_file.content_bytes)
-                    current_file.patch = str(delta_between_the_two_files)  # Convert to string to be able to serialize it to JSON
-                    current_file.content_bytes = 0
-                    changes['modified'].append(current_file.to_json())
+            if not file.is_dir and file.hash in previous_files_by_hash:
+                file.content_bytes = payload_writer.add_local_content(file.hash, previous_files_by_hash[file.hash])
+            elif not file.is_dir:
+                file.content_bytes = payload_writer.add_file_segment(user_directory / file_rel_path, content_hash=file.hash or None)  # Copied by chunks into the payload, once per content
+
+            payload_writer.add_entry('added', file.to_json())
+
+        # A moved file is compared to the previous version at its source
+        modified_files = []
+
+        for file_rel_path, current_file in sorted(current_files.items()):
+            if file_rel_path in added_files_rel_path or current_file.is_dir:
+                continue
 
-        return changes
+            previous_file = previous_files[previous_paths_of_moved.get(file_rel_path, file_rel_path)]
+
+            if not previous_file.is_dir and current_file.hash != previous_file.hash:
+                modified_files.append((current_file, previous_file))
+
+        if modified_files:  # Modified file(s)
+            self.write_modified_files(payload_writer, modified_files)
+
+        return payload_writer.has_entries()
+
+    def get_subtrees_signatures(self, files, directories_rel_path):
+        """Get the signature of the content of directories: the relative path, type and hash of every path under them
+
+        Parameters:
+            files -- The files by relative path
+            directories_rel_path -- The relative paths of the directories
+
+        Returns:
+            A dictionary relative path of the directory -> frozenset of (path relative to the directory, is_dir, hash)
+        """
+        subtrees = {directory_rel_path: set() for directory_rel_path in directories_rel_path}
+
+        for file_rel_path, file in files.items():
+            ancestor_rel_path = os.path.dirname(file_rel_path)
+
+            while ancestor_rel_path:
+                if ancestor_rel_path in subtrees:
+                    subtrees[ancestor_rel_path].add((os.path.relpath(file_rel_path, ancestor_rel_path), file.is_dir, file.hash))
+
+                ancestor_rel_path = os.path.dirname(ancestor_rel_path)
+
+        return {directory_rel_path: frozenset(subtree) for directory_rel_path, subtree in subtrees.items()}
+
+    def detect_moves(self, previous_files, current_files, added_files_rel_path, deleted_files_rel_path):
+        """Match the deleted paths with the added paths that have the same inode or the same content.
+        A moved directory is a single move, the paths under it follow it. The matched paths are removed from the added and deleted ones
+
+        Parameters:
+            previous_files -- The files of the last synchronized state, by relative path
+            current_files -- The current files, by relative path
+            added_files_rel_path -- The relative paths of the added files, updated
+            deleted_files_rel_path -- The relative paths of the deleted files, updated
+
+        Returns:
+            The list of the moves (source, destination), the previous path of every current path covered by a move,
+            and the paths to delete once the moves are done (paths under a moved directory that were deleted)
+        """
+        moves = []
+        previous_paths_of_moved = {}
+        deleted_after_move = []
+
+        # Directories first, shallowest first, so a moved subtree is moved at once
+        deleted_directories = sorted((path for path in deleted_files_rel_path if previous_files[path].is_dir), key=lambda path: (path.count(os.sep), path))
+        added_directories = [path for path in added_files_rel_path if current_files[path].is_dir]
+
+        added_directories_by_inode = {current_files[path].inode: path for path in added_directories if getattr(current_files[path], 'inode', None)}
+        added_directories_by_subtree = {}
+
+        for path, subtree in self.get_subtrees_signatures(current_files, added_directories).items():
+            if subtree:  # Empty directories are only matched by inode
+                added_directories_by_subtree.setdefault(subtree, path)
+
+        deleted_subtrees = self.get_subtrees_signatures(previous_files, deleted_directories)
+
+        for source_rel_path in deleted_directories:
+            if source_rel_path not in deleted_files_rel_path:  # Under a directory already moved
+                continue
+
+            destination_rel_path = added_directories_by_inode.get(getattr(previous_files[source_rel_path], 'inode', None))
+
+            if destination_rel_path is None and deleted_subtrees[source_rel_path]:
+                destination_rel_path = added_directories_by_subtree.get(deleted_subtrees[source_rel_path])
+
+            if destination_rel_path is None or destination_rel_path not in added_files_rel_path:
+                continue
+
+            moves.append((source_rel_path, destination_rel_path))
+            source_prefix = source_rel_path + os.sep
+
+            for previous_rel_path in [source_rel_path] + [path for path in previous_files if path.startswith(source_prefix)]:
+                current_rel_path = destination_rel_path + previous_rel_path[len(source_rel_path):]
+                deleted_files_rel_path.discard(previous_rel_path)
+
+                if current_rel_path in current_files and current_files[current_rel_path].is_dir == previous_files[previous_rel_path].is_dir:
+                    added_files_rel_path.discard(current_rel_path)
+                    previous_paths_of_moved[current_rel_path] = previous_rel_path
+                else:  # Removed from the moved directory, or replaced by a path of another type
+                    deleted_after_move.append(current_rel_path)
+
+        # Then the files, by inode and then by content
+        added_files_by_inode = {}
+        added_files_by_hash = {}
+
+        for path in sorted(added_files_rel_path):
+            if not current_files[path].is_dir:
+                if getattr(current_files[path], 'inode', None):
+                    added_files_by_inode.setdefault(current_files[path].inode, path)
+
+                added_files_by_hash.setdefault(current_files[path].hash, []).append(path)
+
+        for source_rel_path in sorted(deleted_files_rel_path):
+            previous_file = previous_files[source_rel_path]
+
+            if previous_file.is_dir:
+                continue
+
+            destination_rel_path = added_files_by_inode.get(getattr(previous_file, 'inode', None))
+
+            if destination_rel_path is None or destination_rel_path not in added_files_rel_path:
+                destination_rel_path = next((path for path in added_files_by_hash.get(previous_file.hash, []) if path in added_files_rel_path), None)
+
+            if destination_rel_path is None:
+                continue
+
+            moves.append((source_rel_path, destination_rel_path))
+            deleted_files_rel_path.discard(source_rel_path)
+            added_files_rel_path.discard(destination_rel_path)
+            previous_paths_of_moved[destination_rel_path] = source_rel_path
+
+        if moves:
+            Logs().write_new_log(logging.INFO, f"DETECTED {len(moves)} MOVED FILES AND DIRECTORIES")
+
+        return moves, previous_paths_of_moved, deleted_after_move
+
+    def write_modified_files(self, payload_writer, modified_files):
+        """Compute the deltas of the modified files in parallel and feed them to the payload writer, in the order of the list
+
+        Parameters:
+            payload_writer -- The writer of the payload that will be sent
+            modified_files -- The list of the modified files, as tuples (current file, previous file)"""
+        user_directory = self.parameters.current_client.user_directory
+        snapshot_store = self.parameters.get_snapshot_store()
+        delta_executor = self.get_delta_executor()
+
+        # Each worker streams the base version from the snapshot store and writes the delta to its own temporary file
+        deltas = []
+
+        try:
+            for index, (current_file, previous_file) in enumerate(modified_files):
+                previous_object_path = snapshot_store.get_object_path(previous_file.hash)
+
+                if previous_object_path is None:
+                    raise FileNotFoundError(f"Object {previous_file.hash} is not in the snapshot store")
+
+                delta_path = self.parameters.get_cache_directory() / f"delta-{index}{TEMPORARY_FILE_SUFFIX}"
+                future = delta_executor.submit(write_delta_to_file, str(previous_object_path), str(user_directory / current_file.file_rel_path), str(delta_path))
+                deltas.append((current_file, delta_path, future))
+
+            # The results are gathered in the order of submission, so the payload does not depend on which diff finishes first
+            for current_file, delta_path, future in deltas:
+                current_file.delta_engine = future.result()
+                current_file.patch = payload_writer.add_file_segment(delta_path)
+                current_file.content_bytes = 0
+                payload_writer.add_entry('modified', current_file.to_json())
+
+        finally:
+            for current_file, delta_path, future in deltas:
+                future.cancel()
+
+            for current_file, delta_path, future in deltas:
+                if not future.cancelled():
+                    future.exception()  # Wait for the worker to stop writing before removing the file
+
+                if delta_path.exists():
+                    delta_path.unlink()
 
     def reapply_backup_after_blocks(self, backup_current_files):
         """Reapply the files that were backed up before the block-level synchronization was performed
@@ -112,7 +344,8 @@ class PatchProcess:
             backup_current_files -- The list of files that were backed up before the block-level synchronization was performed
         """
 
-        self.parameters.files_hashes_list_previous = self.parameters.get_list_of_files()  # Get current hashes after receiving blocks but before applying backed up changes
+        # Get current hashes after receiving blocks but before applying backed up changes, keeping the backed up content in the snapshot store
+        self.parameters.files_hashes_list_previous = self.parameters.take_snapshot_of_files(keep_files=backup_current_files)
 
         # Files that need to be deleted
         current_files_set = set(file.file_rel_path for file in self.parameters.files_hashes_list_previous)
@@ -122,7 +355,12 @@ class PatchProcess:
         for file_rel_path in deleted_files_rel_path:
             os.remove(f"{self.parameters.current_client.user_directory}/{file_rel_path}")
 
+        snapshot_store = self.parameters.get_snapshot_store()
+
         for file in backup_current_files:
             file_path = f"{self.parameters.current_client.user_directory}/{file.file_rel_path}"
-            with open(file_path, "wb") as file_open:
-                file_open.write(file.content_bytes)
\ No newline at end of file
+
+            if file.is_dir:
+                os.makedirs(file_path, exist_ok=True)
+            else:
+                snapshot_store.copy_object_to_file(file.hash, file_path)  # Write the backed up content, by chunks
\ No newline at end of file
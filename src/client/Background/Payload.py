@@ -0,0 +1,601 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import io
+import json
+import mmap
+import zlib
+import lzma
+import itertools
+import base64
+import shutil
+import uuid
+
+import sys
+from pathlib import Path
+parent_directory = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(parent_directory))
+
+import logging
+from Logs import Logs
+
+PAYLOAD_FILE_PREFIX = "foxync-torrent-"
+
+PAYLOAD_VERSION = 1
+MANIFEST_FILE_NAME = "manifest.json"
+SEGMENTS_FILE_NAME_FORMAT = "segments-{:05d}.fxs"
+
+# Codecs of the compressed segments, a segment reference without codec is stored as is
+CODEC_ZLIB = "zlib"
+CODEC_LZMA = "lzma"
+
+COMPRESSION_SAMPLE_SIZE = 64 * 1024  # Size of the start of a content compressed to choose its codec
+MIN_COMPRESSED_SIZE = 512  # Smaller contents are stored as is, the codec would not save anything
+INCOMPRESSIBLE_RATIO = 0.9  # Contents whose sample does not compress below this ratio (media, archives, bsdiff patches) are stored as is
+LZMA_RATIO = 0.25  # Contents whose sample compresses below this ratio (text, logs) are worth the slower lzma
+DECOMPRESSED_CHUNK_SIZE = 1024 * 1024  # Maximum size of the decompressed chunks, so a small segment never expands in memory at once
+
+def choose_codec(sample):
+    """Choose the codec of a content from a sample of its start, with a fast zlib compression of the sample
+
+    Parameters:
+        sample -- The start of the content
+
+    Returns:
+        The name of the codec, or None to store the content as is
+    """
+    if len(sample) < MIN_COMPRESSED_SIZE:
+        return None
+
+    compression_ratio = len(zlib.compress(sample, 1)) / len(sample)
+
+    if compression_ratio >= INCOMPRESSIBLE_RATIO:
+        return None
+
+    if compression_ratio <= LZMA_RATIO:
+        return CODEC_LZMA
+
+    return CODEC_ZLIB
+
+def create_compressor(codec):
+    """Create a streaming compressor
+
+    Parameters:
+        codec -- The name of the codec"""
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(6)
+
+    if codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=1)
+
+    raise ValueError(f"Unknown payload codec {codec}")
+
+def decompress_chunks(codec, chunks):
+    """Decompress a content by chunks of at most DECOMPRESSED_CHUNK_SIZE bytes
+
+    Parameters:
+        codec -- The name of the codec
+        chunks -- The iterable of the chunks of the compressed content"""
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+
+        for chunk in chunks:
+            while chunk:
+                yield decompressor.decompress(chunk, DECOMPRESSED_CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+
+        yield decompressor.flush()
+
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor()
+
+        for chunk in chunks:
+            yield decompressor.decompress(chunk, DECOMPRESSED_CHUNK_SIZE)
+
+            while not decompressor.needs_input and not decompressor.eof:
+                yield decompressor.decompress(b"", DECOMPRESSED_CHUNK_SIZE)
+
+    else:
+        raise ValueError(f"Unknown payload codec {codec}")
+
+def create_payload_file_name():
+    """Get a new unique name for a payload, so several payloads can be seeded at the same time"""
+    return f"{PAYLOAD_FILE_PREFIX}{uuid.uuid4().hex}"
+
+def get_payload_path(save_path, first_file_path):
+    """Get the path of a downloaded payload from the path of the first file of its torrent
+
+    Parameters:
+        save_path -- The directory in which the torrent was saved
+        first_file_path -- The path of the first file in the torrent
+
+    Returns:
+        The payload directory
+    """
+    return Path(save_path) / Path(first_file_path).parts[0]
+
+def remove_payload(payload_path):
+    """Delete a payload
+
+    Parameters:
+        payload_path -- The path of the payload directory"""
+    payload_path = Path(payload_path)
+
+    if payload_path.is_dir():
+        shutil.rmtree(payload_path)
+
+def get_payload_size(payload_path):
+    """Get the total size of the files of a payload directory
+
+    Parameters:
+        payload_path -- The path of the payload directory"""
+    return sum(file.stat().st_size for file in Path(payload_path).iterdir())
+
+def encode_payload(payload_path):
+    """Encode the files of a small payload directory so it can be sent inside a JSON message
+
+    Parameters:
+        payload_path -- The path of the payload directory
+
+    Returns:
+        A dictionary of the names of the files and their base64 content
+    """
+    return {file.name: base64.b64encode(file.read_bytes()).decode('ascii') for file in Path(payload_path).iterdir()}
+
+def decode_payload(encoded_files, payload_path):
+    """Write the files of a payload directory received inside a JSON message
+
+    Parameters:
+        encoded_files -- The dictionary of the names of the files and their base64 content
+        payload_path -- The path of the payload directory to write"""
+    payload_path = Path(payload_path)
+    payload_path.mkdir(parents=True, exist_ok=True)
+
+    for file_name, encoded_content in encoded_files.items():
+        (payload_path / Path(file_name).name).write_bytes(base64.b64decode(encoded_content))
+
+class ChunksReader(io.RawIOBase):
+    """
+    The ChunksReader class reads an iterable of chunks of bytes as a file, so a content can be parsed
+    with bounded reads without joining its chunks in memory.
+    """
+
+    def __init__(self, chunks):
+        """
+        Initialize a new ChunksReader object.
+
+        Parameters:
+        chunks -- The iterable of the chunks of bytes of the content.
+        """
+        self.chunks = iter(chunks)
+        self.pending_chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Read the next bytes of the content into a buffer
+
+        Parameters:
+            buffer -- The buffer to fill
+
+        Returns:
+            The number of bytes read, 0 at the end of the content
+        """
+        while not self.pending_chunk:
+            chunk = next(self.chunks, None)
+
+            if chunk is None:
+                return 0
+
+            self.pending_chunk = memoryview(chunk)
+
+        read_size = min(len(buffer), len(self.pending_chunk))
+        buffer[:read_size] = self.pending_chunk[:read_size]
+        self.pending_chunk = self.pending_chunk[read_size:]
+
+        return read_size
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):  # Close the file read by a generator of chunks
+            self.chunks.close()
+
+        super().close()
+
+class PayloadWriter:
+    """
+    The PayloadWriter class writes the payload sent via torrent. The payload is a directory containing a JSON manifest
+    describing the changes and the raw contents, grouped in segments files of about SEGMENTS_FILE_SIZE bytes.
+    A content is never split between two segments files, so a large file gets its own segments file.
+    In the manifest, every content is replaced by a reference {'file', 'offset', 'length'} to its segment, plus {'codec', 'size'}
+    if the content was compressed. The contents whose SHA-256 is known are written once in the content table of the manifest and
+    referenced by {'hash'}, as are the contents the receiving client already has, which are only described by a location hint.
+    Entries are fed one at a time and their contents are written to the disk immediately, only the manifest is kept in memory.
+    Bittorrent v2 hashes every file of a torrent separately, so the segments files can be verified independently.
+    """
+
+    COPY_BUFFER_SIZE = 1024 * 1024  # Size of the reads when copying a source file into the payload
+    SEGMENTS_FILE_SIZE = 4 * 1024 * 1024  # Size after which the next content is written to a new segments file
+
+    def __init__(self, payload_path):
+        """
+        Initialize a new PayloadWriter object. The payload directory is created when the first content is written.
+
+        Parameters:
+        payload_path -- The path of the payload directory to write.
+        """
+        self.payload_path = Path(payload_path)
+        self.segments_file = None
+        self.segments_files_count = 0
+
+        self.contents = {}  # SHA-256 -> segment reference, for the contents written once and referenced by hash
+        self.local_contents = {}  # SHA-256 -> location hint, for the contents the receiving client already has
+
+        self.changes = {
+            'moved': [],
+            'added': [],
+            'deleted': [],
+            'modified': []
+        }
+
+    def get_segments_file(self):
+        """Get the segments file in which the next content is written, starting a new one if the current one is full"""
+        if self.segments_file is not None and self.segments_file.tell() < self.SEGMENTS_FILE_SIZE:
+            return self.segments_file
+
+        if self.segments_file is not None:
+            self.segments_file.close()
+
+        self.payload_path.mkdir(parents=True, exist_ok=True)
+        self.segments_file = open(self.payload_path / SEGMENTS_FILE_NAME_FORMAT.format(self.segments_files_count), "wb")
+        self.segments_files_count += 1
+
+        return self.segments_file
+
+    def has_entries(self):
+        """Check if at least one entry was added to the payload"""
+        return any(self.changes.values())
+
+    def add_segment(self, content_bytes):
+        """Append a content segment to the payload
+
+        Parameters:
+            content_bytes -- The content to append
+
+        Returns:
+            The reference of the segment, to put in the manifest
+        """
+        return self.add_chunks_segment([content_bytes])
+
+    def add_chunks_segment(self, chunks):
+        """Append a content produced by chunks to the payload, e.g. a delta, without holding it in memory.
+        The content is compressed with the codec chosen from a sample of its start
+
+        Parameters:
+            chunks -- The iterable of the chunks of bytes of the content
+
+        Returns:
+            The reference of the segment, to put in the manifest. A compressed segment also has its codec and its decompressed size
+        """
+        segments_file = self.get_segments_file()
+        offset = segments_file.tell()
+
+        # Keep the first chunks until the sample is complete
+        chunks = iter(chunks)
+        sample_chunks = []
+        sample_size = 0
+
+        for chunk in chunks:
+            sample_chunks.append(chunk)
+            sample_size += len(chunk)
+
+            if sample_size >= COMPRESSION_SAMPLE_SIZE:
+                break
+
+        codec = choose_codec(b"".join(sample_chunks)[:COMPRESSION_SAMPLE_SIZE])
+        compressor = create_compressor(codec) if codec else None
+        content_size = 0
+
+        for chunk in itertools.chain(sample_chunks, chunks):
+            content_size += len(chunk)
+            segments_file.write(compressor.compress(chunk) if compressor else chunk)
+
+        if compressor:
+            segments_file.write(compressor.flush())
+
+        segment = {'file': self.segments_files_count - 1, 'offset': offset, 'length': segments_file.tell() - offset}
+
+        if codec:
+            segment['codec'] = codec
+            segment['size'] = content_size
+
+        return segment
+
+    def read_file_chunks(self, file_path, starting_byte=0, length=None):
+        """Read a part of a file by chunks
+
+        Parameters:
+            file_path -- The full path of the source file
+            starting_byte -- The position of the content in the source file
+            length -- The length of the content, or None to read until the end of the source file"""
+        read_length = 0
+
+        with open(file_path, "rb") as source_file:
+            source_file.seek(starting_byte)
+
+            while length is None or read_length < length:
+                read_size = self.COPY_BUFFER_SIZE if length is None else min(self.COPY_BUFFER_SIZE, length - read_length)
+                read_bytes = source_file.read(read_size)
+
+                if not read_bytes:  # The source file is shorter than expected
+                    break
+
+                yield read_bytes
+                read_length += len(read_bytes)
+
+    def add_file_segment(self, file_path, starting_byte=0, length=None, content_hash=None):
+        """Copy a part of a file into a content segment of the payload, by chunks
+
+        Parameters:
+            file_path -- The full path of the source file
+            starting_byte -- The position of the content in the source file
+            length -- The length of the content, or None to copy until the end of the source file
+            content_hash -- The SHA-256 of the content if it is known, so identical contents are only written once
+
+        Returns:
+            The reference of the segment, or of the content by hash, to put in the manifest
+        """
+        if content_hash is None:
+            return self.add_chunks_segment(self.read_file_chunks(file_path, starting_byte, length))
+
+        if content_hash not in self.contents:
+            self.contents[content_hash] = self.add_chunks_segment(self.read_file_chunks(file_path, starting_byte, length))
+
+        return {'hash': content_hash}
+
+    def add_local_content(self, content_hash, file_rel_path, starting_byte=0, length=None):
+        """Reference a content the receiving client already has, instead of writing it
+
+        Parameters:
+            content_hash -- The SHA-256 of the content
+            file_rel_path -- The relative path of a file of the receiving client containing the content
+            starting_byte -- The position of the content in this file
+            length -- The length of the content, or None for the whole file
+
+        Returns:
+            The reference of the content by hash, to put in the manifest
+        """
+        if content_hash not in self.contents:
+            self.local_contents.setdefault(content_hash, {'file_rel_path': file_rel_path, 'starting_byte': starting_byte, 'length': length})
+
+        return {'hash': content_hash}
+
+    def add_entry(self, section, entry):
+        """Add an entry to the manifest, its contents must already be segment references
+
+        Parameters:
+            section -- The section of the changes ('added', 'deleted', 'modified', ...)
+            entry -- The entry (File, Patch or Block as JSON, or relative path)"""
+        self.changes.setdefault(section, []).append(entry)
+
+    def close(self, changes_type, creation_timestamp):
+        """Write the manifest and close the payload
+
+        Parameters:
+            changes_type -- The type of changes to be applied later (block or patch)
+            creation_timestamp -- The time at which the changes were generated"""
+        manifest = {
+            'version': PAYLOAD_VERSION,
+            'changes_type': changes_type,
+            'changes': self.changes,
+            'creation_timestamp': creation_timestamp,
+            'segments_files': [SEGMENTS_FILE_NAME_FORMAT.format(index) for index in range(self.segments_files_count)],
+            'contents': self.contents,
+            'local_contents': self.local_contents,
+        }
+
+        if self.segments_file is not None:
+            self.segments_file.close()
+
+        self.payload_path.mkdir(parents=True, exist_ok=True)
+
+        with open(self.payload_path / MANIFEST_FILE_NAME, "w") as manifest_file:
+            json.dump(manifest, manifest_file, separators=(',', ':'))
+
+        Logs().write_new_log(logging.INFO, f"WROTE PAYLOAD WITH {self.segments_files_count} SEGMENTS FILES")
+
+    def discard(self):
+        """Close and delete the payload, when there is nothing to send"""
+        if self.segments_file is not None:
+            self.segments_file.close()
+
+        remove_payload(self.payload_path)
+
+class PayloadReader:
+    """
+    The PayloadReader class reads a payload received via torrent. The segments files are mapped in memory, so the segments
+    are only read from the disk when they are used. A payload directory can be read while it is downloaded, the reader then
+    waits for each part of it before using it.
+    """
+
+    COPY_BUFFER_SIZE = 1024 * 1024  # Size of the writes when copying a segment into a file
+
+    def __init__(self, payload_path, wait_for_range=None):
+        """
+        Initialize a new PayloadReader object and read the manifest of the payload.
+
+        Parameters:
+        payload_path -- The path of the payload directory.
+        wait_for_range -- Function (file name, offset, length or None) waiting for a part of a file of the payload directory, if it is still downloading.
+        """
+        self.payload_path = Path(payload_path)
+        self.wait_for_range = wait_for_range
+        self.mapped_files = []
+        self.staged_contents = {}  # SHA-256 -> path of the copy of a local content
+
+        if self.wait_for_range is not None:
+            self.wait_for_range(MANIFEST_FILE_NAME, 0, None)
+
+        with open(self.payload_path / MANIFEST_FILE_NAME, "r") as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        if self.manifest.get('version') != PAYLOAD_VERSION:
+            raise ValueError(f"The payload {self.payload_path} has an unsupported format version {self.manifest.get('version')}")
+
+        self.segments_files_paths = [self.payload_path / file_name for file_name in self.manifest['segments_files']]
+        self.mapped_files = [None] * len(self.segments_files_paths)
+
+    def stage_local_contents(self, copy_local_content, staging_directory):
+        """Copy the local contents referenced by the payload before any file is changed, so applying the changes cannot alter them
+
+        Parameters:
+            copy_local_content -- Function (SHA-256, location hint, destination path) copying a local content, raising FileNotFoundError if it is not found
+            staging_directory -- The directory in which the local contents are copied"""
+        local_contents = self.manifest['local_contents']
+
+        if not local_contents:
+            return
+
+        staging_directory = Path(staging_directory)
+        staging_directory.mkdir(parents=True, exist_ok=True)
+
+        for content_hash, location in local_contents.items():
+            staged_path = staging_directory / content_hash
+            copy_local_content(content_hash, location, staged_path)
+            self.staged_contents[content_hash] = staged_path
+
+        Logs().write_new_log(logging.INFO, f"STAGED {len(local_contents)} LOCAL CONTENTS")
+
+    def resolve_content(self, content):
+        """Get the segment reference of a content referenced by hash, or the path of its staged local copy
+
+        Parameters:
+            content -- A segment reference, or a reference by hash"""
+        if 'hash' not in content:
+            return content
+
+        content_hash = content['hash']
+
+        if content_hash in self.manifest['contents']:
+            return self.manifest['contents'][content_hash]
+
+        if content_hash in self.staged_contents:
+            return self.staged_contents[content_hash]
+
+        raise FileNotFoundError(f"Content {content_hash} is neither in the payload nor staged")
+
+    def get_mapped_file(self, content):
+        """Get the mapping of the segments file containing a content, mapping it on first use.
+        If the payload is still downloading, wait for the content first
+
+        Parameters:
+            content -- A segment reference"""
+        file_index = content['file']
+        content_end = content['offset'] + content['length']
+
+        if self.wait_for_range is not None:
+            self.wait_for_range(self.segments_files_paths[file_index].name, content['offset'], content['length'])
+
+        mapped_file = self.mapped_files[file_index]
+
+        if mapped_file is None or len(mapped_file) < content_end:  # A file being downloaded can grow after it was mapped
+            if mapped_file is not None:
+                mapped_file.close()
+
+            with open(self.segments_files_paths[file_index], "rb") as segments_file:
+                self.mapped_files[file_index] = mmap.mmap(segments_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.mapped_files[file_index]
+
+    def get_content_bytes(self, content):
+        """Get the bytes of a content of the manifest, decompressed if needed
+
+        Parameters:
+            content -- A segment reference, or a reference by hash
+
+        Returns:
+            The content as bytes
+        """
+        content = self.resolve_content(content)
+
+        if isinstance(content, Path):  # Staged local content
+            return content.read_bytes()
+
+        if content['length'] == 0:  # Empty segments files cannot be mapped
+            return b""
+
+        stored_bytes = self.get_mapped_file(content)[content['offset']:content['offset'] + content['length']]
+
+        if 'codec' in content:
+            return b"".join(decompress_chunks(content['codec'], [stored_bytes]))
+
+        return stored_bytes
+
+    def get_content_chunks(self, content):
+        """Get a content of the manifest by chunks, decompressed if needed, so only a small part of the segment is in memory
+
+        Parameters:
+            content -- A segment reference, or a reference by hash
+
+        Returns:
+            A generator of the chunks of bytes of the content
+        """
+        content = self.resolve_content(content)
+
+        if isinstance(content, Path):  # Staged local content
+            with open(content, "rb") as staged_file:
+                while chunk := staged_file.read(self.COPY_BUFFER_SIZE):
+                    yield chunk
+
+            return
+
+        if content['length'] == 0:
+            return
+
+        mapped_file = self.get_mapped_file(content)
+        segment_end = content['offset'] + content['length']
+
+        chunks = (mapped_file[offset:min(offset + self.COPY_BUFFER_SIZE, segment_end)] for offset in range(content['offset'], segment_end, self.COPY_BUFFER_SIZE))
+
+        if 'codec' in content:
+            chunks = decompress_chunks(content['codec'], chunks)
+
+        yield from chunks
+
+    def open_content(self, content):
+        """Open a content of the manifest as a file read by chunks, e.g. to parse a large delta with bounded memory
+
+        Parameters:
+            content -- A segment reference, or a reference by hash
+
+        Returns:
+            The content opened for reading in binary mode
+        """
+        return io.BufferedReader(ChunksReader(self.get_content_chunks(content)), self.COPY_BUFFER_SIZE)
+
+    def copy_content_to_file(self, content, destination_file):
+        """Write a content of the manifest to an open file, by chunks so only a small part of the segment is in memory
+
+        Parameters:
+            content -- A segment reference, or a reference by hash
+            destination_file -- The file opened in binary mode, at the position where the content is written"""
+        for chunk in self.get_content_chunks(content):
+            destination_file.write(chunk)
+
+    def close(self):
+        """Release the mappings and close the payload files"""
+        for mapped_file in self.mapped_files:
+            if mapped_file is not None:
+                mapped_file.close()
+
+        for staged_path in self.staged_contents.values():
+            staged_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -5,9 +5,12 @@
 # Description : File synchronization tool using Bittorrent
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.parse
 import json
 import platform
+import threading
 
 from pathlib import Path
 import sys
@@ -26,6 +29,14 @@ from inc.server_info_inc import Servers_Info
 class RequestsSender:
     _instance = None
 
+    # Settings of the HTTP sessions
+    POOL_SIZE = 10  # Connections kept alive to the server by each session
+    CONNECT_TIMEOUT_IN_SECONDS = 5
+    READ_TIMEOUT_IN_SECONDS = 30
+    RETRIES_COUNT = 3
+    RETRY_BACKOFF_FACTOR = 0.5  # Waits 0.5, 1, 2... seconds between the retries
+    RETRY_STATUS_CODES = (502, 503, 504)
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(RequestsSender, cls).__new__(cls)
@@ -48,10 +59,53 @@ class RequestsSender:
             
             self.scheduler_ping = BackgroundScheduler()
 
+            # The requests of a thread go through the same session, so the connections and their TLS handshakes are reused.
+            # The scheduler, relay and GUI threads each have their own session, requests.Session is not documented as thread-safe
+            self.thread_sessions = threading.local()
+            self.sessions = []  # Sessions of all threads, to close them
+            self.sessions_lock = threading.Lock()
+            self.timeout = (self.CONNECT_TIMEOUT_IN_SECONDS, self.READ_TIMEOUT_IN_SECONDS)
+
             Logs().write_new_log(logging.INFO, "INITIALIZED CLIENT REQUESTSSENDER")
 
             print("CLIENT REQUESTSSENDER INITIALIZED")
 
+    def get_session(self):
+        """Get the HTTP session of the current thread, creating it on first use"""
+        session = getattr(self.thread_sessions, 'session', None)
+
+        if session is None:
+            # POST requests are only retried if the connection failed, so a request received by the server is never sent twice
+            retry = Retry(
+                total=self.RETRIES_COUNT,
+                backoff_factor=self.RETRY_BACKOFF_FACTOR,
+                status_forcelist=self.RETRY_STATUS_CODES,
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE, max_retries=retry)
+
+            session = requests.Session()
+            session.verify = False
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+            self.thread_sessions.session = session
+
+            with self.sessions_lock:
+                self.sessions.append(session)
+
+        return session
+
+    def close_session(self):
+        """Close the connections kept alive to the server by the sessions of all threads"""
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, []
+            self.thread_sessions = threading.local()  # The threads create new sessions if they send other requests
+
+        for session in sessions:
+            session.close()
+
     def set_scheduler_for_ping(self):
         """Set the scheduler to send a ping message to the server every 3 seconds"""
 
@@ -83,9 +137,9 @@ class RequestsSender:
                 else:
                     headers = {"Authorization": f"Bearer {self.parameters.access_token_server}"}
                     
-                response = requests.post(url, json=data, headers=headers,  verify=False)
+                response = self.get_session().post(url, json=data, headers=headers, timeout=self.timeout)
             else:
-                response = requests.post(url, json=data, verify=False)
+                response = self.get_session().post(url, json=data, timeout=self.timeout)
 
             if response.status_code == 401:
                 self.refresh_access_token()
@@ -102,10 +156,10 @@ class RequestsSender:
         try:
             if auth:
                 headers = {"Authorization": f"Bearer {self.parameters.access_token_server}"}
-                response = requests.get(url, headers=headers, verify=False)
+                response = self.get_session().get(url, headers=headers, timeout=self.timeout)
 
             else:
-                response = requests.get(url, verify=False)
+                response = self.get_session().get(url, timeout=self.timeout)
 
             if response.status_code == 200:
                 response_content = response.json()
@@ -198,6 +252,37 @@ class RequestsSender:
         
         return response_content
 
+    def bootstrap(self, user_id, hashed_password, mac_address, torrent_directory, ip_address, set_online=True):
+        """Get the user, the client, the tokens, the authenticated clients and the number of connected clients in one request
+        
+        Parameters:
+            user_id -- The ID of the user
+            hashed_password -- The hashed password of the user, returned at login, authenticating the request
+            mac_address -- The MAC address of the client
+            torrent_directory -- The torrent directory, if the client is inserted
+            ip_address -- The current IP address of the client, saved if the automatic update is enabled
+            set_online -- Indicates if the client is set as online
+
+        Returns:
+            The dictionary of the response, or None if the request failed
+        """
+        data = {'user_id': user_id, 'hashed_password': hashed_password, 'name': platform.node(), 'mac_address': mac_address,
+                'torrent_directory': torrent_directory, 'ip_address': ip_address, 'set_online': set_online}
+
+        response = self.send_post_request(f'https://{Servers_Info.SERVER_IP.value}:{Servers_Info.SERVER_PORT.value}/bootstrap', data, 
+                               "Successfully sent data to /bootstrap endpoint of server", 
+                               "Error while calling /bootstrap", False)
+
+        if response == 400 or response.status_code != 200:
+            return None
+
+        try:
+            response_content = response.json()
+        except ValueError:  # The server answered an error code as text
+            return None
+
+        return response_content if isinstance(response_content, dict) else None
+
     def get_tokens(self, client_id, user_id):
         """Get the access and refresh tokens from the server"""
 
@@ -290,6 +375,17 @@ class RequestsSender:
                                "Successfully sent data to /relay_magnet_link endpoint of server", 
                                "Error while calling /relay_magnet_link")
 
+    def send_to_server_inline_payload(self, changes_type, payload_files, connecting_client = 0):
+        """Send a small payload to the server, to be relayed directly to the other clients"""
+
+        current_client_json = self.parameters.current_client.dict_to_json()
+
+        data = {'info_type': "inline_payload", 'changes_type': changes_type, 'payload_files': payload_files, 'client_sender': current_client_json, 'connecting_client': connecting_client}
+
+        self.send_post_request(f'https://{Servers_Info.SERVER_IP.value}:{Servers_Info.SERVER_PORT.value}/relay_inline_payload', data, 
+                               "Successfully sent data to /relay_inline_payload endpoint of server", 
+                               "Error while calling /relay_inline_payload")
+
     def login(self, username, hashed_password, is_fast_login = False):
         """Send a list of files and their blocks to the server when client is starting"""
 
@@ -336,7 +432,7 @@ class RequestsSender:
             for i in range(len(files_blocks[key])):
                 files_blocks_json[key].append(files_blocks[key][i].to_json())
 
-        data = {'files_blocks': files_blocks_json, 'client_sender': current_client_json}
+        data = {'files_blocks': files_blocks_json, 'client_sender': current_client_json, 'chunking_mode': self.parameters.current_user.chunking_mode}
         
         self.send_post_request(f'https://{Servers_Info.SERVER_IP.value}:{Servers_Info.SERVER_PORT.value}/relay_blocks', data, 
                                "Successfully sent data to /relay_blocks endpoint of server", 
@@ -2,6 +2,8 @@ from PyQt5.QtCore import QObject, pyqtSignal
 import time
 import os
 import socket
+import ssl
+import struct
 import threading
 import hashlib
 import json
@@ -16,12 +18,22 @@ from pathlib import Path
 parent_directory = Path(__file__).resolve().parent.parent.parent
 sys.path.append(str(parent_directory))
 
+from inc.server_info_inc import Servers_Info
+
 import logging
 from Logs import Logs
 
 class SocketHandler():
     _instance = None
 
+    PUSH_PORT = 3126  # Port of the server on which the push channel is opened
+    CONNECT_TIMEOUT_IN_SECONDS = 5  # Maximum time to open the push channel
+    RECONNECT_DELAY_IN_SECONDS = 5  # Time before opening the push channel again after it was closed
+
+    FRAME_HEADER = struct.Struct("!I")  # Length of the data of a frame, followed by the JSON data
+    MAX_FRAME_SIZE = 1024 * 1024 * 1024  # Frames announcing a larger size are refused
+    RECEIVE_BUFFER_SIZE = 1024 * 1024  # Size of the socket receive buffer, and initial size of the buffer of data sent without frame
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(SocketHandler, cls).__new__(cls)
@@ -45,11 +57,21 @@ class SocketHandler():
             from GUI.Main import Main
             self.main_gui = Main()
 
+            # Import and initialize RequestsSender
+            from Background.RequestsSender import RequestsSender
+            self.requests_sender = RequestsSender()
+
             # Create a separate thread for listening for information from the server
             self.listen_for_information_stop_event = threading.Event()
             self.listen_for_information_thread = threading.Thread(target=self.listen_for_information)
             self.listen_for_information_thread.start()
 
+            # Create a separate thread keeping the push channel to the server open, the server sends the information through it
+            self.push_channel = None
+            self.push_channel_lock = threading.Lock()
+            self.push_channel_thread = threading.Thread(target=self.keep_push_channel_open)
+            self.push_channel_thread.start()
+
             Logs().write_new_log(logging.INFO, "INITIALIZED CLIENT SOCKET HANDLER")
 
             print("CLIENT SOCKETHANDLER INITIALIZED")
@@ -57,7 +79,16 @@ class SocketHandler():
     def stop_listen_for_information_thread(self):
         """Stop the thread listening for information from the server"""
         self.listen_for_information_stop_event.set()
+
+        with self.push_channel_lock:
+            if self.push_channel is not None:
+                try:
+                    self.push_channel.shutdown(socket.SHUT_RDWR)  # Unblock the thread waiting for a frame
+                except OSError:
+                    pass  # The server already closed the push channel
+
         self.listen_for_information_thread.join()
+        self.push_channel_thread.join()
         
     def handle_data_received_via_socket(self, socket_connection):
         """Handle the data received via socket connection
@@ -67,15 +98,38 @@ class SocketHandler():
         """
         try:
             Logs().write_new_log(logging.INFO, "HANDLING RECEIVED DATA VIA SOCKET")
-            received_data = []
-            while True:
-                part_of_data = socket_connection.recv(4096)
-                if not part_of_data:
-                    break
-                received_data.append(part_of_data.decode())
+            header = self.receive_exactly(socket_connection, self.FRAME_HEADER.size)
+
+            if header is None:
+                return
+
+            if header[0] == ord('{'):  # Data sent without frame: the JSON data until the connection is closed
+                received_data = self.receive_until_closed(socket_connection, header)
+            else:
+                (frame_size,) = self.FRAME_HEADER.unpack(header)
+
+                if frame_size > self.MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame of {frame_size} bytes is too large")
+
+                received_data = self.receive_exactly(socket_connection, frame_size)
 
-            received_data_json = json.loads(''.join(received_data))
+                if received_data is None:
+                    raise ValueError("Connection closed before the end of the frame")
 
+            self.handle_received_data(json.loads(received_data))  # Decoded once, a character is never split between two reads
+
+        except Exception as e:
+            print(f"Error handling data: {e}")
+        finally:
+            socket_connection.close()
+
+    def handle_received_data(self, received_data_json):
+        """Handle the data received from the server
+        
+        Parameters:
+            received_data_json -- The received data
+        """
+        try:
             # Handle the received data based on its content
             info_type = received_data_json.get('info_type')
 
@@ -83,12 +137,17 @@ class SocketHandler():
                 Logs().write_new_log(logging.INFO, "RECEIVED BLOCKS LIST")
                 # Compare file blocks received from another client
                 self.block_level_process.compare_files_blocks(
-                    received_data_json['files_blocks'], received_data_json['client_sender'])
+                    received_data_json['files_blocks'], received_data_json['client_sender'], received_data_json.get('chunking_mode', "fixed"))
 
             elif info_type == "complete_seeding":
                 Logs().write_new_log(logging.INFO, "RECEIVED COMPLETE SEEDING")
-                # Stop seeding torrents
-                self.parameters.keep_seeding = False
+                # Stop seeding the torrent that every client downloaded
+                self.torrent_handler.complete_seeding(received_data_json.get('info_hash'))
+
+            elif info_type == "inline_payload":
+                Logs().write_new_log(logging.INFO, "RECEIVED INLINE PAYLOAD")
+                # Apply the small payload sent without torrent
+                self.torrent_handler.transfer_manager.apply_inline_payload(received_data_json['payload_files'])
 
             elif info_type in {"block", "patch"}:
                 Logs().write_new_log(logging.INFO, "RECEIVED MAGNET LINK")
@@ -97,8 +156,173 @@ class SocketHandler():
 
         except Exception as e:
             print(f"Error handling data: {e}")
-        finally:
-            socket_connection.close()
+
+    def receive_exactly(self, socket_connection, size):
+        """Receive an exact number of bytes, into a buffer allocated once
+        
+        Parameters:
+            socket_connection -- The socket connection
+            size -- The number of bytes to receive
+
+        Returns:
+            The received bytes, or None if the connection was closed before
+        """
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received_size = 0
+
+        while received_size < size:
+            part_size = socket_connection.recv_into(view[received_size:])
+
+            if not part_size:
+                return None
+
+            received_size += part_size
+
+        return buffer
+
+    def receive_until_closed(self, socket_connection, received_data):
+        """Receive bytes until the connection is closed
+        
+        Parameters:
+            socket_connection -- The socket connection
+            received_data -- The bytes already received
+
+        Returns:
+            All the received bytes
+        """
+        buffer = bytearray(max(self.RECEIVE_BUFFER_SIZE, len(received_data)))
+        buffer[:len(received_data)] = received_data
+        received_size = len(received_data)
+
+        while True:
+            if received_size == len(buffer):  # The buffer is full, its size is doubled
+                buffer.extend(bytes(len(buffer)))
+
+            part_size = socket_connection.recv_into(memoryview(buffer)[received_size:])
+
+            if not part_size:
+                break
+
+            received_size += part_size
+
+            if received_size > self.MAX_FRAME_SIZE:
+                raise ValueError(f"Data of more than {self.MAX_FRAME_SIZE} bytes received")
+
+        del buffer[received_size:]
+
+        return buffer
+
+    def receive_frame(self, socket_connection):
+        """Receive a frame and decode its JSON data
+        
+        Parameters:
+            socket_connection -- The socket connection
+
+        Returns:
+            The received data, or None if the connection was closed
+        """
+        header = self.receive_exactly(socket_connection, self.FRAME_HEADER.size)
+
+        if header is None:
+            return None
+
+        (frame_size,) = self.FRAME_HEADER.unpack(header)
+
+        if frame_size > self.MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {frame_size} bytes is too large")
+
+        frame_data = self.receive_exactly(socket_connection, frame_size)
+
+        if frame_data is None:
+            return None
+
+        return json.loads(frame_data)
+
+    def send_frame(self, socket_connection, data):
+        """Encode data as a frame and send it
+        
+        Parameters:
+            socket_connection -- The socket connection
+            data -- The data to send
+        """
+        encoded_data = json.dumps(data).encode('utf-8')
+
+        socket_connection.sendall(self.FRAME_HEADER.pack(len(encoded_data)) + encoded_data)
+
+    def open_push_channel(self):
+        """Open the push channel to the server and identify the client with its access token
+
+        Returns:
+            The socket connection of the push channel
+        """
+        # The certificate of the server is not verified, like for the requests to the API
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+        raw_connection = socket.create_connection((Servers_Info.SERVER_IP.value, self.PUSH_PORT), timeout=self.CONNECT_TIMEOUT_IN_SECONDS)
+
+        try:
+            socket_connection = ssl_context.wrap_socket(raw_connection)
+            socket_connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # Detect a server that disappeared
+
+            self.send_frame(socket_connection, {'info_type': "push_channel_hello", 'access_token': self.parameters.access_token_server})
+            socket_connection.settimeout(None)
+
+        except Exception:
+            raw_connection.close()
+            raise
+
+        return socket_connection
+
+    def keep_push_channel_open(self):
+        """Receive the information sent by the server through the push channel, opening it again when it is closed"""
+        while not self.listen_for_information_stop_event.is_set():
+            is_ready = False
+
+            try:
+                socket_connection = self.open_push_channel()
+
+                with self.push_channel_lock:
+                    if self.listen_for_information_stop_event.is_set():
+                        socket_connection.close()
+                        break
+
+                    self.push_channel = socket_connection
+
+                while True:
+                    received_data_json = self.receive_frame(socket_connection)
+
+                    if received_data_json is None:
+                        break
+
+                    if received_data_json.get('info_type') == "push_channel_ready":
+                        is_ready = True
+                        Logs().write_new_log(logging.INFO, "PUSH CHANNEL OPENED")
+                        continue
+
+                    # Handle the information in a new thread, the next frames are received meanwhile
+                    threading.Thread(target=self.handle_received_data, args=(received_data_json,)).start()
+
+            except (OSError, ValueError) as e:
+                print(f"Error on push channel: {e}")
+
+            finally:
+                with self.push_channel_lock:
+                    if self.push_channel is not None:
+                        self.push_channel.close()
+                        self.push_channel = None
+
+            if self.listen_for_information_stop_event.is_set():
+                break
+
+            Logs().write_new_log(logging.INFO, "PUSH CHANNEL CLOSED")
+
+            if not is_ready:  # The server refused the access token
+                self.requests_sender.refresh_access_token()
+
+            self.listen_for_information_stop_event.wait(self.RECONNECT_DELAY_IN_SECONDS)
 
     def listen_for_information(self):
         """Listen for incoming socket connections and handle the data"""
@@ -106,6 +330,7 @@ class SocketHandler():
         Logs().write_new_log(logging.INFO, "RECEIVED DATA VIA SOCKET")
 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE)  # Inherited by the accepted connections
             s.bind(('0.0.0.0', 3125))
             s.listen(1)
             while not self.listen_for_information_stop_event.is_set():
@@ -11,10 +11,13 @@ import shutil
 import json
 import bsdiff4
 import codecs
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 
 from Parameters import Parameters
+from Background.Payload import PayloadWriter, create_payload_file_name, get_payload_size, encode_payload, remove_payload, MANIFEST_FILE_NAME
 
 import logging
 from Logs import Logs
@@ -29,6 +32,15 @@ from inc.server_info_inc import Servers_Info
 class TorrentHandler:
     _instance = None
 
+    LISTEN_PORT = 6881  # Port on which every client accepts Bittorrent connections
+
+    # Piece size of the created torrents, a power of two chosen so a payload has about TARGET_PIECES_COUNT pieces
+    MIN_PIECE_SIZE = 16 * 1024
+    MAX_PIECE_SIZE = 4 * 1024 * 1024
+    TARGET_PIECES_COUNT = 1024
+
+    INLINE_PAYLOAD_MAX_SIZE = 64 * 1024  # Payloads up to this size are sent through the relay server instead of a torrent
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(TorrentHandler, cls).__new__(cls)
@@ -50,6 +62,17 @@ class TorrentHandler:
             from Background.DiffApplier import DiffApplier
             self.diff_applier = DiffApplier()
 
+            # One libtorrent session is shared by every transfer, it is created on the first one
+            self.ses = None
+            self.session_lock = threading.Lock()
+            self.known_peers = set()  # Addresses of the clients met in previous transfers
+
+            from Background.TransferManager import TransferManager
+            self.transfer_manager = TransferManager()
+
+            # The payloads are hashed and published one after the other, without blocking the thread that wrote them
+            self.publish_executor = ThreadPoolExecutor(max_workers=1)
+
             Logs().write_new_log(logging.INFO, "INITIALIZED CLIENT TORRENT HANDLER")
 
             print("CLIENT TORRENTHANDLER INITIALIZED")
@@ -58,47 +81,107 @@ class TorrentHandler:
         """Set the session settings for libtorrent."""
 
         self.session_settings = {
-            'listen_interfaces': f"{self.parameters.current_client.ip_address}:6881",
+            'listen_interfaces': f"{self.parameters.current_client.ip_address}:{self.LISTEN_PORT}",
             'request_timeout': 5,
             'peer_timeout': 15, 
             'min_reconnect_time': 5,
             'min_announce_interval': 15,
-            'local_upload_rate_limit': self.parameters.current_client.upload_limit,
-            'local_download_rate_limit': self.parameters.current_client.download_limit,
+            'upload_rate_limit': self.parameters.current_client.upload_limit,  # 0 means unlimited
+            'download_rate_limit': self.parameters.current_client.download_limit,
+            # Alerts used by the transfer manager
+            'alert_mask': lt.alert.category_t.status_notification | lt.alert.category_t.error_notification | lt.alert.category_t.piece_progress_notification,
         }
 
-        if self.parameters.current_client.upload_limit != 0:
-            self.session_settings['local_upload_rate_limit'] = self.parameters.current_client.upload_limit
+        Logs().write_new_log(logging.INFO, "SESSION SETTINGS SET")
 
-        if self.parameters.current_client.download_limit != 0:
-            self.session_settings['local_download_rate_limit'] = self.parameters.current_client.download_limit
+    def get_session(self):
+        """Get the libtorrent session shared by the transfers, creating it if needed"""
+        with self.session_lock:
+            if self.ses is None:
+                self.set_session_settings()
+                self.ses = lt.session(self.session_settings)
 
-        Logs().write_new_log(logging.INFO, "SESSION SETTINGS SET")
+                Logs().write_new_log(logging.INFO, "STARTED LIBTORRENT SESSION")
+
+            return self.ses
+
+    def apply_session_settings(self):
+        """Apply the settings of the current client to the running session, e.g. after the rate limits were changed"""
+        with self.session_lock:
+            self.set_session_settings()
+
+            if self.ses is not None:
+                self.ses.apply_settings(self.session_settings)
+
+                Logs().write_new_log(logging.INFO, "APPLIED SETTINGS TO LIBTORRENT SESSION")
+
+    def close_session(self):
+        """Stop the shared session and every torrent in it"""
+        self.transfer_manager.stop()
+
+        with self.session_lock:
+            if self.ses is not None:
+                self.ses.pause()
+                self.ses = None
+
+                Logs().write_new_log(logging.INFO, "STOPPED LIBTORRENT SESSION")
+
+    def add_torrent_to_session(self, torrent_params):
+        """Add a torrent to the shared session and connect it directly to the clients already known
+        
+        Parameters:
+            torrent_params -- The parameters of the torrent (libtorrent.add_torrent_params or dictionary)"""
+        handle = self.get_session().add_torrent(torrent_params)
+
+        for peer_address in self.known_peers:  # Do not wait for the tracker announce to find the other clients
+            handle.connect_peer(peer_address)
+
+        return handle
+
+    def remove_torrent_from_session(self, handle):
+        """Remember the peers of a torrent and remove it from the shared session
+        
+        Parameters:
+            handle -- The handle of the torrent"""
+        for peer in handle.get_peer_info():
+            self.known_peers.add((peer.ip[0], self.LISTEN_PORT))
+
+        self.get_session().remove_torrent(handle)
 
-    def generate_data_to_send_and_torrent(self, changes, changes_type, connecting_client=0):
-        """Generate the JSON that will be seeded and downloaded. Also generate the torrent metadata and the magnet link.
+    def create_payload_writer(self):
+        """Create the writer of the binary payload that will be seeded and downloaded. The changes are fed to it one entry at a time"""
+        Logs().write_new_log(logging.INFO, "CREATING TORRENTED PAYLOAD FILE")
+
+        return PayloadWriter(self.parameters.current_client.torrent_directory / create_payload_file_name())
+
+    def generate_data_to_send_and_torrent(self, payload_writer, changes_type, connecting_client=0):
+        """Finish the payload that will be seeded and downloaded. The torrent metadata and the magnet link are then generated
+        on the publishing thread.
         
         Parameters:
-            changes -- The changes to be applied.
+            payload_writer -- The writer to which the changes were fed.
             changes_type -- The type of changes to be applied later (block or patch).
             connecting_client -- The ID of the client that is connecting for the block-level synchronization"""
-        self.main_gui.ui.label_sync_state.setText("Generating a new torrent...")
+        # Write the manifest of the changes, the payload does not change anymore after it
+        payload_writer.close(changes_type, time.time())
 
-        # Create the JSON object containing changes
-        file_to_send_via_torrent = {
-            'changes_type': changes_type,
-            'changes': changes,
-            'creation_timestamp': time.time(),
-        }
+        self.publish_executor.submit(self.publish_payload, payload_writer.payload_path, changes_type, connecting_client)
+
+    def publish_payload(self, payload_path, changes_type, connecting_client=0):
+        """Generate the torrent metadata and the magnet link of a payload, send the magnet link and seed the payload.
+        
+        Parameters:
+            payload_path -- The path of the payload directory.
+            changes_type -- The type of changes to be applied later (block or patch).
+            connecting_client -- The ID of the client that is connecting for the block-level synchronization"""
+        if get_payload_size(payload_path) <= self.INLINE_PAYLOAD_MAX_SIZE:
+            self.send_inline_payload(payload_path, changes_type, connecting_client)
+            return
 
-        Logs().write_new_log(logging.INFO, "CREATING TORRENTED JSON FILE")
-        # Write the JSON to a file
-        json_path = self.parameters.current_client.torrent_directory / "foxync-torrent.json"
-        with open(json_path, "w") as file:
-            json.dump(file_to_send_via_torrent, file, indent=4)
+        self.main_gui.ui.label_sync_state.setText("Generating a new torrent...")
 
         # Generate the torrent metadata and the magnet link
-        magnet_link, torrent_info = self.create_torrent_info_and_magnet_link(json_path)
+        magnet_link, torrent_info = self.create_torrent_info_and_magnet_link(payload_path)
         Logs().write_new_log(logging.INFO, "GENERATED TORRENT METADATA AND MAGNET LINK")
 
         # Send the magnet link to the server based on the change type
@@ -107,25 +190,53 @@ class TorrentHandler:
         elif changes_type == "block":
             self.requests_sender.send_to_server_magnet_link_with_blocks(changes_type, magnet_link, connecting_client)
 
-        # Seed the torrent for clients
+        # Seed the torrent for clients, until every client downloaded it
         self.seed_from_torrent_info(torrent_info)
 
-    def create_torrent_info_and_magnet_link(self, json_path):
+    def send_inline_payload(self, payload_path, changes_type, connecting_client=0):
+        """Send a small payload directly through the relay server, without creating, announcing and seeding a torrent.
+        
+        Parameters:
+            payload_path -- The path of the payload directory.
+            changes_type -- The type of changes to be applied later (block or patch).
+            connecting_client -- The ID of the client that is connecting for the block-level synchronization"""
+        self.main_gui.ui.label_sync_state.setText("Sending modifications...")
+
+        self.requests_sender.send_to_server_inline_payload(changes_type, encode_payload(payload_path), connecting_client)
+        remove_payload(payload_path)
+
+        Logs().write_new_log(logging.INFO, "SENT INLINE PAYLOAD")
+
+        self.main_gui.ui.label_sync_state.setText("Synchronized")
+        self.main_gui.update_last_synchronization_date()
+
+    def get_piece_size(self, payload_size):
+        """Get the piece size of the torrent of a payload
+        
+        Parameters:
+            payload_size -- The total size of the files of the payload"""
+        piece_size = self.MIN_PIECE_SIZE
+
+        while piece_size < self.MAX_PIECE_SIZE and payload_size > piece_size * self.TARGET_PIECES_COUNT:
+            piece_size *= 2
+
+        return piece_size
+
+    def create_torrent_info_and_magnet_link(self, payload_path):
         """Generate the torrent metadata and the magnet link."""
         fs = lt.file_storage()
 
-        # Get file size and construct the relative path
-        size = json_path.stat().st_size
-        parent_directory = os.path.basename(self.parameters.current_client.torrent_directory)
-        relative_path = os.path.join(parent_directory, os.path.relpath(json_path, self.parameters.current_client.torrent_directory))
-        fs.add_file(relative_path, size)
+        # One file in the torrent for the manifest and for each segments file, named "<payload directory>/<file>".
+        # The manifest comes first, so a client downloading the pieces in order can start applying the payload early
+        for file_name in [MANIFEST_FILE_NAME] + sorted(file.name for file in payload_path.iterdir() if file.name != MANIFEST_FILE_NAME):
+            fs.add_file(f"{payload_path.name}/{file_name}", (payload_path / file_name).stat().st_size)
 
         # Create the torrent
-        torrent = lt.create_torrent(fs, flags=lt.create_torrent.v2_only) # Creating the torrent using only the Bittorrent v2 protocol
+        torrent = lt.create_torrent(fs, piece_size=self.get_piece_size(fs.total_size()), flags=lt.create_torrent.v2_only) # Creating the torrent using only the Bittorrent v2 protocol
         torrent.set_creator(self.parameters.current_client.name) # Creator of the torrent
         tracker_url = f"http://{Servers_Info.TRACKER_IP.value}:{Servers_Info.TRACKER_PORT.value}/announce?client_id={self.parameters.current_client.client_id}" # Tracker that will organize the torrenting
         torrent.add_tracker(tracker_url)
-        lt.set_piece_hashes(torrent, str(self.parameters.current_client.torrent_directory.parent)) # Set the piece hashes of the torrent
+        lt.set_piece_hashes(torrent, str(payload_path.parent)) # Set the piece hashes of the torrent. The payload is read and hashed synchronously, on the thread publishing the changes
         torrent_data = torrent.generate()
         torrent_info = lt.torrent_info(torrent_data)
 
@@ -145,26 +256,17 @@ class TorrentHandler:
             print("Invalid magnet link")
             return
 
-        self.set_session_settings()
-
-        # Initialize libtorrent session
-        self.ses = lt.session(self.session_settings)
+        self.parameters.current_client.torrent_directory = Path(self.parameters.current_client.torrent_directory)
+        self.parameters.current_client.user_directory = Path(self.parameters.current_client.user_directory)
 
         # Parse the magnet link
         torrent_params = lt.parse_magnet_uri(magnet_link)
         torrent_params.save_path = str(self.parameters.current_client.torrent_directory)
-        handle = self.ses.add_torrent(torrent_params)
-
-        # Start downloading the torrent
-        self.operate_torrent(handle)
-
-        # Apply the changes from the downloaded torrent
-        self.parameters.current_client.torrent_directory = Path(self.parameters.current_client.torrent_directory)
-        self.parameters.current_client.user_directory = Path(self.parameters.current_client.user_directory)
+        torrent_params.flags |= lt.torrent_flags.sequential_download  # The pieces are applied in the order of the payload
+        handle = self.add_torrent_to_session(torrent_params)
 
-        json_path = self.parameters.current_client.torrent_directory / "foxync-torrent.json"
-
-        self.diff_applier.apply_downloaded_torrent(json_path)
+        # The transfer manager applies the changes once the download is complete
+        self.transfer_manager.add_transfer(handle, torrent_params.save_path, is_download=True)
 
     def seed_from_torrent_info(self, torrent_info=None):
         """Seed the torrent metadata for clients receiving the magnet link.
@@ -180,55 +282,16 @@ class TorrentHandler:
             Logs().write_new_log(logging.ERROR, "NO TORRENT METADATA TO SEED")
             return
 
-        self.set_session_settings()
-
-        # Initialize libtorrent session
-        self.ses = lt.session(self.session_settings)
-
         # Add metadata and start seeding
-        handle = self.ses.add_torrent({'ti': torrent_info, 'save_path': str(self.parameters.current_client.torrent_directory)})
-        self.operate_torrent(handle)
+        save_path = str(self.parameters.current_client.torrent_directory)
+        handle = self.add_torrent_to_session({'ti': torrent_info, 'save_path': save_path})
 
-        # Notify the user and clean up
-        self.main_gui.ui.label_sync_state.setText("Synchronized")
-        json_path = self.parameters.current_client.torrent_directory / "foxync-torrent.json"
-        os.remove(json_path)
+        # The transfer manager stops the seeding and deletes the payload once every client downloaded it
+        self.transfer_manager.add_transfer(handle, save_path, is_download=False)
 
-    def operate_torrent(self, handle):
-        """Interact with the torrent by downloading or seeding it.
+    def complete_seeding(self, info_hash=None):
+        """Stop seeding a torrent that every client downloaded
         
         Parameters:
-            handle (libtorrent.torrent_handle): The handle of the torrent to operate on.
-        """
-
-        self.parameters.keep_seeding = True
-        sent_completion = False
-
-        states_list = ['queued', 'checking', 'downloading metadata', 'downloading', 'finished', 'seeding', 'allocating', 'checking fastresume']
-        
-        while self.parameters.keep_seeding:
-            # Get and display the torrent status
-            status = handle.status()
-            progress_in_percentage = status.progress * 100
-
-            time.sleep(0.1) # Add a bit of time between update of progress_in_percentage and its use in the progress bar
-
-            # Update the progress bar
-            self.main_gui.ui.progressbar_sync.setValue(int(progress_in_percentage))
-
-            if status.progress < 1:
-                # Display download progress
-                output = '%s\r%.2f%% complete (Download: %.1f kb/s, Upload: %.1f kB/s)' % (
-                    states_list[status.state].capitalize(), progress_in_percentage, status.download_rate / 1000, status.upload_rate / 1000)
-                self.main_gui.ui.label_sync_state.setText(output)
-
-            else:
-                # Display seeding status
-                if not sent_completion:
-                    Logs().write_new_log(logging.INFO, "DONE DOWNLOADING, STARTING SEEDING")
-                    self.main_gui.ui.label_sync_state.setText("Seeding")
-                    sent_completion = True
-                    self.requests_sender.send_to_tracker_torrent_completion(handle.info_hash())
-
-        Logs().write_new_log(logging.INFO, "DONE SEEDING")
-        self.main_gui.update_last_synchronization_date()
\ No newline at end of file
+            info_hash -- The info hash of the torrent, or None to stop every complete torrent"""
+        self.transfer_manager.complete_seeding(info_hash)
@@ -0,0 +1,347 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import libtorrent as lt
+import threading
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from Parameters import Parameters
+from Background.Payload import get_payload_path, remove_payload, create_payload_file_name, decode_payload, MANIFEST_FILE_NAME
+
+import sys
+parent_directory = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(parent_directory))
+
+import logging
+from Logs import Logs
+
+class TransferManager:
+    """
+    The TransferManager class tracks every torrent of the shared libtorrent session. A single thread waits for the
+    libtorrent alerts and completes each torrent independently, so several change sets can be seeded and downloaded
+    at the same time. Downloaded payloads are applied one after the other. A payload directory is applied while it is
+    downloaded: its pieces arrive in order and the applier waits for the pieces of each content to be verified.
+    """
+
+    _instance = None
+
+    ALERT_WAIT_IN_MILLISECONDS = 500  # Maximum time waiting for an alert before the progress is updated again
+    PIECE_WAIT_IN_SECONDS = 1  # Maximum time the applier waits for a piece before checking if the transfer was stopped
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(TransferManager, cls).__new__(cls)
+
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            self.initialized = True
+
+            self.parameters = Parameters()
+
+            from Background.TorrentHandler import TorrentHandler
+            self.torrent_handler = TorrentHandler()
+
+            from Background.RequestsSender import RequestsSender
+            self.requests_sender = RequestsSender()
+
+            from Background.DiffApplier import DiffApplier
+            self.diff_applier = DiffApplier()
+
+            from GUI.Main import Main
+            self.main_gui = Main()
+
+            self.transfers = {}  # Info hash -> {'info_hash', 'handle', 'is_download', 'save_path', 'is_finished', 'progress', 'finished_pieces', 'is_applying'}
+            self.transfers_lock = threading.Lock()
+            self.pieces_condition = threading.Condition(self.transfers_lock)  # Notified when pieces are verified
+
+            self.apply_executor = ThreadPoolExecutor(max_workers=1)  # The payloads must not be applied concurrently
+
+            self.alert_thread = None
+            self.stop_event = threading.Event()
+
+            Logs().write_new_log(logging.INFO, "INITIALIZED CLIENT TRANSFER MANAGER")
+
+            print("CLIENT TRANSFERMANAGER INITIALIZED")
+
+    def get_info_hash_string(self, handle):
+        """Get the info hash of a torrent as it is sent to the tracker
+
+        Parameters:
+            handle -- The handle of the torrent"""
+        return str(handle.info_hash())
+
+    def add_transfer(self, handle, save_path, is_download):
+        """Start tracking a torrent of the shared session
+
+        Parameters:
+            handle -- The handle of the torrent
+            save_path -- The directory in which the payload of the torrent is saved
+            is_download -- Indicates if the payload is downloaded, and has to be applied once it is complete"""
+        with self.transfers_lock:
+            self.transfers[self.get_info_hash_string(handle)] = {
+                'info_hash': self.get_info_hash_string(handle),
+                'handle': handle,
+                'is_download': is_download,
+                'save_path': Path(save_path),
+                'is_finished': False,
+                'progress': 0,
+                'finished_pieces': set(),
+                'is_applying': False
+            }
+
+        if self.alert_thread is None or not self.alert_thread.is_alive():
+            self.stop_event.clear()
+            self.alert_thread = threading.Thread(target=self.handle_alerts, daemon=True)
+            self.alert_thread.start()
+
+        Logs().write_new_log(logging.INFO, f"ADDED {'DOWNLOAD' if is_download else 'SEED'} TRANSFER")
+
+    def stop(self):
+        """Stop waiting for alerts"""
+        self.stop_event.set()
+
+        if self.alert_thread is not None and self.alert_thread.is_alive():
+            self.alert_thread.join()
+
+        with self.pieces_condition:  # Wake up the applier waiting for pieces
+            self.pieces_condition.notify_all()
+
+    def handle_alerts(self):
+        """Wait for the alerts of the session and dispatch them to the transfers"""
+        session = self.torrent_handler.get_session()
+
+        while not self.stop_event.is_set():
+            session.post_torrent_updates()  # Ask for a state_update_alert with the status of the torrents that changed
+            session.wait_for_alert(self.ALERT_WAIT_IN_MILLISECONDS)
+
+            for alert in session.pop_alerts():
+                if isinstance(alert, lt.piece_finished_alert):
+                    self.add_finished_piece(alert.handle, alert.piece_index)
+
+                elif isinstance(alert, lt.metadata_received_alert):
+                    self.start_applying_while_downloading(alert.handle)
+
+                elif isinstance(alert, lt.torrent_finished_alert):
+                    self.finish_transfer(alert.handle)
+
+                elif isinstance(alert, lt.state_update_alert):
+                    self.update_progress(alert.status)
+
+                elif isinstance(alert, (lt.torrent_error_alert, lt.file_error_alert)):
+                    Logs().write_new_log(logging.ERROR, f"TORRENT ERROR: {alert.message()}")
+
+    def update_progress(self, torrents_status):
+        """Update the progress of the transfers and display it
+
+        Parameters:
+            torrents_status -- The status of the torrents that changed"""
+        finished_handles = []
+
+        with self.transfers_lock:
+            for status in torrents_status:
+                transfer = self.transfers.get(self.get_info_hash_string(status.handle))
+
+                if transfer is None:
+                    continue
+
+                transfer['progress'] = status.progress
+
+                if status.progress >= 1 and not transfer['is_finished']:  # Seeds added complete do not always post a torrent_finished_alert
+                    finished_handles.append(status.handle)
+
+            downloads_progress = [transfer['progress'] for transfer in self.transfers.values() if transfer['is_download'] and not transfer['is_finished']]
+
+        for handle in finished_handles:
+            self.finish_transfer(handle)
+
+        if not downloads_progress:
+            return
+
+        self.main_gui.ui.progressbar_sync.setValue(int(sum(downloads_progress) / len(downloads_progress) * 100))
+
+        output = "Downloading " + ", ".join(f"{progress * 100:.2f}%" for progress in downloads_progress)
+        self.main_gui.ui.label_sync_state.setText(output)
+
+    def add_finished_piece(self, handle, piece_index):
+        """Remember that a piece was downloaded and verified, and wake up the applier
+
+        Parameters:
+            handle -- The handle of the torrent
+            piece_index -- The index of the piece"""
+        with self.pieces_condition:
+            transfer = self.transfers.get(self.get_info_hash_string(handle))
+
+            if transfer is not None:
+                transfer['finished_pieces'].add(piece_index)
+                self.pieces_condition.notify_all()
+
+    def start_applying_while_downloading(self, handle):
+        """Start applying a downloaded payload as soon as its metadata is known, if its layout allows it
+
+        Parameters:
+            handle -- The handle of the torrent"""
+        files = handle.torrent_file().files()
+
+        with self.transfers_lock:
+            transfer = self.transfers.get(self.get_info_hash_string(handle))
+
+            if transfer is None or not transfer['is_download']:
+                return
+
+            payload_path = get_payload_path(transfer['save_path'], files.file_path(0))
+
+            # Only payload directories starting with their manifest can be read before they are complete
+            if Path(files.file_path(0)) != Path(payload_path.name) / MANIFEST_FILE_NAME:
+                return
+
+            transfer['is_applying'] = True
+            transfer['files_indexes'] = {Path(files.file_path(index)).name: index for index in range(files.num_files())}
+
+        Logs().write_new_log(logging.INFO, "APPLYING PAYLOAD WHILE DOWNLOADING")
+
+        self.apply_executor.submit(self.apply_transfer, transfer, payload_path)
+
+    def get_pieces_of_range(self, transfer, file_name, offset, length):
+        """Get the pieces containing a range of bytes of a file of the payload
+
+        Parameters:
+            transfer -- The transfer of the payload
+            file_name -- The name of the file in the payload directory
+            offset -- The position of the range in the file
+            length -- The length of the range, or None for the rest of the file"""
+        files = transfer['handle'].torrent_file().files()
+        file_index = transfer['files_indexes'][file_name]
+
+        if length is None:
+            length = files.file_size(file_index) - offset
+
+        if length == 0:
+            return range(0)
+
+        # The files of a v2 torrent are aligned on pieces, a piece only contains the bytes of one file
+        starting_byte = files.file_offset(file_index) + offset
+        piece_length = files.piece_length()
+
+        return range(starting_byte // piece_length, (starting_byte + length - 1) // piece_length + 1)
+
+    def wait_for_range(self, transfer, file_name, offset, length):
+        """Wait until a range of bytes of a file of the payload is downloaded and verified
+
+        Parameters:
+            transfer -- The transfer of the payload
+            file_name -- The name of the file in the payload directory
+            offset -- The position of the range in the file
+            length -- The length of the range, or None for the rest of the file"""
+        pieces = self.get_pieces_of_range(transfer, file_name, offset, length)
+
+        with self.pieces_condition:
+            while not transfer['is_finished'] and not transfer['finished_pieces'].issuperset(pieces):
+                if self.stop_event.is_set() or self.transfers.get(transfer['info_hash']) is not transfer:
+                    raise RuntimeError("The transfer stopped before the payload was downloaded")
+
+                self.pieces_condition.wait(self.PIECE_WAIT_IN_SECONDS)
+
+    def apply_transfer(self, transfer, payload_path):
+        """Apply a payload, waiting for its pieces if it is still downloaded
+
+        Parameters:
+            transfer -- The transfer of the payload
+            payload_path -- The path of the payload"""
+        wait_for_range = functools.partial(self.wait_for_range, transfer) if transfer['is_applying'] else None
+
+        try:
+            self.diff_applier.apply_downloaded_torrent(payload_path, wait_for_range)
+
+        except Exception as e:
+            Logs().write_new_log(logging.ERROR, f"COULD NOT APPLY PAYLOAD: {e}")
+
+    def apply_inline_payload(self, payload_files):
+        """Apply a small payload received without torrent, after the payloads already queued
+
+        Parameters:
+            payload_files -- The dictionary of the names of the files of the payload and their base64 content"""
+        payload_path = Path(self.parameters.current_client.torrent_directory) / create_payload_file_name()
+        decode_payload(payload_files, payload_path)
+
+        self.apply_executor.submit(self.apply_and_remove_inline_payload, payload_path)
+
+    def apply_and_remove_inline_payload(self, payload_path):
+        """Apply a small payload received without torrent and delete it
+
+        Parameters:
+            payload_path -- The path of the payload directory"""
+        try:
+            self.diff_applier.apply_downloaded_torrent(payload_path)
+            self.main_gui.update_last_synchronization_date()
+
+        except Exception as e:
+            Logs().write_new_log(logging.ERROR, f"COULD NOT APPLY INLINE PAYLOAD: {e}")
+
+        finally:
+            remove_payload(payload_path)
+
+    def finish_transfer(self, handle):
+        """Tell the tracker that a torrent is complete, and apply it if it was downloaded. The torrent keeps seeding
+
+        Parameters:
+            handle -- The handle of the torrent"""
+        info_hash = self.get_info_hash_string(handle)
+
+        with self.transfers_lock:
+            transfer = self.transfers.get(info_hash)
+
+            if transfer is None or transfer['is_finished']:
+                return
+
+            transfer['is_finished'] = True
+            self.pieces_condition.notify_all()
+
+        Logs().write_new_log(logging.INFO, "DONE DOWNLOADING, STARTING SEEDING")
+        self.main_gui.ui.label_sync_state.setText("Seeding")
+        self.requests_sender.send_to_tracker_torrent_completion(handle.info_hash())
+
+        if transfer['is_download'] and not transfer['is_applying']:  # The payload could not be applied while it was downloaded
+            payload_path = get_payload_path(transfer['save_path'], handle.torrent_file().files().file_path(0))
+            self.apply_executor.submit(self.apply_transfer, transfer, payload_path)
+
+    def complete_seeding(self, info_hash=None):
+        """Stop seeding the torrents that every client downloaded, and delete their payload
+
+        Parameters:
+            info_hash -- The info hash of the torrent, or None to stop every torrent that finished (older servers do not send it)"""
+        with self.transfers_lock:
+            if info_hash is None:
+                info_hashes = [transfer_info_hash for transfer_info_hash, transfer in self.transfers.items() if transfer['is_finished']]
+            else:
+                info_hashes = [info_hash] if info_hash in self.transfers else []
+
+            transfers = [self.transfers.pop(transfer_info_hash) for transfer_info_hash in info_hashes]
+            has_remaining_transfers = bool(self.transfers)
+
+        for transfer in transfers:
+            handle = transfer['handle']
+            payload_path = get_payload_path(transfer['save_path'], handle.torrent_file().files().file_path(0))
+
+            self.torrent_handler.remove_torrent_from_session(handle)
+
+            if transfer['is_download']:  # The payload may still be read by the applier, it is removed after it
+                self.apply_executor.submit(remove_payload, payload_path)
+            else:
+                remove_payload(payload_path)
+
+            Logs().write_new_log(logging.INFO, "DONE SEEDING")
+
+        if not transfers:
+            return
+
+        if not has_remaining_transfers:
+            self.main_gui.ui.label_sync_state.setText("Synchronized")
+
+        self.main_gui.update_last_synchronization_date()
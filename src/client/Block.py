@@ -8,7 +8,7 @@ class Block(File):
     It includes additional attributes specific to blocks such as block number, starting byte, and block size.
     """
 
-    def __init__(self, is_dir=0, file_rel_path=0, content_bytes=0, block_number=0, hash_var=0, starting_byte=0, block_size=0):
+    def __init__(self, is_dir=0, file_rel_path=0, content_bytes=0, block_number=0, hash_var=0, starting_byte=0, block_size=0, source_starting_byte=None, weak_hash=None):
         """
         Initialize a new Block object.
         
@@ -20,10 +20,14 @@ class Block(File):
         hash_var -- The hash of the block.
         starting_byte -- The starting byte position of this block within the file.
         block_size -- The size of the block.
+        source_starting_byte -- The starting byte of the same content in the file of the receiving client, when the content does not need to be sent.
+        weak_hash -- The Adler-32 of the block, to find it at any offset of the file of the sending client.
         """
         self.block_number = block_number
         self.starting_byte = starting_byte
         self.block_size = block_size
+        self.source_starting_byte = source_starting_byte
+        self.weak_hash = weak_hash
 
         # Call the constructor of the parent class File
         super().__init__(is_dir, file_rel_path, content_bytes, hash_var)
@@ -42,7 +46,9 @@ class Block(File):
             "block_number": self.block_number,
             "hash": self.hash,
             "starting_byte": self.starting_byte,
-            "block_size": self.block_size
+            "block_size": self.block_size,
+            "source_starting_byte": self.source_starting_byte,
+            "weak_hash": self.weak_hash
         }
 
     @classmethod
@@ -57,4 +63,4 @@ class Block(File):
         A Block object created from the provided dictionary.
         """
         Logs().write_new_log(logging.INFO, "CREATING BLOCK AS OBJECT")
-        return cls(block_dict["is_dir"], block_dict["file_rel_path"], block_dict["content_bytes"], block_dict["block_number"], block_dict["hash"], block_dict["starting_byte"], block_dict["block_size"])
\ No newline at end of file
+        return cls(block_dict["is_dir"], block_dict["file_rel_path"], block_dict["content_bytes"], block_dict["block_number"], block_dict["hash"], block_dict["starting_byte"], block_dict["block_size"], block_dict.get("source_starting_byte"), block_dict.get("weak_hash"))
\ No newline at end of file
@@ -3,6 +3,9 @@ import logging
 from Logs import Logs
 
 class Client:
+    DEFAULT_QUIET_WINDOW_IN_SECONDS = 2  # Time without new change before the changes are published
+    DEFAULT_MAX_BATCH_SIZE = 1000  # Number of changed files after which the changes are published without waiting
+
     def __init__(self, client):
         self.client_id = client["client_id"]
         self.name = client["name"]
@@ -17,6 +20,8 @@ class Client:
         self.interval_in_seconds_check = client["interval_in_seconds_check"]
         self.upload_limit = client["upload_limit"]
         self.download_limit = client["download_limit"]
+        self.quiet_window_in_seconds = client.get("quiet_window_in_seconds") or self.DEFAULT_QUIET_WINDOW_IN_SECONDS
+        self.max_batch_size = client.get("max_batch_size") or self.DEFAULT_MAX_BATCH_SIZE
         self.user_is_authenticated = client["user_is_authenticated"]
         self.user_id = client["user_id"]
 
@@ -43,6 +48,8 @@ class Client:
             "interval_in_seconds_check": self.interval_in_seconds_check,
             "upload_limit": self.upload_limit,
             "download_limit": self.download_limit,
+            "quiet_window_in_seconds": self.quiet_window_in_seconds,
+            "max_batch_size": self.max_batch_size,
             "user_id": self.user_id
         }
 
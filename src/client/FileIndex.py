@@ -0,0 +1,206 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+
+import logging
+from Logs import Logs
+
+TEMPORARY_FILE_SUFFIX = ".foxync-tmp"  # Suffix of the files being written by the client, they are never indexed
+
+class FileIndex:
+    """
+    The FileIndex class keeps, for every path of the user directory, the stat tuple (size, mtime_ns, inode)
+    and the content hash found during the last scan. The index is persisted on disk, so a scan only has to stat
+    the files and only re-hashes the ones whose stat tuple changed.
+    """
+
+    INDEX_FILE_NAME = "foxync-index.json"
+    HASH_READ_SIZE = 1024 * 1024  # Size of the reads when hashing a file
+
+    def __init__(self, user_directory, index_directory):
+        """
+        Initialize a new FileIndex object and load the index saved on disk, if any.
+
+        Parameters:
+        user_directory -- The directory that is indexed.
+        index_directory -- The directory in which the index is persisted.
+        """
+        self.user_directory = Path(user_directory)
+        self.index_path = Path(index_directory) / self.INDEX_FILE_NAME
+
+        self.entries = {}  # Relative path -> {'is_dir', 'size', 'mtime_ns', 'inode', 'hash'}
+        self.last_scan_ns = 0  # Time at which the last scan started
+
+        self.load()
+
+    def load(self):
+        """Load the index from the disk. The index is discarded if it was made for another user directory"""
+        try:
+            with open(self.index_path, "r") as index_file:
+                index_dict = json.load(index_file)
+
+        except (OSError, ValueError):
+            return
+
+        if index_dict.get('user_directory') != str(self.user_directory):
+            Logs().write_new_log(logging.INFO, "DISCARDED FILE INDEX OF ANOTHER USER DIRECTORY")
+            return
+
+        self.entries = index_dict['entries']
+        self.last_scan_ns = index_dict['last_scan_ns']
+
+        Logs().write_new_log(logging.INFO, "LOADED FILE INDEX")
+
+    def save(self):
+        """Save the index to the disk, replacing the previous one atomically"""
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+
+        index_dict = {
+            'user_directory': str(self.user_directory),
+            'last_scan_ns': self.last_scan_ns,
+            'entries': self.entries
+        }
+
+        temporary_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(temporary_path, "w") as index_file:
+            json.dump(index_dict, index_file)
+
+        os.replace(temporary_path, self.index_path)
+
+    def hash_file(self, file_path):
+        """Get the SHA-256 of a file, read by chunks to keep the memory usage bounded
+
+        Parameters:
+            file_path -- The full path of the file"""
+        file_hash = hashlib.sha256()
+
+        with open(file_path, "rb") as file:
+            while read_bytes := file.read(self.HASH_READ_SIZE):
+                file_hash.update(read_bytes)
+
+        return file_hash.hexdigest()
+
+    def is_entry_up_to_date(self, entry, is_dir, stat):
+        """Check if an entry of the index still describes the file
+
+        Parameters:
+            entry -- The entry of the index, or None
+            is_dir -- Indicates if the path is a directory
+            stat -- The stat result of the path"""
+        if entry is None or entry['is_dir'] != is_dir:
+            return False
+
+        if is_dir:
+            return entry['inode'] == stat.st_ino
+
+        # A file modified during the previous scan could have the same stat tuple with another content
+        if stat.st_mtime_ns >= self.last_scan_ns:
+            return False
+
+        return (entry['size'], entry['mtime_ns'], entry['inode']) == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def update_entry(self, entries, changed_files_rel_path, file_rel_path):
+        """Stat a path and re-hash it if its stat tuple changed
+
+        Parameters:
+            entries -- The entries being built by the scan
+            changed_files_rel_path -- The set of relative paths that were added or changed
+            file_rel_path -- The relative path to update"""
+        full_path = os.path.join(self.user_directory, file_rel_path)
+
+        if file_rel_path.endswith(TEMPORARY_FILE_SUFFIX):
+            return
+
+        try:
+            stat = os.stat(full_path)
+            is_dir = int(os.path.isdir(full_path))
+
+            entry = self.entries.get(file_rel_path)
+
+            if not self.is_entry_up_to_date(entry, is_dir, stat):
+                entry = {
+                    'is_dir': is_dir,
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'inode': stat.st_ino,
+                    'hash': 0 if is_dir else self.hash_file(full_path)
+                }
+                changed_files_rel_path.add(file_rel_path)
+
+        except OSError:  # The file was removed or is not readable anymore
+            entries.pop(file_rel_path, None)
+            return
+
+        entries[file_rel_path] = entry
+
+    def update_subtree(self, entries, changed_files_rel_path, directory_rel_path=None):
+        """Stat every path below a directory of the user directory
+
+        Parameters:
+            entries -- The entries being built by the scan
+            changed_files_rel_path -- The set of relative paths that were added or changed
+            directory_rel_path -- The relative path of the directory, or None for the whole user directory"""
+        top_directory = self.user_directory if directory_rel_path is None else self.user_directory / directory_rel_path
+
+        for directory_path, directories_names, files_names in os.walk(top_directory):
+            for name in directories_names + files_names:
+                if name.endswith(TEMPORARY_FILE_SUFFIX):
+                    continue
+
+                file_rel_path = os.path.relpath(os.path.join(directory_path, name), self.user_directory)
+                self.update_entry(entries, changed_files_rel_path, file_rel_path)
+
+    def scan(self, dirty_paths=None):
+        """Stat the paths of the user directory and re-hash the files whose stat tuple changed
+
+        Parameters:
+            dirty_paths -- Relative paths reported as changed by the change watcher. If None, the whole user directory is scanned
+
+        Returns:
+            The entries of the index and the set of relative paths that were added or changed since the last scan
+        """
+        scan_start_ns = time.time_ns()
+        changed_files_rel_path = set()
+
+        if dirty_paths is None:
+            Logs().write_new_log(logging.INFO, "SCANNING USER DIRECTORY WITH FILE INDEX")
+
+            entries = {}
+            self.update_subtree(entries, changed_files_rel_path)
+
+        else:
+            Logs().write_new_log(logging.INFO, f"SCANNING {len(dirty_paths)} DIRTY PATHS WITH FILE INDEX")
+
+            # Forget the dirty paths and everything below them, they are stat again just after
+            dirty_paths = {os.path.normpath(dirty_path) for dirty_path in dirty_paths}
+            dirty_prefixes = tuple(dirty_path + os.sep for dirty_path in dirty_paths)
+            entries = {file_rel_path: entry for file_rel_path, entry in self.entries.items()
+                       if file_rel_path not in dirty_paths and not file_rel_path.startswith(dirty_prefixes)}
+
+            for dirty_path in dirty_paths:
+                if dirty_path == os.curdir:  # The user directory itself
+                    self.update_subtree(entries, changed_files_rel_path)
+                    continue
+
+                self.update_entry(entries, changed_files_rel_path, dirty_path)
+
+                if entries.get(dirty_path, {}).get('is_dir'):
+                    self.update_subtree(entries, changed_files_rel_path, dirty_path)
+
+        has_changed = bool(changed_files_rel_path) or entries.keys() != self.entries.keys()
+
+        self.entries = entries
+        self.last_scan_ns = scan_start_ns
+
+        if has_changed:
+            self.save()
+
+        return self.entries, changed_files_rel_path
@@ -52,7 +52,8 @@ class Main:
         from Background.RequestsSender import RequestsSender
         self.requests_sender = RequestsSender()
 
-        self.requests_sender.set_client_status(self.parameters.current_client.name, self.parameters.current_client.client_id, 1, self.parameters.current_client.is_away, self.parameters.current_client.user_id)
+        if not self.parameters.take_prefetched('is_online'):  # The client is already set as online if it was bootstrapped
+            self.requests_sender.set_client_status(self.parameters.current_client.name, self.parameters.current_client.client_id, 1, self.parameters.current_client.is_away, self.parameters.current_client.user_id)
 
         self.parameters.current_client.is_online = 1
 
@@ -112,12 +113,18 @@ class Main:
 
     def stop_threads(self):
         """Stop all the threads"""
-        self.background_process.scheduler_changes.shutdown(wait=False)
+        self.background_process.stop_interval_check_for_changes()
+
+        self.background_process.patch_process.shutdown_delta_executor()
 
         self.requests_sender.scheduler_ping.shutdown(wait=False)
 
+        self.requests_sender.close_session()
+
         self.socket_handler.stop_listen_for_information_thread()
 
+        self.socket_handler.torrent_handler.close_session()
+
         Logs().write_new_log(logging.INFO, "STOPPED THREADS AND SCHEDULERS")
 
     def close_event(self, event):
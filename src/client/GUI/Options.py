@@ -27,6 +27,8 @@ class Options:
     # Singleton instance variable
     _instance = None
 
+    CHUNKING_MODES = ["fixed", "cdc"]  # Chunking modes in the order of the items of the chunking mode combobox
+
     # Override __new__ to ensure a single instance (Singleton)
     def __new__(cls):
         if cls._instance is None:
@@ -73,7 +75,10 @@ class Options:
                 "upload_limit": self.ui_options.spinbox_upload_speed_limit,
                 "download_limit": self.ui_options.spinbox_download_speed_limit,
                 "interval_in_seconds_check": self.ui_options.spinbox_interval,
+                "quiet_window_in_seconds": self.ui_options.spinbox_quiet_window,
+                "max_batch_size": self.ui_options.spinbox_max_batch_size,
                 "block_size_in_bytes": self.ui_options.spinbox_block_size,
+                "chunking_mode": self.ui_options.combobox_chunking_mode,
                 "username": self.ui_options.textbox_username,
                 "current_password": self.ui_options.textbox_current_password,
                 "password": self.ui_options.textbox_new_password,
@@ -106,7 +111,10 @@ class Options:
         self.ui_options.spinbox_upload_speed_limit.setValue(int(current_client.upload_limit / 1000))
         self.ui_options.spinbox_download_speed_limit.setValue(int(current_client.download_limit / 1000))
         self.ui_options.spinbox_interval.setValue(current_client.interval_in_seconds_check)
+        self.ui_options.spinbox_quiet_window.setValue(current_client.quiet_window_in_seconds)
+        self.ui_options.spinbox_max_batch_size.setValue(current_client.max_batch_size)
         self.ui_options.spinbox_block_size.setValue(int(current_user.block_size_in_bytes / 1000))
+        self.ui_options.combobox_chunking_mode.setCurrentIndex(self.CHUNKING_MODES.index(current_user.chunking_mode) if current_user.chunking_mode in self.CHUNKING_MODES else 0)
         self.ui_options.textbox_username.setText(current_user.username)
 
     def setup_events(self):
@@ -119,7 +127,10 @@ class Options:
         self.ui_options.spinbox_upload_speed_limit.valueChanged.connect(lambda: self.change_value('upload_limit', self.ui_options.spinbox_upload_speed_limit.value()))
         self.ui_options.spinbox_download_speed_limit.valueChanged.connect(lambda: self.change_value('download_limit', self.ui_options.spinbox_download_speed_limit.value()))
         self.ui_options.spinbox_interval.valueChanged.connect(lambda: self.change_value('interval_in_seconds_check', self.ui_options.spinbox_interval.value()))
+        self.ui_options.spinbox_quiet_window.valueChanged.connect(lambda: self.change_value('quiet_window_in_seconds', self.ui_options.spinbox_quiet_window.value()))
+        self.ui_options.spinbox_max_batch_size.valueChanged.connect(lambda: self.change_value('max_batch_size', self.ui_options.spinbox_max_batch_size.value()))
         self.ui_options.spinbox_block_size.valueChanged.connect(lambda: self.change_value('block_size_in_bytes', self.ui_options.spinbox_block_size.value() * 1000))
+        self.ui_options.combobox_chunking_mode.currentIndexChanged.connect(lambda: self.change_value('chunking_mode', self.CHUNKING_MODES[self.ui_options.combobox_chunking_mode.currentIndex()]))
         self.ui_options.textbox_username.textChanged.connect(lambda: self.change_value('username', self.ui_options.textbox_username.text()))
         self.ui_options.textbox_new_password.textChanged.connect(lambda: self.change_value('password', self.ui_options.textbox_new_password.text()))
         self.ui_options.textbox_current_password.textChanged.connect(lambda: self.change_value('current_password', self.ui_options.textbox_current_password.text()))
@@ -234,8 +245,8 @@ class Options:
         """Update the modified values in the database"""
         Logs().write_new_log(logging.INFO, "CONFIRMING CHANGES")
         # Define mappings for keys to corresponding tables
-        client_keys = {'name', 'ip_address', 'user_directory', 'auto_update_ip_address', 'is_away', 'interval_in_seconds_check', 'upload_limit', 'download_limit'}
-        user_keys = {'username', 'password', 'block_size_in_bytes'}
+        client_keys = {'name', 'ip_address', 'user_directory', 'auto_update_ip_address', 'is_away', 'interval_in_seconds_check', 'upload_limit', 'download_limit', 'quiet_window_in_seconds', 'max_batch_size'}
+        user_keys = {'username', 'password', 'block_size_in_bytes', 'chunking_mode'}
 
         # Separate values into client and user dictionaries
         client_values = {key: value for key, value in self.values_to_edit.items() if key in client_keys}
@@ -267,6 +278,17 @@ class Options:
 
             self.parameters.current_client = self.parameters.get_current_client_obj()
 
+            # Apply the new coalescing settings to the changes waiting to be published
+            if client_values.keys() & {"quiet_window_in_seconds", "max_batch_size"}:
+                Logs().write_new_log(logging.INFO, "CHANGED CHANGES COALESCING")
+                from Background.PatchProcess import PatchProcess
+                PatchProcess().change_coalescer.configure(self.parameters.current_client.quiet_window_in_seconds, self.parameters.current_client.max_batch_size)
+
+            # Apply the new rate limits and address to the running torrent session
+            if client_values.keys() & {"upload_limit", "download_limit", "ip_address"}:
+                from Background.TorrentHandler import TorrentHandler
+                TorrentHandler().apply_session_settings()
+
         # Update t_users table if needed
         if user_values:
 
@@ -309,7 +331,7 @@ class Options:
         if "user_directory" in client_values:
             Logs().write_new_log(logging.INFO, "CHANGED USER DIRECTORY")
             self.background_process.files_blocks = self.block_level_process.init_blocks()
-            self.background_process.scheduler_changes.shutdown(wait=False)
+            self.background_process.stop_interval_check_for_changes()
             self.background_process.show_popup_if_number_of_connected_clients_is_more_than_zero()
 
         self.parameters.current_client.user_directory = Path(self.parameters.current_client.user_directory)
@@ -67,7 +67,7 @@ class Init:
 
         self.background_process.show_popup_if_number_of_connected_clients_is_more_than_zero(True)
 
-        self.parameters.files_hashes_list_previous = self.parameters.get_list_of_files()
+        self.parameters.files_hashes_list_previous = self.parameters.take_snapshot_of_files()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)  # Init PyQt application
@@ -21,6 +21,8 @@ from Background.RequestsSender import RequestsSender
 
 from Patch import Patch     
 from User import User
+from FileIndex import FileIndex
+from SnapshotStore import SnapshotStore
 
 import logging
 from Logs import Logs
@@ -60,12 +62,14 @@ class Parameters:
 
             self.requests_sender = RequestsSender()  # Initialize the request sender
 
-            if user is not None:
-                self.current_user = self.get_current_user_obj(user['user_id'])  # Get the connected user object
-
             self.is_new_client = False
-            
-            self.current_client = self.get_current_client_obj(logging_in=True)  # Get the connected client object
+
+            # One request for the user, the client, the tokens and the other clients, or one request for each if it fails
+            if user is None or not self.bootstrap_parameters(user['user_id'], user['password']):
+                if user is not None:
+                    self.current_user = self.get_current_user_obj(user['user_id'])  # Get the connected user object
+
+                self.current_client = self.get_current_client_obj(logging_in=True)  # Get the connected client object
 
             if self.is_new_client:
                 return
@@ -76,9 +80,8 @@ class Parameters:
             self.current_client.torrent_directory = Path(self.current_client.torrent_directory)
             self.current_client.user_directory = Path(self.current_client.user_directory)
 
-            self.keep_seeding = True  # Indicates when a torrent should keep or stop seeding
 
-            self.files_hashes_list_previous = self.get_list_of_files()  # Initialize previous file hashes list
+            self.files_hashes_list_previous = self.take_snapshot_of_files()  # Initialize previous file hashes list
 
             Logs().write_new_log(logging.INFO, "INITIALIZED PARAMETERS")
         else:
@@ -87,6 +90,60 @@ class Parameters:
             self.current_client.torrent_directory = Path(self.current_client.torrent_directory)
             self.current_client.user_directory = Path(self.current_client.user_directory)
         
+    def bootstrap_parameters(self, user_id, hashed_password):
+        """Get the user, the client, the tokens, the authenticated clients and the number of connected clients in one request at login.
+        The client is also set as online. The values used later during the startup are kept until they are taken once
+        
+        Parameters:
+            user_id -- The ID of the user
+            hashed_password -- The hashed password of the user, returned at login
+
+        Returns:
+            True if the parameters were retrieved, False if they have to be retrieved request by request
+        """
+        Logs().write_new_log(logging.INFO, "BOOTSTRAPPING PARAMETERS")
+
+        self.mac_address = self.get_mac_address()
+        torrent_directory_absolute_path = os.path.abspath("src/torrent-dir")
+
+        response = self.requests_sender.bootstrap(user_id, hashed_password, self.mac_address, torrent_directory_absolute_path, self.get_ip_address())
+
+        if response is None:
+            Logs().write_new_log(logging.ERROR, "ERROR WHILE BOOTSTRAPPING PARAMETERS")
+            return False
+
+        self.current_user = User(response['user'])
+        self.access_token_server = response['access_token']
+        self.refresh_token_server = response['refresh_token']
+        self.is_new_client = response['new_client']
+
+        self.current_client = Client(response['client'])
+
+        if self.is_new_client:  # First time that the user connects on this client, the popup saves the chosen user directory and reloads the client
+            from GUI.PopupSelectDir import PopupSelectDir
+
+            popup = PopupSelectDir(response['client']['client_id'])  # Create the popup window to set a user directory
+            return True
+
+        self.prefetched = {
+            'clients': response['clients'],
+            'number_of_connected_clients': response['number_of_connected_clients'],
+            'is_online': True
+        }
+
+        return True
+
+    def take_prefetched(self, key):
+        """Take a value retrieved by the bootstrap request. It is only given once, the next calls ask the server again
+        
+        Parameters:
+            key -- The name of the value ('clients', 'number_of_connected_clients' or 'is_online')
+
+        Returns:
+            The value, or None if it was not retrieved or was already taken
+        """
+        return getattr(self, 'prefetched', {}).pop(key, None)
+
     def get_current_user_obj(self, user_id):
         """Get the user that connected
 
@@ -187,41 +244,91 @@ class Parameters:
         Parameters:
             user_id -- The ID of the user"""
         Logs().write_new_log(logging.INFO, "RETRIEVING AUTHENTICATED CLIENTS OF CONNECTED USER")
-        clients_db = self.requests_sender.get_authenticated_clients_of_user(user_id, self.current_client.client_id)
+        clients_db = self.take_prefetched('clients')
+
+        if clients_db is None:
+            clients_db = self.requests_sender.get_authenticated_clients_of_user(user_id, self.current_client.client_id)
         return [Client(client_db) for client_db in clients_db]
 
-    def get_list_of_files(self):
-        """Get all the files inside the user directory of the client"""
+    def get_cache_directory(self):
+        """Get the directory next to the torrent directory in which the client keeps its persistent data"""
+        cache_directory = Path(self.current_client.torrent_directory).parent / "cache-dir"
+        cache_directory.mkdir(parents=True, exist_ok=True)
+
+        return cache_directory
+
+    def get_file_index(self):
+        """Get the index of the user directory, or create it if the user directory changed"""
+        user_directory = Path(self.current_client.user_directory)
+
+        if getattr(self, 'file_index', None) is None or self.file_index.user_directory != user_directory:
+            self.file_index = FileIndex(user_directory, self.get_cache_directory())
+
+        return self.file_index
+
+    def get_snapshot_store(self):
+        """Get the store keeping the content of the last synchronized state of the files"""
+        if getattr(self, 'snapshot_store', None) is None:
+            self.snapshot_store = SnapshotStore(self.get_cache_directory() / "snapshot-objects")
+
+        return self.snapshot_store
+
+    def get_list_of_files(self, dirty_paths=None):
+        """Get all the files inside the user directory of the client.
+        Only the files whose stat tuple changed since the last scan are hashed again, and the content of the files is not loaded.
+
+        Parameters:
+            dirty_paths -- Relative paths reported as changed by the change watcher. If None, the whole user directory is scanned"""
         Logs().write_new_log(logging.INFO, "RETRIEVING LIST OF FILES")
 
         if self.current_client.user_directory.is_dir() == False:
             return []
 
-        files_hashes_list = []
+        indexed_files, changed_files_rel_path = self.get_file_index().scan(dirty_paths)  # Stat the files, hash only the changed ones
 
-        # Traverse all files in the user directory
-        files = Path(self.current_client.user_directory).rglob('*')
-        for file_path in files:
-            file_path = str(file_path)
-            is_directory = os.path.isdir(file_path)
+        # Add file hash information to the list
+        files = []
 
-            if is_directory:  # If the file is a directory
-                encoded_file = b''
-            else:  # If the file is not a directory
-                with open(file_path, 'rb') as file:
-                    encoded_file = file.read()
+        for file_rel_path, entry in indexed_files.items():
+            file = Patch(
+                is_dir=entry['is_dir'],
+                file_rel_path=file_rel_path,
+                hash_var=entry['hash']
+            )
+            file.inode = entry.get('inode')  # Not sent, used to detect the moved files
+            files.append(file)
 
-            file_rel_path = os.path.relpath(file_path, self.current_client.user_directory)  # Relative path of the file
+        return files
 
-            is_directory = int(is_directory == True)  # Convert boolean to int
+    def take_snapshot_of_files(self, keep_files=None, dirty_paths=None):
+        """Get all the files inside the user directory and copy the content of the new ones into the snapshot store,
+        so it can be used later as the base version of the files
 
-            # Add file hash information to the list
-            files_hashes_list.append(Patch(
-                is_dir=is_directory,
-                file_rel_path=file_rel_path,
-                content_bytes=encoded_file,
-                hash_var=0
-            ))
+        Parameters:
+            keep_files -- Other list of files whose content must stay in the snapshot store
+            dirty_paths -- Relative paths reported as changed by the change watcher. If None, the whole user directory is scanned"""
+        Logs().write_new_log(logging.INFO, "TAKING SNAPSHOT OF FILES")
+
+        files_hashes_list = self.get_list_of_files(dirty_paths)
+        snapshot_store = self.get_snapshot_store()
+
+        # The content of the previous snapshot is already in the store
+        previous_hashes = {file.hash for file in getattr(self, 'files_hashes_list_previous', None) or []}
+
+        for file in files_hashes_list:
+            if file.is_dir or file.hash in previous_hashes:
+                continue
+
+            try:
+                # The stored hash can differ from the indexed one if the file was modified in the meantime
+                file.hash = snapshot_store.put_file(self.current_client.user_directory / file.file_rel_path, file.hash)
+            except OSError:  # The file was removed since the scan
+                continue
+
+        hashes_to_keep = {file.hash for file in files_hashes_list + (keep_files or [])}
+
+        if hashes_to_keep != previous_hashes:
+            snapshot_store.collect_garbage(hashes_to_keep)
 
         return files_hashes_list
 
@@ -5,7 +5,7 @@ from Logs import Logs
 
 class Patch(File):
 
-    def __init__(self, is_dir = 0, file_rel_path = 0, content_bytes = 0, hash_var = 0, patch = 0):
+    def __init__(self, is_dir = 0, file_rel_path = 0, content_bytes = 0, hash_var = 0, patch = 0, delta_engine = None):
         """
         Initialize a new Patch object.
         
@@ -15,8 +15,10 @@ class Patch(File):
         content_bytes (bytes): The content bytes of the block.
         hash_var (str): The hash of the block.
         patch (str): The patch of the block.
+        delta_engine (str): The name of the engine that computed the patch (None for bsdiff).
         """
         self.patch = patch
+        self.delta_engine = delta_engine
 
         super().__init__(is_dir, file_rel_path, content_bytes, hash_var)
 
@@ -34,7 +36,8 @@ class Patch(File):
             'file_rel_path': self.file_rel_path,
             'content_bytes': self.content_bytes,
             'hash': self.hash,
-            'patch': self.patch
+            'patch': self.patch,
+            'delta_engine': self.delta_engine
         }
 
     @classmethod
@@ -49,4 +52,4 @@ class Patch(File):
         A Patch object created from the provided dictionary.
         """
         Logs().write_new_log(logging.INFO, "CREATING PATCH AS OBJECT")
-        return Patch(patch_dict['is_dir'], patch_dict['file_rel_path'], patch_dict['content_bytes'], patch_dict['hash'], patch_dict['patch'])
\ No newline at end of file
+        return Patch(patch_dict['is_dir'], patch_dict['file_rel_path'], patch_dict['content_bytes'], patch_dict['hash'], patch_dict['patch'], patch_dict.get('delta_engine'))
\ No newline at end of file
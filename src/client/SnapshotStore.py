@@ -0,0 +1,225 @@
+# Author : Mathias Amato
+# Date : 18.10.2026
+# Project name : Foxync
+# Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
+# Description : File synchronization tool using Bittorrent
+
+import os
+import zlib
+import shutil
+import hashlib
+from pathlib import Path
+
+import logging
+from Logs import Logs
+
+class DecompressingReader:
+    """
+    The DecompressingReader class reads a compressed object by chunks, like an uncompressed object file.
+    """
+
+    READ_SIZE = 64 * 1024  # Size of the compressed reads
+
+    def __init__(self, object_path):
+        """
+        Initialize a new DecompressingReader object.
+
+        Parameters:
+        object_path -- The path of the compressed object.
+        """
+        self.object_file = open(object_path, "rb")
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+
+    def read(self, size=-1):
+        """Read decompressed bytes
+
+        Parameters:
+            size -- The number of bytes to read, or -1 to read until the end of the object"""
+        while size < 0 or len(self.buffer) < size:
+            compressed_bytes = self.object_file.read(self.READ_SIZE)
+
+            if not compressed_bytes:
+                self.buffer += self.decompressor.flush()
+                break
+
+            self.buffer += self.decompressor.decompress(compressed_bytes)
+
+        if size < 0:
+            read_bytes, self.buffer = self.buffer, b""
+        else:
+            read_bytes, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return read_bytes
+
+    def close(self):
+        """Close the object file"""
+        self.object_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_object_file(object_path):
+    """Open an object of the store for reading, decompressing it if needed. Works without a SnapshotStore, e.g. in a worker process
+
+    Parameters:
+        object_path -- The path of the object"""
+    if Path(object_path).suffix == SnapshotStore.COMPRESSED_SUFFIX:
+        return DecompressingReader(object_path)
+
+    return open(object_path, "rb")
+
+class SnapshotStore:
+    """
+    The SnapshotStore class keeps the content of the files of the last synchronized state on disk.
+    Objects are addressed by the SHA-256 of their content, so identical files are only stored once,
+    and are optionally compressed with zlib.
+    """
+
+    COPY_BUFFER_SIZE = 1024 * 1024  # Size of the reads when copying a file into or out of the store
+    COMPRESSION_LEVEL = 1
+    COMPRESSED_SUFFIX = ".z"
+
+    def __init__(self, store_directory, compress=True):
+        """
+        Initialize a new SnapshotStore object.
+
+        Parameters:
+        store_directory -- The directory in which the objects are stored.
+        compress -- Indicates if the new objects are compressed.
+        """
+        self.store_directory = Path(store_directory)
+        self.compress = compress
+
+        self.store_directory.mkdir(parents=True, exist_ok=True)
+
+    def get_object_path(self, content_hash):
+        """Get the path of an object, or None if the object is not in the store
+
+        Parameters:
+            content_hash -- The SHA-256 of the content"""
+        object_path = self.store_directory / content_hash[:2] / content_hash
+
+        if object_path.is_file():
+            return object_path
+
+        compressed_object_path = object_path.with_name(content_hash + self.COMPRESSED_SUFFIX)
+
+        if compressed_object_path.is_file():
+            return compressed_object_path
+
+        return None
+
+    def has_object(self, content_hash):
+        """Check if an object is in the store
+
+        Parameters:
+            content_hash -- The SHA-256 of the content"""
+        return self.get_object_path(content_hash) is not None
+
+    def put_file(self, file_path, content_hash=None):
+        """Copy a file into the store, unless an object with the same content is already stored
+
+        Parameters:
+            file_path -- The full path of the file
+            content_hash -- The SHA-256 of the file if it is already known
+
+        Returns:
+            The SHA-256 of the stored content
+        """
+        if content_hash is not None and self.has_object(content_hash):
+            return content_hash
+
+        temporary_path = self.store_directory / f"incoming-{os.getpid()}-{id(self)}.tmp"
+        file_hash = hashlib.sha256()
+        compressor = zlib.compressobj(self.COMPRESSION_LEVEL) if self.compress else None
+
+        with open(file_path, "rb") as source_file, open(temporary_path, "wb") as object_file:
+            while read_bytes := source_file.read(self.COPY_BUFFER_SIZE):
+                file_hash.update(read_bytes)
+                object_file.write(compressor.compress(read_bytes) if compressor else read_bytes)
+
+            if compressor:
+                object_file.write(compressor.flush())
+
+        content_hash = file_hash.hexdigest()
+
+        if self.has_object(content_hash):  # The file changed since it was hashed, and its new content is already stored
+            temporary_path.unlink()
+            return content_hash
+
+        object_path = self.store_directory / content_hash[:2] / (content_hash + (self.COMPRESSED_SUFFIX if compressor else ""))
+        object_path.parent.mkdir(exist_ok=True)
+        os.replace(temporary_path, object_path)
+
+        return content_hash
+
+    def read_object(self, content_hash):
+        """Read the whole content of an object
+
+        Parameters:
+            content_hash -- The SHA-256 of the content"""
+        object_path = self.get_object_path(content_hash)
+
+        if object_path is None:
+            raise FileNotFoundError(f"Object {content_hash} is not in the snapshot store")
+
+        with open(object_path, "rb") as object_file:
+            content_bytes = object_file.read()
+
+        if object_path.suffix == self.COMPRESSED_SUFFIX:
+            content_bytes = zlib.decompress(content_bytes)
+
+        return content_bytes
+
+    def open_object(self, content_hash):
+        """Open an object for reading by chunks, decompressing it if needed
+
+        Parameters:
+            content_hash -- The SHA-256 of the content"""
+        object_path = self.get_object_path(content_hash)
+
+        if object_path is None:
+            raise FileNotFoundError(f"Object {content_hash} is not in the snapshot store")
+
+        return open_object_file(object_path)
+
+    def copy_object_to_file(self, content_hash, file_path):
+        """Write the content of an object to a file, by chunks
+
+        Parameters:
+            content_hash -- The SHA-256 of the content
+            file_path -- The full path of the file to write"""
+        object_path = self.get_object_path(content_hash)
+
+        if object_path is None:
+            raise FileNotFoundError(f"Object {content_hash} is not in the snapshot store")
+
+        with open(object_path, "rb") as object_file, open(file_path, "wb") as destination_file:
+            if object_path.suffix != self.COMPRESSED_SUFFIX:
+                shutil.copyfileobj(object_file, destination_file, self.COPY_BUFFER_SIZE)
+                return
+
+            decompressor = zlib.decompressobj()
+
+            while read_bytes := object_file.read(self.COPY_BUFFER_SIZE):
+                destination_file.write(decompressor.decompress(read_bytes))
+
+            destination_file.write(decompressor.flush())
+
+    def collect_garbage(self, hashes_to_keep):
+        """Delete the objects that are not referenced anymore
+
+        Parameters:
+            hashes_to_keep -- The hashes of the objects that must be kept"""
+        deleted_objects = 0
+
+        for object_path in self.store_directory.glob("*/*"):
+            if object_path.name.removesuffix(self.COMPRESSED_SUFFIX) not in hashes_to_keep:
+                object_path.unlink()
+                deleted_objects += 1
+
+        Logs().write_new_log(logging.INFO, f"DELETED {deleted_objects} UNREFERENCED SNAPSHOT OBJECTS")
@@ -4,6 +4,8 @@ import hashlib
 import logging
 from Logs import Logs
 class User:
+    DEFAULT_CHUNKING_MODE = "fixed"  # "fixed" cuts files every block_size_in_bytes, "cdc" cuts them at content-defined boundaries
+
     def __init__(self, user):
         """Initialize the user object
 
@@ -15,6 +17,7 @@ class User:
         self.username = user["username"]
         self.hashed_password = user["password"]
         self.block_size_in_bytes = user["block_size_in_bytes"]
+        self.chunking_mode = user.get("chunking_mode") or self.DEFAULT_CHUNKING_MODE
 
     def dict_to_json(self):
         """Convert a dictionary to json
@@ -29,6 +32,7 @@ class User:
             "username": self.username,
             "hashed_password": self.hashed_password,
             "block_size_in_bytes": self.block_size_in_bytes,
+            "chunking_mode": self.chunking_mode,
         }
 
         return json.dumps(user_dict)
\ No newline at end of file
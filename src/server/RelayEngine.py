@@ -0,0 +1,213 @@
+import asyncio
+import json
+import ssl
+import struct
+import threading
+
+class RelayEngine:
+    """
+    The RelayEngine class sends the relayed data to the clients from an asyncio event loop running in its own thread.
+    The API endpoints hand the data over and return immediately, the clients are then reached concurrently
+    with non-blocking sockets, without a thread per client.
+
+    The data is sent as frames: a 4 bytes big-endian length followed by the JSON data. Every client keeps
+    a connection open to the push port of the server, on which the frames are sent. The push channels are identified
+    by the client ID of the access token, so clients sharing an IP address behind a NAT each keep their own channel.
+    A client without push channel is sent the frame through a new connection to its listening port.
+    """
+
+    _instance = None
+
+    CLIENT_PORT = 3125  # Port on which every client listens for the relayed data
+    PUSH_PORT = 3126  # Port on which the clients open their push channel
+    CONNECT_TIMEOUT_IN_SECONDS = 5  # Maximum time to open the connection to a client
+    SEND_TIMEOUT_IN_SECONDS = 30  # Maximum time to send the data to a client
+    MAX_CONCURRENT_CONNECTIONS = 1000  # Maximum number of clients being sent data at the same time
+
+    FRAME_HEADER = struct.Struct("!I")  # Length of the data of a frame
+    MAX_HELLO_SIZE = 64 * 1024  # Maximum size of the frame opening a push channel
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(RelayEngine, cls).__new__(cls)
+
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'initialized'):
+            self.initialized = True
+
+            self.loop = asyncio.new_event_loop()
+            self.connections_semaphore = None  # Created in the event loop
+
+            self.push_channels = {}  # ID of a client -> writer of its push channel
+            self.authenticate_push_channel = None  # Function returning the ID of the client owning an access token, or None
+
+            self.loop_thread = threading.Thread(target=self.run_loop, daemon=True)
+            self.loop_thread.start()
+
+            print("RELAY ENGINE INITIALIZED")
+
+    def run_loop(self):
+        """Run the event loop of the engine until the server stops"""
+        asyncio.set_event_loop(self.loop)
+        self.connections_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_CONNECTIONS)
+        self.loop.run_forever()
+
+    def start_push_server(self, host, certificate_paths=None):
+        """Start accepting the push channels of the clients
+
+        Arguments:
+            host -- The IP address to listen on
+            certificate_paths -- The paths of the certificate and of the key to encrypt the channels with, or None
+        """
+        ssl_context = None
+
+        if certificate_paths is not None:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(*certificate_paths)
+
+        asyncio.run_coroutine_threadsafe(asyncio.start_server(self.handle_push_channel, host, self.PUSH_PORT, ssl=ssl_context), self.loop).result()
+
+        print(f"PUSH CHANNELS ACCEPTED ON PORT {self.PUSH_PORT}")
+
+    async def handle_push_channel(self, reader, writer):
+        """Register the push channel opened by a client, until it is closed
+
+        Arguments:
+            reader -- The reader of the connection
+            writer -- The writer of the connection
+        """
+        client_id = None
+
+        try:
+            header = await asyncio.wait_for(reader.readexactly(self.FRAME_HEADER.size), self.CONNECT_TIMEOUT_IN_SECONDS)
+            (hello_size,) = self.FRAME_HEADER.unpack(header)
+
+            if hello_size > self.MAX_HELLO_SIZE or self.authenticate_push_channel is None:
+                return
+
+            hello = json.loads(await asyncio.wait_for(reader.readexactly(hello_size), self.CONNECT_TIMEOUT_IN_SECONDS))
+
+            # The database is queried outside of the event loop
+            client_id = await self.loop.run_in_executor(None, self.authenticate_push_channel, hello.get('access_token'))
+
+            if client_id is None:
+                print("Push channel refused: invalid access token")
+                return
+
+            client_id = str(client_id)
+            previous_writer = self.push_channels.get(client_id)
+
+            if previous_writer is not None:  # The client reconnected
+                previous_writer.close()
+
+            self.push_channels[client_id] = writer
+            writer.write(self.create_frame({'info_type': "push_channel_ready"}))
+
+            print(f"Push channel opened by client {client_id}")
+
+            while await reader.read(4096):  # The client sends nothing else, the channel is open until it is closed
+                pass
+
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            print(f"Error on push channel of client {client_id}: {e!r}")
+
+        finally:
+            if client_id is not None and self.push_channels.get(client_id) is writer:
+                del self.push_channels[client_id]
+
+                print(f"Push channel closed by client {client_id}")
+
+            writer.close()
+
+    def create_frame(self, data):
+        """Encode data as a frame
+
+        Arguments:
+            data -- The data to encode
+        """
+        encoded_data = json.dumps(data).encode('utf-8')
+
+        return self.FRAME_HEADER.pack(len(encoded_data)) + encoded_data
+
+    def relay(self, recipients, data_to_relay):
+        """Schedule the sending of data to clients and return without waiting for it
+
+        Arguments:
+            recipients -- The (ID, IP address) of the clients to relay the data to
+            data_to_relay -- The data to relay to these clients
+
+        Returns:
+            A concurrent.futures.Future completed once every client was tried
+        """
+        frame = self.create_frame(data_to_relay)  # Encoded once for every recipient
+
+        return asyncio.run_coroutine_threadsafe(self.send_to_clients(list(recipients), frame), self.loop)
+
+    async def send_to_clients(self, recipients, frame):
+        """Send data to clients concurrently
+
+        Arguments:
+            recipients -- The (ID, IP address) of the clients to relay the data to
+            frame -- The frame of the data to relay to these clients
+        """
+        await asyncio.gather(*(self.send_to_client(client_id, ip, frame) for client_id, ip in recipients))
+
+    async def send_to_client(self, client_id, ip, frame):
+        """Send data to a client through its push channel, or through a new connection if it has none
+
+        Arguments:
+            client_id -- The ID of the client to relay the data to
+            ip -- The IP address of that client, used if it has no push channel
+            frame -- The frame of the data to relay to that client
+        """
+        client_id = str(client_id)
+        push_channel = self.push_channels.get(client_id)
+
+        if push_channel is not None:
+            try:
+                push_channel.write(frame)
+                await asyncio.wait_for(push_channel.drain(), self.SEND_TIMEOUT_IN_SECONDS)
+
+                return
+
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"Error sending data to client {client_id} through its push channel: {e!r}")
+
+                if self.push_channels.get(client_id) is push_channel:
+                    del self.push_channels[client_id]
+
+                push_channel.close()
+
+        await self.send_to_client_listening_port(ip, frame)
+
+    async def send_to_client_listening_port(self, ip, frame):
+        """Send data to a client through a new connection to its listening port, a client that cannot be reached in time is skipped
+
+        Arguments:
+            ip -- The IP address of the client to relay the data to
+            frame -- The frame of the data to relay to that client
+        """
+        async with self.connections_semaphore:
+            writer = None
+
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(ip, self.CLIENT_PORT), self.CONNECT_TIMEOUT_IN_SECONDS)
+
+                writer.write(frame)
+                await asyncio.wait_for(writer.drain(), self.SEND_TIMEOUT_IN_SECONDS)
+
+                print(f"Data sent to {ip}")
+
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"Error sending data to {ip}: {e!r}")
+
+            finally:
+                if writer is not None:
+                    writer.close()
+
+                    try:
+                        await asyncio.wait_for(writer.wait_closed(), self.CONNECT_TIMEOUT_IN_SECONDS)
+                    except (OSError, asyncio.TimeoutError):
+                        pass
@@ -1,17 +1,16 @@
-import socket
-import json
-import threading
-import concurrent.futures
 import time
 import platform
 from apscheduler.schedulers.background import BackgroundScheduler 
 
 from database.MariaDB_Connection_Server import MariaDB_Connection_Server
+from RelayEngine import RelayEngine
 
 class Server:
 
     _instance = None
 
+    CHUNKING_MODES = ("fixed", "cdc")  # Ways the clients of a user can cut the files into blocks
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Server, cls).__new__(cls)
@@ -21,9 +20,23 @@ class Server:
         if not hasattr(self, 'initialized'):
             self.initialized = True
             self.conn = MariaDB_Connection_Server()
+            self.relay_engine = RelayEngine()  # Sends the relayed data to the clients in the background
+
+            self.add_missing_columns()
             
             print("SERVER INITIALIZED")
 
+    def add_missing_columns(self):
+        """Add to the database the columns added after it was created"""
+
+        try:
+            self.conn.update_query(f"ALTER TABLE t_users ADD COLUMN IF NOT EXISTS chunking_mode VARCHAR(8) NOT NULL DEFAULT '{self.CHUNKING_MODES[0]}'")
+            self.conn.update_query("ALTER TABLE t_clients ADD COLUMN IF NOT EXISTS quiet_window_in_seconds INT NOT NULL DEFAULT 2")
+            self.conn.update_query("ALTER TABLE t_clients ADD COLUMN IF NOT EXISTS max_batch_size INT NOT NULL DEFAULT 1000")
+
+        except Exception as e:
+            print(f"Failed to add missing columns: {e}")
+
     def get_all_clients(self):
         """Query the database to get all clients"""
         
@@ -36,6 +49,22 @@ class Server:
             print(f"Failed to get all clients: {e}")
             return False
 
+    def get_client(self, client_id):
+        """Query the database to get a client
+
+        Arguments:
+            client_id -- The id of the client
+        """
+
+        try:
+            cur = self.conn.read_query(f"SELECT * FROM t_clients WHERE client_id = '{client_id}'")
+
+            return cur.fetchone()
+
+        except Exception as e:
+            print(f"Failed to get client: {e}")
+            return None
+
     def get_client_with_latest_synchronization(self, ip_address_of_sender):
         """Query the database to get the client with the most recent synchronization
 
@@ -311,6 +340,9 @@ class Server:
         """Query the database to update the options of the current client"""
 
         try:
+            if data["new_values"].get("chunking_mode", self.CHUNKING_MODES[0]) not in self.CHUNKING_MODES:
+                raise ValueError(f"Unknown chunking mode {data['new_values']['chunking_mode']}")
+
             columns = ', '.join([f"{key} = ?" for key in data["new_values"].keys()])
             query = f"UPDATE {data['table']} SET {columns} WHERE {data['id_name']} = ?"
             values = list(data["new_values"].values())
@@ -326,55 +358,23 @@ class Server:
             return False
 
 
-    def create_thread_for_sending_information_to_single_client(self, ip_of_recipient, data_to_relay):
-        """Create new thread for sending data to a single client
+    def relay_information_to_single_client(self, recipient, data_to_relay):
+        """Relay data to a single client, without waiting for it to be sent
 
         Arguments:
-            ip_of_recipient -- The IP address of the client to relay the data to
+            recipient -- The client to relay the data to
             data_to_relay -- The data to relay to that client
         """
-        thread = threading.Thread(target=self.send_information_to_client, args=(ip_of_recipient, 3125, data_to_relay))
-        thread.start()
-        thread.join()
+        self.relay_engine.relay([(recipient["client_id"], recipient["ip_address"])], data_to_relay)
 
-    def create_threads_for_sending_information_to_clients(self, clients, ip_of_sender, data_to_relay):
-        """Create new threads for sending data to all connected clients
+    def relay_information_to_clients(self, clients, client_id_of_sender, data_to_relay):
+        """Relay data to all connected clients, without waiting for it to be sent
         
         Arguments:
             clients -- The clients to relay the data to
-            ip_of_sender -- The IP address of the client that send the data to relay
+            client_id_of_sender -- The ID of the client that send the data to relay, or None if it is not a client
             data_to_relay -- The data to relay to the other clients
         """
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            futures = []
-
-            for client in clients:
-                if client["ip_address"] == ip_of_sender:
-                    continue
-
-                future = executor.submit(self.send_information_to_client, client["ip_address"], 3125, data_to_relay)
-                futures.append(future)
-
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()  # Will raise any exceptions caught by the thread
-                except Exception as e:
-                    print(f"Exception in thread: {e}")
-
-    def send_information_to_client(self, ip, port, data_to_relay):
-        """Send data to clients
-
-        Arguments:
-            ip -- The IP address of the client to relay the data to
-            port -- The port of the client to relay the data to
-            data_to_relay -- The data to relay to that client
-        """
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((ip, port))
-                s.sendall(json.dumps(data_to_relay).encode('utf-8'))
-                print(f"Data sent to {ip}")
-
-        except (socket.error, json.JSONDecodeError) as e:
-            print(f"Error sending data to {ip}: {e}")
+        recipients = [(client["client_id"], client["ip_address"]) for client in clients if str(client["client_id"]) != str(client_id_of_sender)]
 
+        self.relay_engine.relay(recipients, data_to_relay)
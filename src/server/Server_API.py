@@ -4,7 +4,7 @@
 # Project URL : https://gitlab.ictge.ch/mathias-amt/foxync
 # Description : File synchronization tool using Bittorrent
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort
 from flask_jwt_extended import (
     JWTManager, create_access_token, create_refresh_token, jwt_required, get_jwt_identity, decode_token
 )
@@ -37,6 +37,26 @@ ping_handler = PingHandler()
 
 connected_clients = []
 
+def authenticate_push_channel(access_token):
+    """Get the ID of the client owning an access token, for its push channel
+
+    Arguments:
+        access_token -- The access token sent by the client when opening its push channel
+    """
+    try:
+        with app.app_context():
+            identity = decode_token(access_token)['sub']
+
+        client = server.get_client(identity['client_id'])
+
+        return client['client_id'] if client else None
+
+    except Exception as e:
+        print(f"Failed to authenticate push channel: {e}")
+        return None
+
+server.relay_engine.authenticate_push_channel = authenticate_push_channel
+
 @app.route('/')
 def hello_world():
     return "<h1>Hello world! Server is working!</h1>"
@@ -104,13 +124,31 @@ def relay_magnet_link():
     if data_to_relay['info_type'] == "block":
         # When sending back a magnet link generated for the newly connected client
         connecting_client = json.loads(data_to_relay["connecting_client"])
-        server.create_thread_for_sending_information_to_single_client(connecting_client['ip_address'], data_to_relay)
+        server.relay_information_to_single_client(connecting_client, data_to_relay)
 
     else:
         # When sending a magnet link to all the connected clients for synchronization
         connected_clients = server.get_online_and_not_away_clients()
-        ip_of_sender = request.remote_addr  # IP of the sending client, to not get its own magnet link
-        server.create_threads_for_sending_information_to_clients(connected_clients, ip_of_sender, data_to_relay)
+        client_id_of_sender = get_jwt_identity()['client_id']  # ID of the sending client, to not get its own magnet link
+        server.relay_information_to_clients(connected_clients, client_id_of_sender, data_to_relay)
+
+    return "200"
+
+@app.route('/relay_inline_payload', methods=["POST"])
+@jwt_required()
+def relay_inline_payload():
+    data_to_relay = request.json
+
+    if data_to_relay['changes_type'] == "block":
+        # When sending back the blocks for the newly connected client
+        connecting_client = json.loads(data_to_relay["connecting_client"])
+        server.relay_information_to_single_client(connecting_client, data_to_relay)
+
+    else:
+        # When sending the patches to all the connected clients for synchronization
+        connected_clients = server.get_online_and_not_away_clients()
+        client_id_of_sender = get_jwt_identity()['client_id']  # ID of the sending client, to not get its own payload
+        server.relay_information_to_clients(connected_clients, client_id_of_sender, data_to_relay)
 
     return "200"
 
@@ -123,7 +161,7 @@ def relay_blocks():
     ip_address_of_sender = request.remote_addr
     client_with_latest_synchronization = server.get_client_with_latest_synchronization(ip_address_of_sender)
 
-    server.create_thread_for_sending_information_to_single_client(client_with_latest_synchronization["ip_address"], data_to_relay)
+    server.relay_information_to_single_client(client_with_latest_synchronization, data_to_relay)
 
     return "200"
 
@@ -172,6 +210,50 @@ def get_current_client_or_insert_if_not_found():
 
     return jsonify(client=client, new_client=new_client)
 
+@app.route('/bootstrap', methods=["POST"])
+def bootstrap():
+    """Everything a client needs at startup in one request: the user, the client (inserted if not found, with its IP address updated
+    if enabled), the tokens, the authenticated clients of the user and the number of connected clients.
+    The caller is authenticated with the hashed password of the user before anything is changed"""
+    data = request.json
+
+    user = server.get_current_user(data.get('user_id'))
+
+    if not user or not secrets.compare_digest(str(user['password']), str(data.get('hashed_password', ''))):
+        abort(401)
+
+    new_client = False
+
+    client = server.get_current_client(data['user_id'], data['mac_address'])
+
+    if client is None:
+        data['ip_address'] = request.remote_addr
+        client = server.insert_and_get_new_client(data)
+
+        new_client = True
+
+    if not client:
+        abort(500)
+
+    access_token = create_access_token(identity={'user_id': str(client['user_id']), 'client_id': str(client['client_id'])})
+    refresh_token = create_refresh_token(identity={'user_id': str(client['user_id']), 'client_id': str(client['client_id'])})
+
+    if not new_client:
+        if data.get('ip_address') and data['ip_address'] != client['ip_address'] and client['auto_update_ip_address']:
+            server.update_client_ip_address(client['client_id'], data['ip_address'])
+            client['ip_address'] = data['ip_address']
+
+        if data.get('set_online'):
+            server.set_client_status({'client_id': client['client_id'], 'is_online': 1, 'is_away': client['is_away']})
+            ping_handler.update_ping_time_of_client(client['client_id'])
+            client['is_online'] = 1
+
+    clients = server.get_authenticated_clients_of_user(data['user_id']) or []
+    number_of_clients = server.get_number_of_connected_clients(data['user_id']) or {}
+
+    return jsonify(user=user, client=client, new_client=new_client, access_token=access_token, refresh_token=refresh_token,
+                   clients=clients, number_of_connected_clients=number_of_clients.get('COUNT(name)', 0))
+
 @app.route('/get_usernames_authenticated_to_current_client', methods=["GET"])
 def get_usernames_authenticated_to_current_client():
     mac_address = request.args.get('mac_address')
@@ -231,13 +313,15 @@ def update_options():
 
 @app.route('/complete_seeding', methods=['POST'])
 def complete_seeding():
-    data_to_relay = {'info_type': "complete_seeding"}
+    data = request.get_json(silent=True) or {}
+    data_to_relay = {'info_type': "complete_seeding", 'info_hash': data.get('info_hash')}
 
     connected_clients = server.get_online_and_not_away_clients()
 
-    server.create_threads_for_sending_information_to_clients(connected_clients, "0", data_to_relay)
+    server.relay_information_to_clients(connected_clients, None, data_to_relay)
 
     return "200"
 
 if __name__ == '__main__':
+    server.relay_engine.start_push_server(Servers_Info.SERVER_IP.value, ('src/server/ssl/school/cert.pem', 'src/server/ssl/school/key.pem'))
     app.run(debug=False, host=Servers_Info.SERVER_IP.value, port=Servers_Info.SERVER_PORT.value, ssl_context=('src/server/ssl/school/cert.pem', 'src/server/ssl/school/key.pem'))
\ No newline at end of file
@@ -130,14 +130,17 @@ class Tracker:
 
         return True
 
-    def send_stop_seeding_to_server_relay(self):
+    def send_stop_seeding_to_server_relay(self, info_hash):
         """
         Send a request to the server relay to stop seeding.
+
+        Arguments:
+            info_hash -- The info hash of the torrent that every peer downloaded
         """
         try:
             print("Sending stop seeding request to server relay...")
             # Send POST request to the server relay endpoint
-            requests.post(f'https://{Servers_Info.SERVER_IP.value}:{Servers_Info.SERVER_PORT.value}/complete_seeding', json={'info_type': "complete_seeding"}, verify=False)
+            requests.post(f'https://{Servers_Info.SERVER_IP.value}:{Servers_Info.SERVER_PORT.value}/complete_seeding', json={'info_type': "complete_seeding", 'info_hash': info_hash}, verify=False)
         except requests.exceptions.RequestException as e:
             # Print error message if request fails
             print(f"Error while calling /complete_seeding of server: {str(e)}")
@@ -75,7 +75,7 @@ def complete():
     complete_seeding = tracker.delete_info_hash_if_empty_and_return_complete_seeding(peers, ip, url_decoded_info_hash_string)
 
     if complete_seeding:
-        tracker.send_stop_seeding_to_server_relay()
+        tracker.send_stop_seeding_to_server_relay(url_decoded_info_hash_string)
 
     return "200"
 
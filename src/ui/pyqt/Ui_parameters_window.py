@@ -327,6 +327,25 @@ class Ui_parameters_window(object):
         self.spinbox_block_size.setMinimum(1)
         self.spinbox_block_size.setMaximum(999)
         self.spinbox_block_size.setObjectName("spinbox_block_size")
+        self.label_name_14 = QtWidgets.QLabel(self.tab_global_options)
+        self.label_name_14.setGeometry(QtCore.QRect(142, 98, 120, 31))
+        font = QtGui.QFont()
+        font.setPointSize(11)
+        self.label_name_14.setFont(font)
+        self.label_name_14.setObjectName("label_name_14")
+        self.label_ip_status_8 = QtWidgets.QLabel(self.tab_global_options)
+        self.label_ip_status_8.setGeometry(QtCore.QRect(246, 88, 20, 31))
+        font = QtGui.QFont()
+        font.setPointSize(10)
+        self.label_ip_status_8.setFont(font)
+        self.label_ip_status_8.setWhatsThis("")
+        self.label_ip_status_8.setAlignment(QtCore.Qt.AlignCenter)
+        self.label_ip_status_8.setObjectName("label_ip_status_8")
+        self.combobox_chunking_mode = QtWidgets.QComboBox(self.tab_global_options)
+        self.combobox_chunking_mode.setGeometry(QtCore.QRect(410, 98, 151, 32))
+        self.combobox_chunking_mode.setObjectName("combobox_chunking_mode")
+        self.combobox_chunking_mode.addItem("")
+        self.combobox_chunking_mode.addItem("")
         self.label_wrong = QtWidgets.QLabel(self.tab_global_options)
         self.label_wrong.setEnabled(True)
         self.label_wrong.setGeometry(QtCore.QRect(410, 328, 301, 18))
@@ -337,6 +356,59 @@ class Ui_parameters_window(object):
         self.label_wrong.setWordWrap(False)
         self.label_wrong.setObjectName("label_wrong")
         self.tab_options.addTab(self.tab_global_options, "")
+        self.tab_sync_options = QtWidgets.QWidget()
+        self.tab_sync_options.setObjectName("tab_sync_options")
+        self.label_name_15 = QtWidgets.QLabel(self.tab_sync_options)
+        self.label_name_15.setGeometry(QtCore.QRect(88, 20, 190, 31))
+        font = QtGui.QFont()
+        font.setPointSize(11)
+        self.label_name_15.setFont(font)
+        self.label_name_15.setObjectName("label_name_15")
+        self.label_ip_status_9 = QtWidgets.QLabel(self.tab_sync_options)
+        self.label_ip_status_9.setGeometry(QtCore.QRect(196, 10, 21, 31))
+        font = QtGui.QFont()
+        font.setPointSize(10)
+        self.label_ip_status_9.setFont(font)
+        self.label_ip_status_9.setWhatsThis("")
+        self.label_ip_status_9.setAlignment(QtCore.Qt.AlignCenter)
+        self.label_ip_status_9.setObjectName("label_ip_status_9")
+        self.spinbox_quiet_window = QtWidgets.QSpinBox(self.tab_sync_options)
+        self.spinbox_quiet_window.setGeometry(QtCore.QRect(356, 20, 101, 32))
+        self.spinbox_quiet_window.setMinimum(1)
+        self.spinbox_quiet_window.setMaximum(3600)
+        self.spinbox_quiet_window.setObjectName("spinbox_quiet_window")
+        self.label_name_16 = QtWidgets.QLabel(self.tab_sync_options)
+        self.label_name_16.setGeometry(QtCore.QRect(467, 20, 150, 31))
+        font = QtGui.QFont()
+        font.setPointSize(11)
+        self.label_name_16.setFont(font)
+        self.label_name_16.setObjectName("label_name_16")
+        self.label_name_17 = QtWidgets.QLabel(self.tab_sync_options)
+        self.label_name_17.setGeometry(QtCore.QRect(88, 70, 190, 31))
+        font = QtGui.QFont()
+        font.setPointSize(11)
+        self.label_name_17.setFont(font)
+        self.label_name_17.setObjectName("label_name_17")
+        self.label_ip_status_10 = QtWidgets.QLabel(self.tab_sync_options)
+        self.label_ip_status_10.setGeometry(QtCore.QRect(208, 60, 21, 31))
+        font = QtGui.QFont()
+        font.setPointSize(10)
+        self.label_ip_status_10.setFont(font)
+        self.label_ip_status_10.setWhatsThis("")
+        self.label_ip_status_10.setAlignment(QtCore.Qt.AlignCenter)
+        self.label_ip_status_10.setObjectName("label_ip_status_10")
+        self.spinbox_max_batch_size = QtWidgets.QSpinBox(self.tab_sync_options)
+        self.spinbox_max_batch_size.setGeometry(QtCore.QRect(356, 70, 101, 32))
+        self.spinbox_max_batch_size.setMinimum(1)
+        self.spinbox_max_batch_size.setMaximum(1000000)
+        self.spinbox_max_batch_size.setObjectName("spinbox_max_batch_size")
+        self.label_name_18 = QtWidgets.QLabel(self.tab_sync_options)
+        self.label_name_18.setGeometry(QtCore.QRect(467, 70, 150, 31))
+        font = QtGui.QFont()
+        font.setPointSize(11)
+        self.label_name_18.setFont(font)
+        self.label_name_18.setObjectName("label_name_18")
+        self.tab_options.addTab(self.tab_sync_options, "")
         self.button_save_changes = QtWidgets.QPushButton(parameters_window)
         self.button_save_changes.setGeometry(QtCore.QRect(660, 447, 120, 40))
         font = QtGui.QFont()
@@ -385,6 +457,9 @@ class Ui_parameters_window(object):
         parameters_window.setTabOrder(self.textbox_username, self.textbox_current_password)
         parameters_window.setTabOrder(self.textbox_current_password, self.textbox_new_password)
         parameters_window.setTabOrder(self.textbox_new_password, self.spinbox_block_size)
+        parameters_window.setTabOrder(self.spinbox_block_size, self.combobox_chunking_mode)
+        parameters_window.setTabOrder(self.combobox_chunking_mode, self.spinbox_quiet_window)
+        parameters_window.setTabOrder(self.spinbox_quiet_window, self.spinbox_max_batch_size)
 
     def retranslateUi(self, parameters_window):
         _translate = QtCore.QCoreApplication.translate
@@ -431,9 +506,28 @@ class Ui_parameters_window(object):
         self.label_ip_status_3.setText(_translate("parameters_window", "?"))
         self.label_name_11.setText(_translate("parameters_window", "(Keep empty to not update it)"))
         self.label_name_12.setText(_translate("parameters_window", "Kb"))
+        self.label_name_14.setText(_translate("parameters_window", "Block cutting"))
+        self.label_ip_status_8.setToolTip(_translate("parameters_window", "Fixed size blocks are cut every block size, they are the fastest to compute.\n"
+"----\n"
+"Content-defined blocks are cut where the content matches a pattern, around the block size.\n"
+"Data inserted in a file then only changes the blocks around it, but the files are cut slower."))
+        self.label_ip_status_8.setText(_translate("parameters_window", "?"))
+        self.combobox_chunking_mode.setItemText(0, _translate("parameters_window", "Fixed size"))
+        self.combobox_chunking_mode.setItemText(1, _translate("parameters_window", "Content-defined"))
         self.textbox_username.setPlaceholderText(_translate("parameters_window", "Ekki"))
         self.label_wrong.setText(_translate("parameters_window", "Wrong username or password"))
         self.tab_options.setTabText(self.tab_options.indexOf(self.tab_global_options), _translate("parameters_window", "User settings"))
+        self.label_name_15.setText(_translate("parameters_window", "Quiet window"))
+        self.label_ip_status_9.setToolTip(_translate("parameters_window", "The changes are published once no file changed for this time.\n"
+"The files saved several times meanwhile are only sent once."))
+        self.label_ip_status_9.setText(_translate("parameters_window", "?"))
+        self.label_name_16.setText(_translate("parameters_window", "seconds"))
+        self.label_name_17.setText(_translate("parameters_window", "Max batch size"))
+        self.label_ip_status_10.setToolTip(_translate("parameters_window", "The changes are published without waiting once this number\n"
+"of files changed."))
+        self.label_ip_status_10.setText(_translate("parameters_window", "?"))
+        self.label_name_18.setText(_translate("parameters_window", "changed files"))
+        self.tab_options.setTabText(self.tab_options.indexOf(self.tab_sync_options), _translate("parameters_window", "Sync settings"))
         self.button_save_changes.setText(_translate("parameters_window", "Save"))
         self.button_cancel_changes.setText(_translate("parameters_window", "Cancel changes"))
         self.button_open_logs.setText(_translate("parameters_window", "Open logs folder"))